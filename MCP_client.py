@@ -2,7 +2,7 @@
 import asyncio
 from src.agent.core import SupportAgent
 from src.interface.cli import CLIInterface
-from mcp.client.stdio import std_client
+from src.agent.mcp_transport import MCP_SERVER_URL, connect_mcp
 from mcp import ClientSession, StdioServerParameters
 
 
@@ -14,7 +14,8 @@ server_params = StdioServerParameters(
 
 
 async def main():
-    async with std_client(server_params) as (read, write):
+    # MCP_SERVER_URL selects a shared HTTP server; otherwise a private one is launched over stdio
+    async with connect_mcp(MCP_SERVER_URL, server_params) as (read, write):
         print("✅ Connection established")
         async with ClientSession(read, write) as session:
             # Initialize the support agent
@@ -1,33 +1,219 @@
 #!/usr/bin/env python3
+import argparse
+import functools
+import os
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
 from src.tools.database import DatabaseTools
+from src.utils.tracing import tracer
 from mcp.server.fastmcp import FastMCP
 
-mcp = FastMCP("Data Support Agent", "0.1.0")
+load_dotenv()
+
+# Transport settings: stdio serves one client; sse and streamable-http serve many sessions
+# from this one process and its shared database pools
+MCP_TRANSPORT = os.getenv("MCP_TRANSPORT", "stdio")
+MCP_HOST = os.getenv("MCP_HOST", "127.0.0.1")
+MCP_PORT = int(os.getenv("MCP_PORT", "8000"))
+
+# One DatabaseTools (and so one Postgres pool and one CouchDB connection pool) for every session
 db_tools = DatabaseTools()
 
+
+@asynccontextmanager
+async def lifespan(server: FastMCP):
+    # Load the schema catalog in the background so the first describe_schema is served from memory.
+    # Runs for every session; only the first starts a load, later ones find it running or done.
+    db_tools.catalog.load_in_background()
+    yield
+
+
+mcp = FastMCP("Data Support Agent", "0.1.0", lifespan=lifespan, host=MCP_HOST, port=MCP_PORT)
+tracer.service = "mcp-server"
+
+
+def traced_tool(fn):
+    """Run a tool inside a span that continues the client's trace from the request's traceparent"""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            meta = mcp.get_context().request_context.meta
+        except (LookupError, ValueError):
+            meta = None
+        with tracer.span(f"mcp.{fn.__name__}", traceparent=getattr(meta, "traceparent", None)) as span:
+            result = await fn(*args, **kwargs)
+            span.set(result_chars=len(result))
+            return result
+    return wrapper
+
+
+@mcp.tool()
+@traced_tool
+async def query_pg(sql: str, page_size: int = None) -> str:
+    """
+    Execute SQL queries safely.
+    Args:
+        sql (str): The SQL to run.
+        page_size (int): Rows per page (default 200, max 1000). When given, large row sets are
+            paged through fetch_pg_page; when omitted, they are stored under a handle instead.
+    Returns:
+        str: A name:type header line and tab-separated rows (NULL is \\N). A result larger than one
+        page comes back as a preview plus a handle for result_slice, result_filter and result_aggregate.
+        Queries and data changes are checked with EXPLAIN first: reads the planner expects to return too many rows
+        get a LIMIT (noted in the result), and statements still too costly are rejected. Each call
+        also runs under a statement timeout.
+    """
+    return await db_tools.query_pg(sql, page_size)
+
 @mcp.tool()
-async def query_pg(sql: str) -> str:
-    """Execute SQL queries safely"""
-    return db_tools.query_pg(sql)
+@traced_tool
+async def bulk_load_pg(table: str, columns: list[str], rows: list = None, csv: str = None, header: bool = False) -> str:
+    """
+    Load many rows into a Postgres table at once with COPY. Use this instead of long INSERT ... VALUES statements.
+    Args:
+        table (str): Table to load, optionally schema-qualified ("schema.table").
+        columns (list[str]): Columns the values are given for, in order.
+        rows (list): Rows as lists of values in column order, or as objects keyed by column. null is NULL.
+        csv (str): The rows as CSV text instead of rows; an empty unquoted field is NULL.
+        header (bool): Whether the first CSV line is a header to skip.
+    Returns:
+        str: Rows loaded and rejected, with the row number and error for each rejected row.
+        Rows are committed in batches, so rows that load stay loaded when others are rejected.
+    """
+    return await db_tools.bulk_load_pg(table, columns, rows, csv, header)
+
+@mcp.tool()
+@traced_tool
+async def fetch_pg_page(cursor_token: str, page_size: int = None) -> str:
+    """
+    Fetch the next page of a query_pg result set.
+    Args:
+        cursor_token (str): The cursor_token returned by query_pg or a previous fetch_pg_page call.
+        page_size (int): Rows per page (default 200, max 1000).
+    Returns:
+        str: The next page of rows.
+    """
+    return await db_tools.fetch_pg_page(cursor_token, page_size)
+
+@mcp.tool()
+@traced_tool
+async def describe_schema(name: str = None, refresh: bool = False) -> str:
+    """
+    Describe Postgres tables (columns, types, keys, row estimates) and CouchDB databases
+    (document counts, indexes, views) from an in-memory catalog. Use this instead of
+    querying information_schema or listing databases.
+    Args:
+        name (str): A table or CouchDB database name to describe; omit to describe everything.
+        refresh (bool): Reload the catalog first. It already reloads itself after DDL.
+    Returns:
+        str: The schema description.
+    """
+    return await db_tools.describe_schema(name, refresh)
+
+@mcp.tool()
+@traced_tool
+async def result_slice(handle: str, offset: int = 0, limit: int = None, columns: list[str] = None,
+                       order_by: str = None, descending: bool = False) -> str:
+    """
+    Read a window of rows from a large result that query_pg or query_couch stored under a handle.
+    Args:
+        handle (str): The handle from the earlier result's preview.
+        offset (int): Rows to skip.
+        limit (int): Rows to return (default 200, max 1000).
+        columns (list[str]): Columns to return; omit for all.
+        order_by (str): Column to sort by; rows keep their original order otherwise.
+        descending (bool): Sort descending.
+    Returns:
+        str: The rows and their position in the stored result.
+    """
+    return await db_tools.result_slice(handle, offset, limit, columns, order_by, descending)
+
+@mcp.tool()
+@traced_tool
+async def result_filter(handle: str, where: list[list], columns: list[str] = None, limit: int = None,
+                        offset: int = 0, order_by: str = None, descending: bool = False) -> str:
+    """
+    Return the rows of a stored result that match every condition.
+    Args:
+        handle (str): The handle from the earlier result's preview.
+        where (list[list]): Conditions as [column, operator, value]; operators: =, !=, <, <=, >, >=,
+            like, not like, in, not in, is null, is not null.
+        columns (list[str]): Columns to return; omit for all.
+        limit (int): Rows to return (default 200, max 1000).
+        offset (int): Matching rows to skip.
+        order_by (str): Column to sort by.
+        descending (bool): Sort descending.
+    Returns:
+        str: The matching rows and how many matched in total.
+    """
+    return await db_tools.result_filter(handle, where, columns, limit, offset, order_by, descending)
+
+@mcp.tool()
+@traced_tool
+async def result_aggregate(handle: str, metrics: list[str], group_by: list[str] = None, where: list[list] = None) -> str:
+    """
+    Aggregate a stored result without reading its rows.
+    Args:
+        handle (str): The handle from the earlier result's preview.
+        metrics (list[str]): e.g. ["count", "sum:amount", "avg:amount", "min:created_at", "max:created_at",
+            "count_distinct:user_id"].
+        group_by (list[str]): Columns to group by.
+        where (list[list]): Optional [column, operator, value] conditions applied first.
+    Returns:
+        str: One row per group with the requested metrics.
+    """
+    return await db_tools.result_aggregate(handle, metrics, group_by, where)
+
+@mcp.resource("stats://query-cache")
+def query_cache_stats() -> dict:
+    """Hit and miss counters for the query_pg read cache"""
+    return db_tools.cache_stats()
+
+@mcp.resource("stats://query-guard")
+def query_guard_stats() -> dict:
+    """Statements query_pg rejected or limited after checking the planner's estimate"""
+    return db_tools.guard_stats()
 
 @mcp.tool()
-def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None) -> str:
+@traced_tool
+async def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None,
+                      docs: list[dict] = None, doc_ids: list[str] = None, limit: int = None, fields: list[str] = None,
+                      bookmark: str = None, view: str = None) -> str:
     # db_name: str, doc_id: str = None, query: dict = None
     """
     Perform CRUD operations on CouchDB documents in a specific database.
     Args:
         db_name (str): Name of the CouchDB database.
         doc_id (str): Document ID to fetch, update, or delete a specific document.
-        query (dict): Mango query to list documents (if doc_id is not provided).
-        operation (str): The type of operation to perform. Options: "create", "read", "update", "delete".
-        data (dict): The data to use for create or update operations.
+        query (dict): Mango query (or bare selector) to list documents (if doc_id is not provided).
+            For view: view parameters such as group_level, key, startkey, endkey, reduce.
+        operation (str): The type of operation to perform. Options: "create", "read", "update", "delete",
+            "bulk_create", "bulk_read", "bulk_update", "bulk_delete", "create_index", "list_indexes",
+            "view", "define_view", "list_views".
+        data (dict): The data to use for create or update operations. For create_index: {"fields": [...], "name": ...}.
+            For define_view: {"design": ..., "view": ..., "map": "function(doc) {...}", "reduce": "_count" | "_sum" | "_stats" | js}.
+        docs (list[dict]): Documents for bulk_create, or partial documents with "_id" for bulk_update.
+        doc_ids (list[str]): Document IDs for bulk_read or bulk_delete.
+        limit (int): Maximum documents a Mango read returns (default 25, max 200).
+        fields (list[str]): Fields to return from a Mango read instead of whole documents.
+        bookmark (str): Bookmark from a previous Mango read, to fetch the next batch.
+        view (str): "design_name/view_name" for the view operation; aggregates run inside CouchDB.
     Returns:
-        str: The result of the operation.
+        str: The result of the operation. Bulk writes report a status line per document.
     """
-    return db_tools.query_couch(db_name, doc_id, query, operation, data)
+    return await db_tools.query_couch(db_name, doc_id, query, operation, data, docs, doc_ids, limit, fields, bookmark, view)
 
 if __name__ == "__main__":
-    print("Starting server...")
+    parser = argparse.ArgumentParser(description="Data Support Agent MCP server")
+    parser.add_argument("--transport", choices=["stdio", "sse", "streamable-http"], default=MCP_TRANSPORT)
+    parser.add_argument("--host", default=MCP_HOST)
+    parser.add_argument("--port", type=int, default=MCP_PORT)
+    args = parser.parse_args()
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    if args.transport != "stdio":
+        path = mcp.settings.sse_path if args.transport == "sse" else mcp.settings.streamable_http_path
+        print(f"Starting server on http://{args.host}:{args.port}{path} ({args.transport})...")
     # Initialize and run the server
-    mcp.run(transport="stdio")
+    mcp.run(transport=args.transport)
     
\ No newline at end of file
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""Latency the agent loop adds on its own, with the model and the databases replaced by local fakes.
+
+Replays the tool_use sequences recorded in execution-log.txt through Chat.process_query: a fake
+Anthropic endpoint answers each turn from the script and an in-process MCP server returns the
+recorded tool results after a configurable delay. Everything is deterministic, so the numbers
+move only when the client loop does.
+
+    python scripts/bench_agent_loop.py --repeat 20 --tool-latency 0.005 --json logs/bench_agent_loop.json
+"""
+import argparse
+import ast
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "testAagent"))
+os.environ.setdefault("ANTHROPIC_API_KEY", "bench")
+
+from mcp.server.lowlevel import Server  # noqa: E402
+from mcp.shared.memory import create_connected_server_and_client_session  # noqa: E402
+from mcp.types import TextContent  # noqa: E402
+
+from src.agent.rate_limiter import RateLimiter  # noqa: E402
+from src.agent.token_counter import content_text  # noqa: E402
+from src.agent.tool_memo import canonical_key  # noqa: E402
+from src.tests.fake_anthropic import fake_anthropic  # noqa: E402
+
+MARKERS = ("🛠️", "✅", "⚙️", "🔄", "📤", "📊", "📥", "🔍", "🧠", "🤖", "❌", "=")
+
+
+def parse_log(path: str) -> list[dict]:
+    """Scripts from a client transcript: [{"query", "turns": [{"text", "tools": [{"name", "input", "result"}]}]}]."""
+    scripts, script, turn, tool = [], None, None, None
+    lines = Path(path).read_text(encoding="utf-8").splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("📝 Processing query: "):
+            script = {"query": line.removeprefix("📝 Processing query: "), "turns": []}
+            scripts.append(script)
+        elif script and line.startswith("📊 Response breakdown"):
+            turn = {"text": "", "tools": []}
+            script["turns"].append(turn)
+        elif turn is not None and line.startswith("🗣️ Claude's response:"):
+            text = []
+            while i + 1 < len(lines) and not lines[i + 1].startswith(MARKERS):
+                i += 1
+                text.append(lines[i])
+            turn["text"] = "\n".join(text).strip()
+        elif turn is not None and line.startswith("🛠️ Executing tool: "):
+            tool = {"name": line.removeprefix("🛠️ Executing tool: ").split(" (ID:")[0], "input": {}, "result": "ok"}
+            turn["tools"].append(tool)
+        elif tool is not None and line.startswith("📥 Tool input: "):
+            tool["input"] = ast.literal_eval(line.removeprefix("📥 Tool input: "))
+        elif tool is not None and line.startswith("📤 Tool result: "):
+            result = [line.removeprefix("📤 Tool result: ")]
+            while i + 1 < len(lines) and lines[i + 1].strip() and not lines[i + 1].startswith(MARKERS):
+                i += 1
+                result.append(lines[i])
+            tool["result"] = "\n".join(result)
+        i += 1
+    return [s for s in scripts if s["turns"]]
+
+
+def replay(scripts: list[dict]):
+    """Fake model: the n-th assistant turn of the conversation whose first message matches a script."""
+    by_query = {s["query"]: s["turns"] for s in scripts}
+
+    def respond(body: dict) -> dict:
+        turns = by_query[content_text(body["messages"][0]["content"])]
+        index = sum(1 for m in body["messages"] if m["role"] == "assistant")
+        if index >= len(turns):
+            return {"content": [{"type": "text", "text": "Done."}], "stop_reason": "end_turn"}
+        turn = turns[index]
+        content = [{"type": "text", "text": turn["text"]}] if turn["text"] else []
+        content += [{"type": "tool_use", "id": f"toolu_{index:03d}_{n}", "name": t["name"], "input": t["input"]}
+                    for n, t in enumerate(turn["tools"])]
+        return {"content": content, "stop_reason": "tool_use" if turn["tools"] else "end_turn"}
+
+    return respond
+
+
+async def fake_mcp_server(scripts: list[dict], latency: float) -> Server:
+    """Serves the real server's tool schemas and answers each call with its recorded result."""
+    from MCP_server import mcp as real_server
+
+    tools = await real_server.list_tools()
+    results = {canonical_key(t["name"], t["input"]): t["result"]
+               for s in scripts for turn in s["turns"] for t in turn["tools"]}
+    server = Server("bench")
+
+    @server.list_tools()
+    async def list_tools():
+        return tools
+
+    @server.call_tool(validate_input=False)
+    async def call_tool(name: str, arguments: dict):
+        if latency:
+            await asyncio.sleep(latency)
+        return [TextContent(type="text", text=results.get(canonical_key(name, arguments), "ok"))]
+
+    return server
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def covered(intervals: list[tuple[float, float]]) -> float:
+    """Total time covered by possibly overlapping (start, end) intervals."""
+    total, reach = 0.0, float("-inf")
+    for start, end in sorted(intervals):
+        if end > reach:
+            total += end - max(start, reach)
+            reach = end
+    return total
+
+
+class Probe:
+    """Wraps the loop's outside calls and bookkeeping to time them per query."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.outside: list[tuple[float, float]] = []
+        self.api_calls = 0
+        self.token_calls = 0
+        self.token_time = 0.0
+        self.serialize_time = 0.0
+        self.request_bytes = 0
+
+    def timed_outside(self, fn, is_api: bool):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.outside.append((start, time.perf_counter()))
+                self.api_calls += is_api
+        return wrapper
+
+    def timed_tokens(self, fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.token_calls += 1
+                self.token_time += time.perf_counter() - start
+        return wrapper
+
+    def timed_request(self, fn):
+        def wrapper(*args, **kwargs):
+            # Building the cached request plus the JSON encoding the SDK does with it
+            start = time.perf_counter()
+            request = fn(*args, **kwargs)
+            self.request_bytes += len(json.dumps(request, default=str))
+            self.serialize_time += time.perf_counter() - start
+            return request
+        return wrapper
+
+
+async def run(args) -> dict:
+    import mcp_client_test as agent
+
+    scripts = parse_log(args.log)
+    if not scripts:
+        raise SystemExit(f"No scripted queries found in {args.log}")
+    probe = Probe()
+    agent.cached_request = probe.timed_request(agent.cached_request)
+    server = await fake_mcp_server(scripts, args.tool_latency)
+    samples = []
+    async with fake_anthropic(responder=replay(scripts), latency=args.api_latency) as (fake, client):
+        agent.anthropic_client = client
+        async with create_connected_server_and_client_session(server) as session:
+            session.call_tool = probe.timed_outside(session.call_tool, is_api=False)
+            for run_number in range(args.warmup + args.repeat):
+                for script in scripts:
+                    chat = agent.Chat(streaming=args.stream, limiter=RateLimiter(10**6, 10**9, 10**9))
+                    chat.session = session
+                    await chat.initialize_tools(session)
+                    chat.claude_request = probe.timed_outside(chat.claude_request, is_api=True)
+                    chat.claude_stream = probe.timed_outside(chat.claude_stream, is_api=True)
+                    for name in ("count", "calibrate", "message_tokens", "truncate"):
+                        setattr(chat.tokens, name, probe.timed_tokens(getattr(chat.tokens, name)))
+                    probe.reset()
+                    start = time.perf_counter()
+                    await chat.process_query(session, script["query"])
+                    wall = time.perf_counter() - start
+                    if run_number < args.warmup:
+                        continue
+                    iterations = max(1, probe.api_calls)
+                    samples.append({
+                        "wall": wall,
+                        "overhead_per_iteration": (wall - covered(probe.outside)) / iterations,
+                        "iterations": iterations,
+                        "token_calls": probe.token_calls,
+                        "token_time": probe.token_time,
+                        "serialize_per_request": probe.serialize_time / iterations,
+                        "bytes_per_request": probe.request_bytes / iterations,
+                    })
+    return summarize(samples)
+
+
+def summarize(samples: list[dict]) -> dict:
+    walls = [s["wall"] * 1000 for s in samples]
+    overheads = [s["overhead_per_iteration"] * 1000 for s in samples]
+    return {
+        "queries": len(samples),
+        "iterations_per_query": sum(s["iterations"] for s in samples) / len(samples),
+        "query_ms_p50": percentile(walls, 50),
+        "query_ms_p99": percentile(walls, 99),
+        "overhead_ms_per_iteration_p50": percentile(overheads, 50),
+        "overhead_ms_per_iteration_p99": percentile(overheads, 99),
+        "serialize_us_per_request": sum(s["serialize_per_request"] for s in samples) / len(samples) * 1e6,
+        "request_kb": sum(s["bytes_per_request"] for s in samples) / len(samples) / 1024,
+        "token_count_calls_per_query": sum(s["token_calls"] for s in samples) / len(samples),
+        "token_count_us_per_query": sum(s["token_time"] for s in samples) / len(samples) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--log", default=str(ROOT / "execution-log.txt"), help="Client transcript to replay")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--tool-latency", type=float, default=0.0, help="Seconds each fake tool call takes")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds each fake model response takes")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming path")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    # The loop's own printing is part of its cost, but not of this report
+    logging.disable(logging.INFO)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run(args))
+    print(f"{results['queries']} replayed queries, {results['iterations_per_query']:.1f} model turns per query on average "
+          f"({'streaming' if args.stream else 'non-streaming'})")
+    for key, value in results.items():
+        if key not in ("queries", "iterations_per_query"):
+            print(f"{key:<34}{value:>12.2f}")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
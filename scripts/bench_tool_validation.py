@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Per-call cost of tool lookup plus input validation, before and after the tool registry.
+
+Uses the real tool schemas from MCP_server.py; no database or API access is needed.
+
+    python scripts/bench_tool_validation.py --calls 20000
+"""
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from jsonschema import validate  # noqa: E402
+
+from MCP_server import mcp  # noqa: E402
+from src.agent.tool_registry import ToolRegistry  # noqa: E402
+
+SAMPLE_INPUTS = [
+    ("query_pg", {"sql": "SELECT id, email FROM users WHERE created_at > now() - interval '1 day'"}),
+    ("query_couch", {"db_name": "mobilization", "operation": "read", "query": {"selector": {"type": "request"}},
+                     "limit": 50, "fields": ["_id", "status"]}),
+    ("describe_schema", {"name": "users"}),
+    ("result_filter", {"handle": "r_0123abcd", "where": [["region", "=", "north"]], "limit": 20}),
+]
+
+
+def before(tools: list[dict], name: str, tool_input: dict) -> None:
+    """The original path: linear scan, then jsonschema.validate with the raw schema."""
+    tool = next((t for t in tools if t["name"] == name), None)
+    validate(instance=tool_input, schema=tool["input_schema"])
+
+
+def measure(label: str, fn, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        name, tool_input = SAMPLE_INPUTS[i % len(SAMPLE_INPUTS)]
+        fn(name, tool_input)
+    per_call = (time.perf_counter() - start) / calls * 1e6
+    print(f"{label:<28}{per_call:>10.1f} µs/call")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    listed = asyncio.run(mcp.list_tools())
+    registry = ToolRegistry()
+    registry.load(listed)
+    tools = registry.params
+    print(f"{len(tools)} tools, {args.calls} calls over {len(SAMPLE_INPUTS)} sample inputs")
+
+    slow = measure("scan + jsonschema.validate", lambda n, i: before(tools, n, i), args.calls)
+    fast = measure("registry lookup + validate", registry.validate, args.calls)
+    print(f"speedup: {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 from tenacity import retry, stop_after_attempt, wait_exponential
 import anthropic
 from ..utils.config import load_config
+from .prompt_cache import CacheUsage, cached_request
+from .rate_limiter import rate_limit_wait, shared_limiter
 
 
 class AnthropicAPIClient:
@@ -9,15 +11,19 @@ class AnthropicAPIClient:
         self.client = anthropic.AsyncAnthropic()
         self.model = config["model"]["name"]
         self.max_tokens = config["model"]["max_tokens"]
+        self.system_prompt = config["agent"]["system_prompt"]
+        self.cache_usage = CacheUsage()
+        self.limiter = shared_limiter
 
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
+    @retry(stop=stop_after_attempt(3), wait=rate_limit_wait(wait_exponential(multiplier=1, min=1, max=10)))
     async def generate_response(self, messages, tools):
-        """Generate response with context management."""
-        return await self.client.messages.create(
+        """Generate response with context management, caching the system prompt, tools and history prefix."""
+        response = await self.limiter.create(
+            self.client,
             model=self.model,
-            system=self.system_prompt,
             max_tokens=self.max_tokens,
-            messages=messages,
-            tools=tools,
-        )
\ No newline at end of file
+            **cached_request(self.system_prompt, tools, messages),
+        )
+        self.cache_usage.record(response.usage)
+        return response
@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import os
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import anthropic
+from anthropic.types.messages import MessageBatch
+from dotenv import load_dotenv
+from loguru import logger
+
+from ..utils.config import load_config
+from .prompt_cache import CacheUsage, cached_request
+from .token_counter import content_text
+
+load_dotenv()
+
+# First poll delay in seconds; grows by BATCH_POLL_BACKOFF per poll up to BATCH_POLL_MAX
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "10"))
+BATCH_POLL_BACKOFF = float(os.getenv("BATCH_POLL_BACKOFF", "1.5"))
+BATCH_POLL_MAX = float(os.getenv("BATCH_POLL_MAX", "120"))
+# Requests per submitted batch (the API accepts up to 100,000 or 256 MB)
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))
+# Follow-up batches allowed for tool calls before a conversation is given up
+BATCH_MAX_ROUNDS = int(os.getenv("BATCH_MAX_ROUNDS", "8"))
+# Resubmissions of a request that errored transiently or expired
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "2"))
+# Tool calls run at once between rounds
+BATCH_TOOL_CONCURRENCY = int(os.getenv("BATCH_TOOL_CONCURRENCY", "8"))
+
+RETRYABLE_ERRORS = {"api_error", "overloaded_error", "rate_limit_error", "timeout_error"}
+
+RunTool = Callable[[str, dict], Awaitable[str]]
+
+
+@dataclass
+class BatchJob:
+    """One independent conversation carried across batch rounds."""
+    id: str
+    custom_id: str
+    messages: list
+    status: str = "pending"
+    rounds: int = 0
+    retries: int = 0
+    error: str = None
+    tool_calls: list[dict] = field(default_factory=list)
+    usage: CacheUsage = field(default_factory=CacheUsage)
+
+    @property
+    def answer(self) -> str:
+        last = self.messages[-1]
+        return content_text(last["content"]) if last["role"] == "assistant" else ""
+
+
+class BatchAPIClient:
+    """Runs many independent conversations through the Message Batches API at the batch discount.
+
+    Each round submits every open conversation's next turn as one batch (split at
+    BATCH_MAX_REQUESTS) and polls with a growing interval until it ends. Responses that
+    stop for tool_use have their tools run locally, and the conversations go into the next
+    round's batch with the tool results, until each one answers or BATCH_MAX_ROUNDS is hit.
+    """
+
+    def __init__(self, client: anthropic.AsyncAnthropic = None, model: str = None, max_tokens: int = None,
+                 system_prompt: str = None, poll_interval: float = BATCH_POLL_INTERVAL):
+        config = load_config()
+        self.client = client or anthropic.AsyncAnthropic()
+        self.model = model or config["model"]["name"]
+        self.max_tokens = max_tokens or config["model"]["max_tokens"]
+        self.system_prompt = system_prompt or config["agent"]["system_prompt"]
+        self.poll_interval = poll_interval
+        self.cache_usage = CacheUsage()
+        self.polls = 0
+
+    def _request(self, job: BatchJob, tools: list) -> dict:
+        return {
+            "custom_id": job.custom_id,
+            "params": {
+                "model": self.model,
+                "max_tokens": self.max_tokens,
+                **cached_request(self.system_prompt, tools, job.messages),
+            },
+        }
+
+    async def submit(self, jobs: list[BatchJob], tools: list) -> list[str]:
+        """Submit the next turn of every job; returns the batch ids."""
+        batch_ids = []
+        for start in range(0, len(jobs), BATCH_MAX_REQUESTS):
+            chunk = jobs[start:start + BATCH_MAX_REQUESTS]
+            batch = await self.client.messages.batches.create(requests=[self._request(j, tools) for j in chunk])
+            logger.info(f"Submitted batch {batch.id} with {len(chunk)} requests")
+            batch_ids.append(batch.id)
+        return batch_ids
+
+    async def wait(self, batch_id: str) -> MessageBatch:
+        """Poll until the batch has ended, backing off since batches take minutes to hours."""
+        delay = self.poll_interval
+        while True:
+            batch = await self.client.messages.batches.retrieve(batch_id)
+            self.polls += 1
+            if batch.processing_status == "ended":
+                return batch
+            counts = batch.request_counts
+            logger.debug(f"Batch {batch_id}: {counts.processing} processing, {counts.succeeded} succeeded, "
+                         f"{counts.errored} errored")
+            await asyncio.sleep(delay)
+            delay = min(delay * BATCH_POLL_BACKOFF, BATCH_POLL_MAX)
+
+    async def collect(self, batch_id: str, jobs: dict[str, BatchJob]) -> list[BatchJob]:
+        """Apply one ended batch's results; returns the jobs waiting on tool calls or a retry."""
+        next_round = []
+        async for item in await self.client.messages.batches.results(batch_id):
+            job = jobs[item.custom_id]
+            result = item.result
+            if result.type == "succeeded":
+                message = result.message
+                job.usage.record(message.usage)
+                self.cache_usage.record(message.usage)
+                job.messages.append({"role": "assistant", "content": [b.model_dump(exclude_none=True) for b in message.content]})
+                if message.stop_reason == "tool_use":
+                    next_round.append(job)
+                else:
+                    job.status = "succeeded"
+                continue
+            error_type = result.error.error.type if result.type == "errored" else result.type
+            if error_type in RETRYABLE_ERRORS | {"expired"} and job.retries < BATCH_MAX_RETRIES:
+                job.retries += 1
+                next_round.append(job)
+            else:
+                job.status = "errored"
+                job.error = result.error.error.message if result.type == "errored" else result.type
+        return next_round
+
+    async def run_tools(self, jobs: list[BatchJob], run_tool: RunTool) -> None:
+        """Run the tool calls each job's last response asked for and append their results."""
+        semaphore = asyncio.Semaphore(BATCH_TOOL_CONCURRENCY)
+
+        async def call(job: BatchJob, block: dict) -> dict:
+            async with semaphore:
+                try:
+                    content = await run_tool(block["name"], block["input"])
+                except Exception as e:
+                    logger.error(f"Tool {block['name']} failed for {job.id}: {str(e)}")
+                    content = f"Execution error: {str(e)}"
+            job.tool_calls.append({"name": block["name"], "input": block["input"],
+                                   "result": content[:200], "result_chars": len(content)})
+            return {"type": "tool_result", "tool_use_id": block["id"], "content": content}
+
+        async def answer(job: BatchJob) -> None:
+            blocks = [b for b in job.messages[-1]["content"] if b["type"] == "tool_use"]
+            results = await asyncio.gather(*[call(job, block) for block in blocks])
+            job.messages.append({"role": "user", "content": list(results)})
+
+        await asyncio.gather(*[answer(job) for job in jobs if job.messages[-1]["role"] == "assistant"])
+
+    async def run(self, queries: dict[str, str], tools: list, run_tool: RunTool) -> dict[str, BatchJob]:
+        """Answer every query ({id: first user message}) and return the finished jobs by id."""
+        counter = itertools.count()
+        jobs = {}
+        for query_id, query in queries.items():
+            custom_id = f"job-{next(counter)}"  # ids must match ^[a-zA-Z0-9_-]{1,64}$
+            jobs[custom_id] = BatchJob(query_id, custom_id, [{"role": "user", "content": query}])
+        pending = list(jobs.values())
+        for round_number in range(1, BATCH_MAX_ROUNDS + 1):
+            if not pending:
+                break
+            for job in pending:
+                job.rounds = round_number
+            batch_ids = await self.submit(pending, tools)
+            await asyncio.gather(*[self.wait(batch_id) for batch_id in batch_ids])
+            pending = [job for batch_id in batch_ids for job in await self.collect(batch_id, jobs)]
+            await self.run_tools(pending, run_tool)
+            logger.info(f"Batch round {round_number} done; {len(pending)} conversations continue")
+        for job in pending:
+            job.status = "errored"
+            job.error = f"Still calling tools after {BATCH_MAX_ROUNDS} rounds"
+        return {job.id: job for job in jobs.values()}
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from .token_counter import TokenCounter, content_text
+
+load_dotenv()
+
+# Cheaper model used to summarize old turns
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", "claude-3-5-haiku-20241022")
+COMPACTION_MAX_TOKENS = int(os.getenv("COMPACTION_MAX_TOKENS", "1024"))
+# Start summarizing once history reaches this share of the budget...
+COMPACTION_TRIGGER = float(os.getenv("COMPACTION_TRIGGER", "0.7"))
+# ...and fold in enough old turns to bring it back to this share
+COMPACTION_TARGET = float(os.getenv("COMPACTION_TARGET", "0.4"))
+
+SUMMARY_PREFIX = "[Summary of earlier conversation]\n"
+SUMMARY_INSTRUCTIONS = (
+    "You compress the history of a database support conversation. Write a concise summary that keeps every "
+    "fact the assistant learned: table and database names, schemas, ids, query results and numbers, decisions, "
+    "errors hit and what the user still wants. Omit pleasantries. Plain text, no preamble."
+)
+
+
+def _render(message) -> str:
+    """One message as transcript text, naming the tools called and their inputs."""
+    content = message["content"]
+    if isinstance(content, list):
+        parts = []
+        for block in content:
+            data = block.model_dump(exclude_none=True) if hasattr(block, "model_dump") else block
+            if isinstance(data, dict) and data.get("type") == "tool_use":
+                parts.append(f"[called {data['name']} {json.dumps(data.get('input', {}), default=str)}]")
+            elif isinstance(data, dict) and data.get("type") == "tool_result":
+                parts.append(f"[result] {content_text(data.get('content', ''))}")
+            else:
+                parts.append(content_text(data))
+        content = "\n".join(parts)
+    return f"{message['role'].upper()}: {content}"
+
+
+def split_summary(message) -> tuple[list, str]:
+    """Separate a first message into its original content blocks and any summary already folded into it."""
+    content = message["content"]
+    blocks = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+    for i, block in enumerate(blocks):
+        if isinstance(block, dict) and block.get("type") == "text" and block.get("text", "").startswith(SUMMARY_PREFIX):
+            return blocks[:i] + blocks[i + 1:], block["text"][len(SUMMARY_PREFIX):]
+    return blocks, ""
+
+
+class Compactor:
+    """Summarizes old turns in the background and swaps the summary in when it is ready.
+
+    Compaction starts at COMPACTION_TRIGGER of the budget, well before the hard limit,
+    so the summary is normally ready before it is needed. The summarized span always
+    ends where a new assistant turn begins, so tool_use/tool_result pairs move together,
+    and the summary is folded into the first user message to keep roles alternating.
+    """
+
+    def __init__(self, client, model: str = COMPACTION_MODEL, trigger: float = COMPACTION_TRIGGER,
+                 target: float = COMPACTION_TARGET):
+        self.client = client
+        self.model = model
+        self.trigger = trigger
+        self.target = target
+        self._task: asyncio.Task = None
+        # The exact message objects being summarized, to check they are still in place on swap
+        self._span: list = []
+        self.compactions = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def maybe_start(self, messages: list, counter: TokenCounter, budget: int, system: str = None,
+                    tools: list = None) -> bool:
+        """Start summarizing old turns if history is past the trigger and nothing is in progress."""
+        if self._task is not None or counter.count(messages, system, tools) <= budget * self.trigger:
+            return False
+        k = counter.cut_point(messages, int(budget * self.target), system, tools)
+        if k <= 1:
+            return False
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Synchronous callers outside an event loop get the hard truncation only
+            return False
+        self._span = messages[:k]
+        self._task = asyncio.create_task(self._summarize(list(self._span)))
+        logger.info(f"Compacting {k - 1} messages in the background with {self.model}")
+        return True
+
+    async def _summarize(self, span: list) -> str:
+        _, previous = split_summary(span[0])
+        transcript = "\n\n".join(_render(m) for m in span[1:])
+        prompt = (f"Summary so far:\n{previous}\n\n" if previous else "") + f"Conversation to add:\n{transcript}"
+        response = await self.client.messages.create(
+            model=self.model,
+            max_tokens=COMPACTION_MAX_TOKENS,
+            system=SUMMARY_INSTRUCTIONS,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        return "".join(block.text for block in response.content if getattr(block, "type", None) == "text")
+
+    def apply(self, messages: list, counter: TokenCounter = None) -> bool:
+        """Swap a finished summary in for the turns it covers; never waits on a running summary."""
+        if self._task is None or not self._task.done():
+            return False
+        task, span = self._task, self._span
+        self._task, self._span = None, []
+        if task.cancelled() or task.exception() is not None:
+            logger.error(f"Conversation compaction failed: {task.exception() if not task.cancelled() else 'cancelled'}")
+            return False
+        if len(messages) < len(span) or any(a is not b for a, b in zip(messages, span)):
+            logger.warning("History changed under a pending compaction; discarding the summary")
+            return False
+        blocks, _ = split_summary(span[0])
+        first = {**span[0], "content": blocks + [{"type": "text", "text": SUMMARY_PREFIX + task.result()}]}
+        messages[:len(span)] = [first]
+        if counter is not None:
+            counter.forget(span)
+        self.compactions += 1
+        logger.info(f"Compacted {len(span) - 1} messages into a summary")
+        return True
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        self._task, self._span = None, []
@@ -0,0 +1,41 @@
+import os
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+from mcp import StdioServerParameters
+from mcp.client.sse import sse_client
+from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+
+load_dotenv()
+
+# URL of a shared, long-running MCP server (".../mcp" for streamable HTTP, ".../sse" for SSE).
+# Empty means launch a private server over stdio.
+MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "")
+
+DEFAULT_SERVER_PARAMS = StdioServerParameters(
+    command="python",
+    args=["./MCP_server.py"],
+    env=None,
+)
+
+
+def transport_name(url: str = MCP_SERVER_URL) -> str:
+    if not url:
+        return "stdio"
+    return "sse" if url.rstrip("/").endswith("/sse") else "streamable-http"
+
+
+@asynccontextmanager
+async def connect_mcp(url: str = MCP_SERVER_URL, server_params: StdioServerParameters = None):
+    """Open (read, write) streams to the MCP server: over HTTP when a URL is configured, else over stdio."""
+    transport = transport_name(url)
+    if transport == "stdio":
+        async with stdio_client(server_params or DEFAULT_SERVER_PARAMS) as (read, write):
+            yield read, write
+    elif transport == "sse":
+        async with sse_client(url) as (read, write):
+            yield read, write
+    else:
+        async with streamablehttp_client(url) as (read, write, _):
+            yield read, write
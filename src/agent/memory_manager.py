@@ -1,24 +1,28 @@
 from anthropic import AsyncAnthropic
 from ..utils.config import load_config
+from .compaction import Compactor
+from .token_counter import TokenCounter, usage_input_tokens
 
 class MemoryManager:
     """Conversation history and context window management."""
 
     def __init__(self):
         config = load_config()
-        self.client = AsyncAnthropic()
-        self.max_context = config["model"]["context_window "]
+        self.tokens = TokenCounter()
+        self.compactor = Compactor(AsyncAnthropic())
+        self.max_context = config["model"]["context_window"]
 
-    async def truncate_history(self, messages) -> None:
-        """Truncate conversation history to fit within the context window: token limits"""
-        while await self._current_tokens(messages) > self.max_context:
-            if len(messages) == 1:
-                messages.pop(1)
-            else:
-                break
-    
-    async def _current_tokens(self, messages) -> int:
+    def truncate_history(self, messages, system: str = None, tools: list = None) -> list:
+        """Keep history within the context window: swap in finished summaries, start the next one early,
+        and only drop turns if the hard limit is reached before a summary is ready."""
+        self.compactor.apply(messages, self.tokens)
+        self.compactor.maybe_start(messages, self.tokens, self.max_context, system, tools)
+        return self.tokens.truncate(messages, self.max_context, system, tools)
+
+    def record_usage(self, usage, messages, system: str = None, tools: list = None) -> None:
+        """Calibrate the local estimate with the input tokens a response reported for these messages."""
+        self.tokens.calibrate(usage_input_tokens(usage), messages, system, tools)
+
+    def _current_tokens(self, messages, system: str = None, tools: list = None) -> int:
         """Calculate the number of tokens in the current conversation history."""
-        return await self.client.count_tokens(
-            messages=messages
-            ).input_tokens
\ No newline at end of file
+        return self.tokens.count(messages, system, tools)
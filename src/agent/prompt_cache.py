@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+
+# Marks the end of a prefix the API may cache and reuse on the next request
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _block_dict(block) -> dict:
+    if isinstance(block, dict):
+        return dict(block)
+    if hasattr(block, "model_dump"):
+        return block.model_dump(exclude_none=True)
+    return {"type": "text", "text": str(block)}
+
+
+def cached_system(system_prompt: str) -> list[dict]:
+    """System prompt as a text block with a cache breakpoint after it."""
+    return [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+
+
+def cached_tools(tools: list) -> list:
+    """Tool list with a cache breakpoint on the last schema, covering every tool before it."""
+    if not tools:
+        return tools
+    return [*tools[:-1], {**tools[-1], "cache_control": CACHE_CONTROL}]
+
+
+def cached_messages(messages: list) -> list:
+    """Messages with a rolling cache breakpoint on the final block of the last message.
+
+    The stored history is not modified, so only the newest message ever carries the
+    marker; the API finds the previous request's breakpoint on its own when reading.
+    """
+    if not messages:
+        return messages
+    last = messages[-1]
+    content = last["content"]
+    blocks = [{"type": "text", "text": content}] if isinstance(content, str) else [_block_dict(b) for b in content]
+    if not blocks:
+        return messages
+    blocks[-1] = {**blocks[-1], "cache_control": CACHE_CONTROL}
+    return [*messages[:-1], {**last, "content": blocks}]
+
+
+def cached_request(system_prompt: str, tools: list, messages: list) -> dict:
+    """system, tools and messages arguments for messages.create with all three breakpoints set."""
+    return {
+        "system": cached_system(system_prompt),
+        "tools": cached_tools(tools),
+        "messages": cached_messages(messages),
+    }
+
+
+@dataclass
+class CacheUsage:
+    """Prompt cache token counts accumulated over a session from each response's usage."""
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+
+    def record(self, usage) -> None:
+        self.requests += 1
+        self.input_tokens += usage.input_tokens or 0
+        self.output_tokens += usage.output_tokens or 0
+        self.cache_read_tokens += getattr(usage, "cache_read_input_tokens", 0) or 0
+        self.cache_write_tokens += getattr(usage, "cache_creation_input_tokens", 0) or 0
+
+    @property
+    def hit_rate(self) -> float:
+        prompt = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return self.cache_read_tokens / prompt if prompt else 0.0
+
+    def summary(self) -> str:
+        return (f"{self.requests} requests, {self.cache_read_tokens} cache read / {self.cache_write_tokens} cache write / "
+                f"{self.input_tokens} uncached input tokens ({self.hit_rate:.0%} read from cache), "
+                f"{self.output_tokens} output tokens")
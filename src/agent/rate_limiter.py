@@ -0,0 +1,226 @@
+import asyncio
+import json
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+import anthropic
+from anthropic.types import Message
+from dotenv import load_dotenv
+from loguru import logger
+
+from .token_counter import TOKEN_CHARS_PER_TOKEN, content_text
+
+load_dotenv()
+
+# Starting budgets per minute; replaced by the account's real limits from the first response headers
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "50"))
+RATE_LIMIT_INPUT_TPM = int(os.getenv("RATE_LIMIT_INPUT_TPM", "30000"))
+RATE_LIMIT_OUTPUT_TPM = int(os.getenv("RATE_LIMIT_OUTPUT_TPM", "8000"))
+# Output tokens held back per request until its usage is known (capped at max_tokens)
+RATE_LIMIT_OUTPUT_RESERVE = int(os.getenv("RATE_LIMIT_OUTPUT_RESERVE", "1024"))
+# Share of each limit this process plans to use, leaving slack for clock skew and other clients
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.9"))
+# Pause after a 429 that came without a retry-after header
+RATE_LIMIT_DEFAULT_BACKOFF = float(os.getenv("RATE_LIMIT_DEFAULT_BACKOFF", "1.0"))
+
+HEADER_PREFIXES = {
+    "requests": "anthropic-ratelimit-requests",
+    "input_tokens": "anthropic-ratelimit-input-tokens",
+    "output_tokens": "anthropic-ratelimit-output-tokens",
+}
+
+
+class TokenBucket:
+    """A budget of `capacity` units per window that refills continuously."""
+
+    def __init__(self, capacity: float, window: float = 60.0):
+        self.capacity = capacity
+        self.window = window
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.window
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available; more than the whole capacity waits for a full bucket."""
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def give(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, capacity: float, remaining: float, now: float) -> None:
+        """Adopt a capacity from the server's limit and, if lower, its remaining budget.
+
+        The server counts every client on the account, so it may know of spending this process
+        didn't do; a higher figure may just be stale, sent before our later requests arrived.
+        """
+        self._refill(now)
+        self.capacity = capacity
+        self.level = min(self.level, remaining, capacity)
+
+
+def estimate_input_tokens(request: dict, chars_per_token: float = TOKEN_CHARS_PER_TOKEN) -> int:
+    """Rough prompt size of a messages.create request, for callers that have no better count."""
+    text = (content_text(request.get("system") or "") + content_text(request.get("messages", []))
+            + json.dumps(request.get("tools") or [], default=str))
+    return math.ceil(len(text) / chars_per_token)
+
+
+def _limited_input(usage) -> int:
+    # Cached prefix reads don't count towards the input token limit; cache writes do
+    return (usage.input_tokens or 0) + (getattr(usage, "cache_creation_input_tokens", 0) or 0)
+
+
+class RateLimiter:
+    """Keeps every caller sharing it under the account's request, input and output token limits.
+
+    Each call reserves one request, its estimated input tokens and some output tokens before it
+    is sent. Callers are served strictly in arrival order, so one waiting on a big prompt is not
+    overtaken by a stream of small ones. Limits and remaining budgets are taken from the
+    anthropic-ratelimit-* headers of every response, and a 429's retry-after pauses everyone, not
+    just the caller that hit it. Unused output reservations are refunded from the actual usage.
+    """
+
+    def __init__(self, requests_per_minute: int = RATE_LIMIT_RPM,
+                 input_tokens_per_minute: int = RATE_LIMIT_INPUT_TPM,
+                 output_tokens_per_minute: int = RATE_LIMIT_OUTPUT_TPM,
+                 output_reserve: int = RATE_LIMIT_OUTPUT_RESERVE,
+                 window: float = 60.0,
+                 headroom: float = RATE_LIMIT_HEADROOM):
+        self.headroom = headroom
+        self.buckets = {
+            "requests": TokenBucket(requests_per_minute * headroom, window),
+            "input_tokens": TokenBucket(input_tokens_per_minute * headroom, window),
+            "output_tokens": TokenBucket(output_tokens_per_minute * headroom, window),
+        }
+        self.output_reserve = output_reserve
+        self.blocked_until = 0.0
+        self._turn = asyncio.Lock()  # asyncio.Lock wakes waiters first come, first served
+        self.requests = 0
+        self.waits = 0
+        self.waited = 0.0
+        self.rate_limited = 0
+
+    async def acquire(self, input_tokens: int, max_tokens: int = 0) -> dict:
+        """Wait for this caller's turn and budget, then take it; returns the reservation."""
+        reservation = {
+            "requests": 1,
+            "input_tokens": input_tokens,
+            "output_tokens": min(max_tokens, self.output_reserve) if max_tokens else self.output_reserve,
+        }
+        async with self._turn:
+            waited = 0.0
+            while True:
+                now = time.monotonic()
+                delay = max([self.blocked_until - now]
+                            + [bucket.wait_time(reservation[name], now) for name, bucket in self.buckets.items()])
+                if delay <= 0:
+                    break
+                waited += delay
+                await asyncio.sleep(delay)
+            now = time.monotonic()
+            for name, bucket in self.buckets.items():
+                bucket.take(reservation[name], now)
+        self.requests += 1
+        if waited:
+            self.waits += 1
+            self.waited += waited
+            logger.debug(f"Rate limiter held a request for {waited:.2f}s")
+        return reservation
+
+    def update(self, headers, rate_limited: bool = False) -> None:
+        """Adopt limits from response headers; a 429 also pauses every caller for its retry-after."""
+        now = time.monotonic()
+        for name, prefix in HEADER_PREFIXES.items():
+            limit, remaining = headers.get(f"{prefix}-limit"), headers.get(f"{prefix}-remaining")
+            if limit is None or remaining is None:
+                continue
+            try:
+                self.buckets[name].sync(float(limit) * self.headroom, float(remaining), now)
+            except ValueError:
+                continue
+        if rate_limited:
+            self.rate_limited += 1
+            try:
+                pause = float(headers.get("retry-after", RATE_LIMIT_DEFAULT_BACKOFF))
+            except ValueError:
+                pause = RATE_LIMIT_DEFAULT_BACKOFF
+            self.blocked_until = max(self.blocked_until, now + pause)
+            logger.warning(f"Rate limited by the API; pausing all callers for {pause:.2f}s")
+
+    def settle(self, reservation: dict, usage=None, ran: bool = True) -> None:
+        """Refund what a request reserved but did not use; one the API rejected refunds everything."""
+        if ran and usage is None:
+            return
+        used = {"requests": 0, "input_tokens": 0, "output_tokens": 0}
+        if ran:
+            used = {"requests": 1, "input_tokens": _limited_input(usage), "output_tokens": usage.output_tokens or 0}
+        for name, bucket in self.buckets.items():
+            bucket.give(reservation[name] - used[name])
+
+    @asynccontextmanager
+    async def reserve(self, request: dict, input_tokens: int = None):
+        """Hold budget for one API call; the caller records the response headers and usage on the yielded slot."""
+        reservation = await self.acquire(
+            input_tokens if input_tokens is not None else estimate_input_tokens(request),
+            request.get("max_tokens", 0),
+        )
+        slot = _Slot()
+        try:
+            yield slot
+        except anthropic.APIStatusError as e:
+            self.settle(reservation, ran=False)
+            self.update(e.response.headers, rate_limited=e.status_code == 429)
+            raise
+        except BaseException:
+            self.settle(reservation, slot.usage)
+            self.update(slot.headers)
+            raise
+        # Refund first so the headers, applied last, can still lower the result
+        self.settle(reservation, slot.usage)
+        self.update(slot.headers)
+
+    async def create(self, client: anthropic.AsyncAnthropic, input_tokens: int = None, **kwargs) -> Message:
+        """messages.create under the limiter. 429s are raised for the caller's retry after the pause."""
+        async with self.reserve(kwargs, input_tokens) as slot:
+            raw = await client.with_options(max_retries=0).messages.with_raw_response.create(**kwargs)
+            slot.headers = raw.headers
+            message = await raw.parse()
+            slot.usage = message.usage
+            return message
+
+    def stats(self) -> str:
+        return (f"{self.requests} requests, {self.waits} held for {self.waited:.1f}s in total, "
+                f"{self.rate_limited} rate limited")
+
+
+class _Slot:
+    def __init__(self):
+        self.headers = {}
+        self.usage = None
+
+
+def rate_limit_wait(fallback):
+    """tenacity wait that retries a 429 straight away, since the limiter already holds it back."""
+    def wait(retry_state) -> float:
+        if isinstance(retry_state.outcome.exception(), anthropic.RateLimitError):
+            return 0
+        return fallback(retry_state)
+    return wait
+
+
+# One limiter for every caller in the process
+shared_limiter = RateLimiter()
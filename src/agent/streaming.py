@@ -0,0 +1,59 @@
+import asyncio
+from contextlib import nullcontext
+from typing import Awaitable, Callable
+
+import anthropic
+from anthropic.types import Message, ToolUseBlock
+from loguru import logger
+
+from .rate_limiter import RateLimiter
+
+
+class StreamInterrupted(Exception):
+    """The response stream failed after tools had already been started.
+
+    Not worth retrying blindly: the tools may have written data. The tasks are
+    attached so the caller can wait for them before deciding what to do.
+    """
+
+    def __init__(self, cause: Exception, tool_tasks: list[asyncio.Task]):
+        super().__init__(f"Stream interrupted after {len(tool_tasks)} tool calls started: {cause}")
+        self.cause = cause
+        self.tool_tasks = tool_tasks
+
+
+async def stream_message(client: anthropic.AsyncAnthropic,
+                         on_text: Callable[[str], None],
+                         run_tool: Callable[[ToolUseBlock], Awaitable[dict]],
+                         limiter: RateLimiter = None,
+                         input_tokens: int = None,
+                         **kwargs) -> tuple[Message, list[asyncio.Task]]:
+    """Stream one response, printing text as it arrives and starting each tool as soon as its input is complete.
+
+    Returns the final message and one task per tool_use block, in the order the blocks
+    appear, so the caller can gather results while the transcript stays in order.
+    With a limiter, the request waits for its budget and reports headers and usage back to it.
+    """
+    tool_tasks: list[asyncio.Task] = []
+    if limiter:
+        client = client.with_options(max_retries=0)
+    try:
+        async with (limiter.reserve(kwargs, input_tokens) if limiter else nullcontext()) as slot:
+            async with client.messages.stream(**kwargs) as stream:
+                if slot:
+                    slot.headers = stream.response.headers
+                async for event in stream:
+                    if event.type == "text":
+                        on_text(event.text)
+                    elif event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                        block = event.content_block
+                        logger.debug(f"Tool input for {block.name} ({block.id}) complete; dispatching while the model continues")
+                        tool_tasks.append(asyncio.create_task(run_tool(block)))
+                message = await stream.get_final_message()
+            if slot:
+                slot.usage = message.usage
+    except Exception as e:
+        if tool_tasks:
+            raise StreamInterrupted(e, tool_tasks) from e
+        raise
+    return message, tool_tasks
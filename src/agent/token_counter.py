@@ -0,0 +1,136 @@
+import json
+import math
+import os
+
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+# Starting characters-per-token ratio for the local estimate, corrected from API usage as responses arrive
+TOKEN_CHARS_PER_TOKEN = float(os.getenv("TOKEN_CHARS_PER_TOKEN", "3.5"))
+# Fixed cost the API adds for each message's role and framing
+TOKENS_PER_MESSAGE = 4
+# How much weight one usage reading gets when adjusting the calibration
+CALIBRATION_WEIGHT = 0.5
+
+
+def content_text(content) -> str:
+    """Flatten message content (a string, dicts or SDK blocks) into the text the model sees."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(content_text(block) for block in content)
+    if hasattr(content, "model_dump"):
+        content = content.model_dump(exclude_none=True)
+    if isinstance(content, dict):
+        if content.get("type") == "text":
+            return content.get("text", "")
+        if content.get("type") == "tool_result":
+            return content_text(content.get("content", ""))
+        return json.dumps(content, separators=(",", ":"), default=str)
+    return str(content)
+
+
+def usage_input_tokens(usage) -> int:
+    """All prompt tokens in a response's usage, counting cached prefix reads and writes too."""
+    return (usage.input_tokens + (getattr(usage, "cache_read_input_tokens", 0) or 0)
+            + (getattr(usage, "cache_creation_input_tokens", 0) or 0))
+
+
+class TokenCounter:
+    """Local, incremental token accounting for a conversation.
+
+    Each message is estimated once and the estimate is cached by identity, so totals cost
+    nothing to recompute as messages are added and removed. The estimate is scaled by a
+    factor calibrated against the input token counts the API reports with every response.
+    """
+
+    def __init__(self, chars_per_token: float = TOKEN_CHARS_PER_TOKEN):
+        self.chars_per_token = chars_per_token
+        self.scale = 1.0
+        # id(message) -> (message, raw estimate); the message is held so its id is not reused
+        self._cache: dict[int, tuple[object, int]] = {}
+        self._static: dict[str, int] = {}
+
+    def _estimate_text(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def message_tokens(self, message) -> int:
+        """Raw (uncalibrated) estimate for one message, computed once per message."""
+        cached = self._cache.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        tokens = TOKENS_PER_MESSAGE + self._estimate_text(content_text(message["content"]))
+        self._cache[id(message)] = (message, tokens)
+        return tokens
+
+    def static_tokens(self, system: str = None, tools: list = None) -> int:
+        """Raw estimate for the system prompt and tool schemas, cached by their text."""
+        text = (system or "") + json.dumps(tools or [], separators=(",", ":"), default=str)
+        if text not in self._static:
+            self._static = {text: self._estimate_text(text)}
+        return self._static[text]
+
+    def count(self, messages: list, system: str = None, tools: list = None) -> int:
+        """Calibrated token count for a request with these messages, system prompt and tools."""
+        raw = self.static_tokens(system, tools) + sum(self.message_tokens(m) for m in messages)
+        return round(raw * self.scale)
+
+    def calibrate(self, actual_tokens: int, messages: list, system: str = None, tools: list = None) -> None:
+        """Pull the estimate toward what the API actually counted for the same request."""
+        raw = self.static_tokens(system, tools) + sum(self.message_tokens(m) for m in messages)
+        if raw <= 0 or actual_tokens <= 0:
+            return
+        self.scale += CALIBRATION_WEIGHT * (actual_tokens / raw - self.scale)
+        logger.debug(f"Token estimate calibrated: {raw} raw vs {actual_tokens} actual, scale {self.scale:.3f}")
+
+    def forget(self, removed: list) -> None:
+        """Drop cached estimates for messages that left the conversation."""
+        for message in removed:
+            cached = self._cache.get(id(message))
+            if cached is not None and cached[0] is message:
+                del self._cache[id(message)]
+
+    def cut_point(self, messages: list, budget: int, system: str = None, tools: list = None,
+                  keep_first: int = 1) -> int:
+        """Index k such that keeping messages[:keep_first] + messages[k:] fits the budget.
+
+        Found in one pass over per-message counts. k always starts a turn of the other role
+        from messages[keep_first - 1], so roles keep alternating and no tool_result is left
+        without its tool_use. Returns keep_first when nothing needs to go, and the last
+        valid cut when even that does not fit.
+        """
+        counts = [self.message_tokens(m) for m in messages]
+        total = self.static_tokens(system, tools) + sum(counts)
+        if round(total * self.scale) <= budget or len(messages) <= keep_first + 1:
+            return keep_first
+        anchor_role = messages[keep_first - 1]["role"] if keep_first else None
+        best = keep_first
+        for k in range(keep_first, len(messages)):
+            if k > keep_first:
+                total -= counts[k - 1]
+            if messages[k]["role"] == anchor_role or _starts_with_tool_result(messages[k]):
+                continue
+            best = k
+            if round(total * self.scale) <= budget:
+                break
+        return best
+
+    def truncate(self, messages: list, budget: int, system: str = None, tools: list = None,
+                 keep_first: int = 1) -> list:
+        """Remove the oldest messages after the first keep_first in place; returns what was removed."""
+        k = self.cut_point(messages, budget, system, tools, keep_first)
+        removed = messages[keep_first:k]
+        del messages[keep_first:k]
+        self.forget(removed)
+        return removed
+
+
+def _starts_with_tool_result(message) -> bool:
+    content = message["content"]
+    if not isinstance(content, list) or not content:
+        return False
+    first = content[0]
+    kind = first.get("type") if isinstance(first, dict) else getattr(first, "type", None)
+    return kind == "tool_result"
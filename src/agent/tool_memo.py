@@ -0,0 +1,130 @@
+import asyncio
+import json
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from ..tools.query_cache import is_cacheable, normalize_sql, statement_kind
+from ..utils.tracing import current_span
+
+# Reads whose results are safe to reuse until a write in the same scope
+COUCH_READS = {"read", "list_indexes", "view", "list_views", "bulk_read"}
+COUCH_SCHEMA_WRITES = {"create_index", "define_view"}
+RESULT_TOOLS = {"result_slice", "result_filter", "result_aggregate"}
+# Stateful reads: each call returns something different by design
+NEVER_MEMOIZED = {"fetch_pg_page"}
+ERROR_PREFIXES = ("Error", "Query error", "Execution error", "Validation error")
+
+
+def canonical_key(name: str, tool_input: dict) -> tuple[str, str]:
+    return name, json.dumps(tool_input or {}, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def classify(name: str, tool_input: dict) -> tuple[str, set[str]]:
+    """('read', scopes it depends on), ('write', scopes it invalidates) or ('skip', nothing)."""
+    tool_input = tool_input or {}
+    if name in NEVER_MEMOIZED:
+        return "skip", set()
+    if name == "query_pg":
+        sql = normalize_sql(tool_input.get("sql", ""))
+        kind = statement_kind(sql)
+        if kind == "read" and ";" not in sql and tool_input.get("page_size") is None and is_cacheable(sql):
+            return "read", {"pg"}
+        if kind == "read":
+            # Multi-statement batches may hide a write; paged reads hold a server cursor; volatile
+            # functions, locking reads and EXPLAIN ANALYZE give a new answer on every run
+            return ("write", {"pg"}) if ";" in sql else ("skip", set())
+        return "write", {"pg", "schema"} if kind in ("ddl", "other") else {"pg"}
+    if name == "bulk_load_pg":
+        return "write", {"pg"}
+    if name == "query_couch":
+        scope = f"couch:{tool_input.get('db_name')}"
+        operation = tool_input.get("operation", "read")
+        if operation in COUCH_READS:
+            return "read", {scope}
+        return "write", {scope, "schema"} if operation in COUCH_SCHEMA_WRITES else {scope}
+    if name == "describe_schema":
+        return ("skip", set()) if tool_input.get("refresh") else ("read", {"schema"})
+    if name in RESULT_TOOLS:
+        return "read", {"results"}
+    # Unknown tools may change anything
+    return "write", {"*"}
+
+
+class ToolMemo:
+    """Per-session memo of read-only tool calls, keyed on tool name and canonical input.
+
+    Identical calls in flight together share one execution, and finished results are
+    reused until a write tool call touches the same scope (Postgres, one CouchDB
+    database, or the schema catalog).
+    """
+
+    def __init__(self):
+        # key -> (scopes, result)
+        self._results: dict[tuple, tuple[set[str], object]] = {}
+        self._in_flight: dict[tuple, tuple[set[str], asyncio.Future]] = {}
+        self._generation = 0
+        self.calls = 0
+        self.saved = 0
+        self.invalidations = 0
+
+    async def call(self, name: str, tool_input: dict, run: Callable[[], Awaitable]):
+        """Run a tool call through the memo; run() performs the real call."""
+        self.calls += 1
+        kind, scopes = classify(name, tool_input)
+        if kind == "write":
+            self.invalidate(scopes)
+            try:
+                return await run()
+            finally:
+                # Reads that overlapped the write may have seen either state
+                self.invalidate(scopes)
+        if kind == "skip":
+            return await run()
+
+        key = canonical_key(name, tool_input)
+        current_span().set(memo_hit=key in self._results or key in self._in_flight)
+        if key in self._results:
+            self.saved += 1
+            logger.debug(f"Tool memo hit: {name} {key[1][:80]}")
+            return self._results[key][1]
+        if key in self._in_flight:
+            self.saved += 1
+            logger.debug(f"Tool memo joined in-flight call: {name} {key[1][:80]}")
+            return await asyncio.shield(self._in_flight[key][1])
+
+        future = asyncio.ensure_future(run())
+        self._in_flight[key] = (scopes, future)
+        generation = self._generation
+        try:
+            result = await asyncio.shield(future)
+        finally:
+            if self._in_flight.get(key, (None, None))[1] is future:
+                del self._in_flight[key]
+        if generation == self._generation and not _is_error(result):
+            self._results[key] = (scopes, result)
+        return result
+
+    def invalidate(self, scopes: set[str]) -> None:
+        """Forget results depending on any of these scopes ('*' for all)."""
+        self._generation += 1
+        stale = [k for k, (s, _) in self._results.items() if "*" in scopes or s & scopes]
+        for key in stale:
+            del self._results[key]
+        # Later callers must not join a read that started before the write
+        for key in [k for k, (s, _) in self._in_flight.items() if "*" in scopes or s & scopes]:
+            del self._in_flight[key]
+        self.invalidations += len(stale)
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "saved": self.saved, "entries": len(self._results),
+                "invalidations": self.invalidations}
+
+
+def _is_error(result) -> bool:
+    """MCP error results, and tool output that reports an error, are not reused."""
+    if getattr(result, "isError", False):
+        return True
+    content = getattr(result, "content", None)
+    text = content[0].text if content and hasattr(content[0], "text") else result if isinstance(result, str) else ""
+    return text.startswith(ERROR_PREFIXES)
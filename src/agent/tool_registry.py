@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+from loguru import logger
+from mcp import ClientSession, types
+
+
+class ToolRegistry:
+    """MCP tools indexed by name, each with a validator compiled once from its input schema.
+
+    The registry refreshes itself when the server sends notifications/tools/list_changed,
+    recompiling only the tools whose definition changed.
+    """
+
+    def __init__(self):
+        self._tools: dict[str, dict] = {}
+        self._validators: dict[str, object] = {}
+        self._fingerprints: dict[str, str] = {}
+        # Tool params in server order, rebuilt only when the set changes so request prefixes stay stable
+        self._params: list[dict] = []
+        self._refreshing: asyncio.Task = None
+        self._dirty = False
+        self.refreshes = 0
+
+    @property
+    def params(self) -> list[dict]:
+        """Tool definitions in the shape messages.create expects."""
+        return self._params
+
+    def __len__(self) -> int:
+        return len(self._tools)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def get(self, name: str) -> dict:
+        return self._tools.get(name)
+
+    def load(self, tools: list) -> tuple[list[str], list[str], list[str]]:
+        """Apply a full tool listing; returns (added, removed, changed) tool names."""
+        listed = {}
+        for tool in tools:
+            param = {"name": tool.name, "description": tool.description or "", "input_schema": tool.inputSchema}
+            listed[tool.name] = (param, json.dumps(param, sort_keys=True))
+        added = [name for name in listed if name not in self._tools]
+        removed = [name for name in self._tools if name not in listed]
+        changed = [name for name in listed if name in self._tools and self._fingerprints[name] != listed[name][1]]
+        for name in removed:
+            del self._tools[name], self._validators[name], self._fingerprints[name]
+        for name in added + changed:
+            param, fingerprint = listed[name]
+            schema = param["input_schema"]
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+            self._tools[name] = param
+            self._validators[name] = cls(schema)
+            self._fingerprints[name] = fingerprint
+        if added or removed or changed:
+            self._params = [self._tools[name] for name in listed]
+        return added, removed, changed
+
+    def validate(self, name: str, tool_input: dict) -> None:
+        """Raise ValidationError if the input does not match the tool's schema."""
+        error = best_match(self._validators[name].iter_errors(tool_input))
+        if error is not None:
+            raise error
+
+    async def refresh(self, session: ClientSession) -> tuple[list[str], list[str], list[str]]:
+        """Re-list tools from the server, following pagination, and apply the differences."""
+        tools, cursor = [], None
+        while True:
+            response = await session.list_tools(cursor)
+            tools += response.tools
+            cursor = response.nextCursor
+            if not cursor:
+                break
+        added, removed, changed = self.load(tools)
+        self.refreshes += 1
+        if added or removed or changed:
+            logger.info(f"Tool list changed: added {added}, removed {removed}, changed {changed}")
+        return added, removed, changed
+
+    def on_message(self, message, session: ClientSession) -> bool:
+        """Schedule a refresh for a tools/list_changed notification; returns whether it was one.
+
+        The refresh runs as its own task: the message handler is called from the session's
+        receive loop, which has to keep running to deliver the list_tools response.
+        """
+        if not (isinstance(message, types.ServerNotification)
+                and isinstance(message.root, types.ToolListChangedNotification)):
+            return False
+        self._dirty = True
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._refresh_until_current(session))
+        return True
+
+    async def _refresh_until_current(self, session: ClientSession) -> None:
+        # A notification that lands mid-refresh may describe a newer list, so go round again
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self.refresh(session)
+            except Exception as e:
+                logger.error(f"Refreshing the tool list failed: {str(e)}")
+                return
+
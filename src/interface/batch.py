@@ -0,0 +1,136 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from contextlib import AbstractAsyncContextManager
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+# Concurrent agent sessions in a batch run
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# A worker factory opens one session and yields an answer(query) coroutine function for it
+Answer = Callable[[str], Awaitable[dict]]
+WorkerFactory = Callable[[], AbstractAsyncContextManager[Answer]]
+
+
+def load_queries(path: str) -> list[dict]:
+    """Read {"id": ..., "query": ...} records (or bare JSON strings) from a JSONL file."""
+    records, seen = [], set()
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            record = {"query": item} if isinstance(item, str) else dict(item)
+            if not record.get("query"):
+                raise ValueError(f"{path}:{number}: record has no 'query'")
+            record["id"] = str(record.get("id", f"line-{number}"))
+            if record["id"] in seen:
+                raise ValueError(f"{path}:{number}: duplicate id '{record['id']}'")
+            seen.add(record["id"])
+            records.append(record)
+    return records
+
+
+def completed_ids(path: str) -> set[str]:
+    """Ids already answered successfully in an earlier run's output; a torn last line is ignored."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == "ok":
+                done.add(result["id"])
+    return done
+
+
+class ResultWriter:
+    """Appends one JSON line per finished query, flushed and synced so a killed run loses nothing."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        torn = os.path.exists(path) and os.path.getsize(path) > 0 and not _ends_with_newline(path)
+        self._file = open(path, "a", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+
+    def write(self, result: dict) -> None:
+        self._file.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+async def run_batch(input_path: str, output_path: str, worker_factory: WorkerFactory,
+                    concurrency: int = BATCH_CONCURRENCY) -> dict:
+    """Answer every query in input_path across `concurrency` sessions, skipping ones already done.
+
+    Each result line holds the record's fields plus answer, tool_calls, usage, latency_s and
+    status ("ok" or "error"). Failed queries are retried when the run is resumed.
+    """
+    records = load_queries(input_path)
+    done = completed_ids(output_path)
+    pending = [r for r in records if r["id"] not in done]
+    _progress(f"{len(records)} queries, {len(records) - len(pending)} already done, {len(pending)} to run "
+              f"with {concurrency} sessions")
+    queue: asyncio.Queue = asyncio.Queue()
+    for record in pending:
+        queue.put_nowait(record)
+    writer = ResultWriter(output_path)
+    counts = {"ok": 0, "error": 0}
+
+    async def worker(number: int) -> None:
+        if queue.empty():
+            return
+        try:
+            async with worker_factory() as answer:
+                while not queue.empty():
+                    record = queue.get_nowait()
+                    writer.write(await _answer_one(answer, record))
+        except Exception as e:
+            logger.error(f"Batch worker {number} stopped: {str(e)}")
+            _progress(f"worker {number} stopped: {str(e)}")
+
+    async def _answer_one(answer: Answer, record: dict) -> dict:
+        started = time.perf_counter()
+        try:
+            result = {**record, **await answer(record["query"]), "status": "ok"}
+        except Exception as e:
+            result = {**record, "status": "error", "error": str(e)}
+        result["latency_s"] = round(time.perf_counter() - started, 3)
+        counts[result["status"]] += 1
+        finished = counts["ok"] + counts["error"]
+        _progress(f"[{finished}/{len(pending)}] {record['id']}: {result['status']} in {result['latency_s']}s")
+        return result
+
+    try:
+        await asyncio.gather(*[worker(n) for n in range(max(1, concurrency))])
+    finally:
+        writer.close()
+    summary = {"total": len(records), "skipped": len(records) - len(pending), **counts,
+               "not_run": queue.qsize()}
+    _progress(f"batch finished: {summary}")
+    return summary
+
+
+def _progress(message: str) -> None:
+    # Progress goes to stderr so it stays visible while the agent's own output is silenced
+    print(message, file=sys.stderr, flush=True)
@@ -0,0 +1,215 @@
+"""Local stand-in for the Anthropic Messages and Message Batches APIs, with rate limits and rate-limit headers."""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import Callable
+
+import anthropic
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src.agent.rate_limiter import HEADER_PREFIXES, TokenBucket, estimate_input_tokens
+
+
+def echo(body: dict) -> dict:
+    """Default responder: answer with the last user text and no tool calls."""
+    last = body["messages"][-1]["content"] if body.get("messages") else ""
+    text = last if isinstance(last, str) else "ok"
+    return {"content": [{"type": "text", "text": f"echo: {text}"}], "stop_reason": "end_turn"}
+
+
+def _sse(event: dict) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def stream_events(message: dict):
+    """The SSE events the API sends for a finished message."""
+    start = {**message, "content": [], "stop_reason": None,
+             "usage": {**message["usage"], "output_tokens": 0}}
+    yield {"type": "message_start", "message": start}
+    for index, block in enumerate(message["content"]):
+        if block["type"] == "tool_use":
+            yield {"type": "content_block_start", "index": index, "content_block": {**block, "input": {}}}
+            yield {"type": "content_block_delta", "index": index,
+                   "delta": {"type": "input_json_delta", "partial_json": json.dumps(block["input"])}}
+        else:
+            yield {"type": "content_block_start", "index": index, "content_block": {"type": "text", "text": ""}}
+            yield {"type": "content_block_delta", "index": index, "delta": {"type": "text_delta", "text": block["text"]}}
+        yield {"type": "content_block_stop", "index": index}
+    yield {"type": "message_delta", "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+           "usage": {"output_tokens": message["usage"]["output_tokens"]}}
+    yield {"type": "message_stop"}
+
+
+class FakeAnthropic:
+    """Serves /v1/messages, enforcing per-window request and token budgets the way the API does.
+
+    Over budget, a request gets a 429 with retry-after; every response carries the
+    anthropic-ratelimit-* headers. `responder(body)` decides the content of each reply.
+
+    The batch endpoints answer every request with the responder when the batch is created
+    and report it ended after `batch_polls` retrieves. A responder reply of
+    {"error": "<error type>"} becomes an errored batch result.
+    """
+
+    def __init__(self, requests_per_minute: int = 1000, input_tokens_per_minute: int = 1_000_000,
+                 output_tokens_per_minute: int = 1_000_000, window: float = 60.0, latency: float = 0.0,
+                 responder: Callable[[dict], dict] = echo, batch_polls: int = 2):
+        self.buckets = {
+            "requests": TokenBucket(requests_per_minute, window),
+            "input_tokens": TokenBucket(input_tokens_per_minute, window),
+            "output_tokens": TokenBucket(output_tokens_per_minute, window),
+        }
+        self.latency = latency
+        self.responder = responder
+        self.requests = 0
+        self.rejected = 0
+        self.active = 0
+        self.max_active = 0
+        self.bodies: list[dict] = []
+        self.batch_polls = batch_polls
+        self.batches: dict[str, dict] = {}
+        self._ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_post("/v1/messages", self.messages)
+        self.app.router.add_post("/v1/messages/batches", self.create_batch)
+        self.app.router.add_get("/v1/messages/batches/{batch_id}", self.retrieve_batch)
+        self.app.router.add_get("/v1/messages/batches/{batch_id}/results", self.batch_results)
+
+    def headers(self, retry_after: float = None) -> dict:
+        now = time.monotonic()
+        headers = {}
+        for name, prefix in HEADER_PREFIXES.items():
+            bucket = self.buckets[name]
+            bucket.wait_time(0, now)  # refill to now
+            headers[f"{prefix}-limit"] = str(int(bucket.capacity))
+            headers[f"{prefix}-remaining"] = str(max(0, int(bucket.level)))
+        if retry_after is not None:
+            headers["retry-after"] = f"{retry_after:.3f}"
+        return headers
+
+    def message(self, body: dict, input_tokens: int, reply: dict = None) -> dict:
+        reply = reply or self.responder(body)
+        output_tokens = reply.get("output_tokens") or sum(
+            max(1, len(block.get("text", json.dumps(block.get("input", {})))) // 4) for block in reply["content"])
+        return {
+            "id": f"msg_{next(self._ids)}", "type": "message", "role": "assistant", "model": body["model"],
+            "content": reply["content"], "stop_reason": reply["stop_reason"], "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                      "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0},
+        }
+
+    def admit(self, input_tokens: int) -> float:
+        """Take one request and its input tokens, or return how long until they would fit."""
+        now = time.monotonic()
+        need = {"requests": 1, "input_tokens": input_tokens, "output_tokens": 1}
+        wait = max(bucket.wait_time(need[name], now) for name, bucket in self.buckets.items())
+        if wait > 0:
+            return wait
+        self.buckets["requests"].take(1, now)
+        self.buckets["input_tokens"].take(input_tokens, now)
+        return 0.0
+
+    async def messages(self, request):
+        body = await request.json()
+        self.requests += 1
+        input_tokens = estimate_input_tokens(body, chars_per_token=4)
+        wait = self.admit(input_tokens)
+        if wait > 0:
+            self.rejected += 1
+            return web.json_response(
+                {"type": "error", "error": {"type": "rate_limit_error", "message": "Rate limit exceeded"}},
+                status=429, headers=self.headers(retry_after=wait))
+        self.bodies.append(body)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            message = self.message(body, input_tokens)
+            self.buckets["output_tokens"].take(message["usage"]["output_tokens"], time.monotonic())
+            if not body.get("stream"):
+                return web.json_response(message, headers=self.headers())
+            response = web.StreamResponse(headers={"content-type": "text/event-stream", **self.headers()})
+            await response.prepare(request)
+            for event in stream_events(message):
+                await response.write(_sse(event))
+            return response
+        finally:
+            self.active -= 1
+
+    async def create_batch(self, request):
+        body = await request.json()
+        batch_id = f"msgbatch_{next(self._ids)}"
+        results = []
+        for item in body["requests"]:
+            params = item["params"]
+            self.bodies.append(params)
+            reply = self.responder(params)
+            if "error" in reply:
+                result = {"type": "errored", "error": {"type": "error", "error": {
+                    "type": reply["error"], "message": f"Simulated {reply['error']}"}}}
+            else:
+                message = self.message(params, estimate_input_tokens(params, chars_per_token=4), reply)
+                result = {"type": "succeeded", "message": message}
+            results.append({"custom_id": item["custom_id"], "result": result})
+        origin = f"{request.url.scheme}://{request.url.host}:{request.url.port}"
+        self.batches[batch_id] = {"results": results, "polls": 0,
+                                  "results_url": f"{origin}/v1/messages/batches/{batch_id}/results"}
+        return web.json_response(self._batch(batch_id))
+
+    def _batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        ended = batch["polls"] >= self.batch_polls
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for item in batch["results"]:
+            counts[item["result"]["type"] if ended else "processing"] += 1
+        return {
+            "id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts, "created_at": "2025-01-01T00:00:00Z", "expires_at": "2025-01-02T00:00:00Z",
+            "ended_at": "2025-01-01T01:00:00Z" if ended else None, "archived_at": None,
+            "cancel_initiated_at": None, "results_url": batch["results_url"] if ended else None,
+        }
+
+    async def retrieve_batch(self, request):
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self.batches:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "Not found"}},
+                                     status=404)
+        self.batches[batch_id]["polls"] += 1
+        return web.json_response(self._batch(batch_id))
+
+    async def batch_results(self, request):
+        batch = self.batches[request.match_info["batch_id"]]
+        lines = "".join(json.dumps(item) + "\n" for item in batch["results"])
+        return web.Response(text=lines, content_type="application/binary")
+
+
+@asynccontextmanager
+async def fake_anthropic(**options):
+    """Serve a FakeAnthropic on a free local port; yields (fake, client) with SDK retries off."""
+    fake = FakeAnthropic(**options)
+    server = TestServer(fake.app)
+    await server.start_server()
+    client = anthropic.AsyncAnthropic(api_key="test", max_retries=0, base_url=f"http://{server.host}:{server.port}")
+    try:
+        yield fake, client
+    finally:
+        await client.close()
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local fake of the Anthropic Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8300)
+    parser.add_argument("--rpm", type=int, default=1000, help="Requests per minute")
+    parser.add_argument("--input-tpm", type=int, default=1_000_000, help="Input tokens per minute")
+    parser.add_argument("--output-tpm", type=int, default=1_000_000, help="Output tokens per minute")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    args = parser.parse_args()
+    fake = FakeAnthropic(args.rpm, args.input_tpm, args.output_tpm, latency=args.latency)
+    web.run_app(fake.app, host=args.host, port=args.port)
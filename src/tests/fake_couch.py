@@ -0,0 +1,353 @@
+"""In-memory stand-in for the parts of the CouchDB HTTP API the tools use."""
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import uuid
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+
+def _error(status: int, error: str, reason: str) -> web.Response:
+    return web.json_response({"error": error, "reason": reason}, status=status)
+
+
+def _missing_db() -> web.Response:
+    return _error(404, "not_found", "Database does not exist.")
+
+
+def matches(doc: dict, selector: dict) -> bool:
+    """Evaluate the subset of Mango selectors the tests rely on."""
+    for field, condition in selector.items():
+        if field == "$and":
+            if not all(matches(doc, s) for s in condition):
+                return False
+            continue
+        if field == "$or":
+            if not any(matches(doc, s) for s in condition):
+                return False
+            continue
+        value = doc
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$exists" and (value is not None) != expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+            if op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                if op == "$gt" and not value > expected:
+                    return False
+                if op == "$gte" and not value >= expected:
+                    return False
+                if op == "$lt" and not value < expected:
+                    return False
+                if op == "$lte" and not value <= expected:
+                    return False
+    return True
+
+
+def _eval(expr: str, doc: dict):
+    """Evaluate the tiny subset of JavaScript expressions the fake map functions support."""
+    expr = expr.strip()
+    if expr.startswith("["):
+        return [_eval(part, doc) for part in expr[1:-1].split(",")]
+    if expr.startswith("doc."):
+        return doc.get(expr[4:])
+    if expr == "null":
+        return None
+    return json.loads(expr.replace("'", '"'))
+
+
+def run_map(map_fn: str, doc: dict) -> list[tuple]:
+    """Emulate map functions of the form: function(doc) { [if (doc.f == 'v')] emit(key, value); }"""
+    condition = re.search(r"if\s*\(\s*doc\.(\w+)\s*={2,3}\s*(.+?)\s*\)", map_fn)
+    if condition and doc.get(condition.group(1)) != _eval(condition.group(2), doc):
+        return []
+    emit = re.search(r"emit\(\s*(\[[^\]]*\]|[^,]+)\s*,\s*([^)]+?)\s*\)", map_fn)
+    return [(_eval(emit.group(1), doc), _eval(emit.group(2), doc))] if emit else []
+
+
+def run_reduce(reduce_fn: str, values: list):
+    if reduce_fn == "_count":
+        return len(values)
+    if reduce_fn == "_sum":
+        return sum(values)
+    if reduce_fn == "_stats":
+        return {"sum": sum(values), "count": len(values), "min": min(values), "max": max(values),
+                "sumsqr": sum(v * v for v in values)}
+    raise ValueError(f"Unsupported reduce {reduce_fn}")
+
+
+class FakeCouchDB:
+    """Keeps databases in dicts and records every request it serves."""
+
+    def __init__(self, latency: float = 0.0):
+        self.dbs: dict[str, dict[str, dict]] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.latency = latency
+        # (db, id) -> rev of the tombstone left by a delete
+        self.deleted: dict[tuple[str, str], str] = {}
+        # db -> Mango index definitions
+        self.indexes: dict[str, list[dict]] = {}
+        self._revs = itertools.count(1)
+        self.app = web.Application(middlewares=[self._record])
+        self.app.router.add_route("GET", "/", self.welcome)
+        self.app.router.add_route("GET", "/_all_dbs", self.all_dbs)
+        self.app.router.add_route("*", "/{db}", self.database)
+        self.app.router.add_route("POST", "/{db}/_find", self.find)
+        self.app.router.add_route("POST", "/{db}/_explain", self.explain)
+        self.app.router.add_route("*", "/{db}/_index", self.index)
+        self.app.router.add_route("POST", "/{db}/_bulk_docs", self.bulk_docs)
+        self.app.router.add_route("POST", "/{db}/_all_docs", self.all_docs)
+        self.app.router.add_route("GET", "/{db}/_design_docs", self.design_docs)
+        self.app.router.add_route("POST", "/{db}/_design/{ddoc}/_view/{view}", self.view)
+        self.app.router.add_route("*", "/{db}/_design/{ddoc}", self.design_document)
+        self.app.router.add_route("*", "/{db}/{doc_id}", self.document)
+
+    @web.middleware
+    async def _record(self, request, handler):
+        self.requests.append((request.method, request.path))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def create_db(self, name: str, docs: list[dict] = ()) -> None:
+        self.dbs[name] = {}
+        for doc in docs:
+            self.put(name, dict(doc))
+
+    def put(self, db_name: str, doc: dict) -> dict:
+        doc.setdefault("_id", uuid.uuid4().hex)
+        doc["_rev"] = f"{next(self._revs)}-{uuid.uuid4().hex[:8]}"
+        self.dbs[db_name][doc["_id"]] = doc
+        return doc
+
+    def _save(self, db: dict, db_name: str, doc: dict, doc_id: str = None):
+        doc_id = doc_id or doc.get("_id")
+        current = db.get(doc_id) if doc_id else None
+        if current is not None and doc.get("_rev") != current["_rev"]:
+            return None
+        if doc_id:
+            doc["_id"] = doc_id
+        return self.put(db_name, doc)
+
+    async def welcome(self, request):
+        return web.json_response({"couchdb": "Welcome", "version": "3.3.0"})
+
+    async def all_dbs(self, request):
+        return web.json_response(sorted(self.dbs))
+
+    async def database(self, request):
+        name = request.match_info["db"]
+        if request.method == "PUT":
+            if name in self.dbs:
+                return _error(412, "file_exists", "The database could not be created, the file already exists.")
+            self.dbs[name] = {}
+            return web.json_response({"ok": True}, status=201)
+        if name not in self.dbs:
+            return _missing_db()
+        db = self.dbs[name]
+        if request.method in ("GET", "HEAD"):
+            return web.json_response({"db_name": name, "doc_count": len(db)})
+        if request.method == "DELETE":
+            del self.dbs[name]
+            return web.json_response({"ok": True})
+        if request.method == "POST":
+            doc = self._save(db, name, await request.json())
+            if doc is None:
+                return _error(409, "conflict", "Document update conflict.")
+            return web.json_response({"ok": True, "id": doc["_id"], "rev": doc["_rev"]}, status=201)
+        return _error(405, "method_not_allowed", "Only GET,HEAD,POST,PUT,DELETE allowed")
+
+    async def document(self, request, doc_id: str = None):
+        name = request.match_info["db"]
+        doc_id = doc_id or request.match_info["doc_id"]
+        if name not in self.dbs:
+            return _missing_db()
+        db = self.dbs[name]
+        current = db.get(doc_id)
+        if request.method == "PUT":
+            doc = self._save(db, name, await request.json(), doc_id)
+            if doc is None:
+                return _error(409, "conflict", "Document update conflict.")
+            return web.json_response({"ok": True, "id": doc_id, "rev": doc["_rev"]}, status=201)
+        if current is None:
+            return _error(404, "not_found", "missing")
+        if request.method == "GET":
+            return web.json_response(current)
+        if request.method == "HEAD":
+            return web.Response(headers={"ETag": f'"{current["_rev"]}"'})
+        if request.method == "DELETE":
+            if request.query.get("rev") != current["_rev"]:
+                return _error(409, "conflict", "Document update conflict.")
+            del db[doc_id]
+            self.deleted[(name, doc_id)] = f"{next(self._revs)}-deleted"
+            return web.json_response({"ok": True, "id": doc_id, "rev": self.deleted[(name, doc_id)]})
+        return _error(405, "method_not_allowed", "Only GET,HEAD,PUT,DELETE allowed")
+
+    async def design_document(self, request):
+        return await self.document(request, f"_design/{request.match_info['ddoc']}")
+
+    def _plan(self, name: str, body: dict) -> dict:
+        """Pick the first index whose leading field the selector uses, like CouchDB's planner."""
+        fields = [f for f in body.get("selector", {}) if not f.startswith("$")]
+        for index in self.indexes.get(name, []):
+            if index["def"]["fields"] and next(iter(index["def"]["fields"][0])) in fields:
+                return index
+        return {"ddoc": None, "name": "_all_docs", "type": "special", "def": {"fields": [{"_id": "asc"}]}}
+
+    async def find(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        body = await request.json()
+        selector = body.get("selector", {})
+        docs = [d for d in self.dbs[name].values() if not d["_id"].startswith("_design/") and matches(d, selector)]
+        start = int(body.get("bookmark") or body.get("skip", 0))
+        limit = body.get("limit", 25)
+        page = docs[start:start + limit]
+        if body.get("fields"):
+            page = [{f: d[f] for f in body["fields"] if f in d} for d in page]
+        result = {"docs": page, "bookmark": str(start + len(page))}
+        if self._plan(name, body)["type"] == "special":
+            result["warning"] = "No matching index found, create an index to optimize query time."
+        return web.json_response(result)
+
+    async def explain(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        body = await request.json()
+        return web.json_response({"dbname": name, "index": self._plan(name, body), "selector": body.get("selector", {})})
+
+    async def index(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        indexes = self.indexes.setdefault(name, [])
+        if request.method == "GET":
+            special = {"ddoc": None, "name": "_all_docs", "type": "special", "def": {"fields": [{"_id": "asc"}]}}
+            return web.json_response({"total_rows": len(indexes) + 1, "indexes": [special] + indexes})
+        body = await request.json()
+        fields = [f if isinstance(f, dict) else {f: "asc"} for f in body["index"]["fields"]]
+        index_name = body.get("name") or f"idx-{len(indexes) + 1}"
+        ddoc = body.get("ddoc") or f"_design/{index_name}"
+        if any(ix["def"]["fields"] == fields for ix in indexes):
+            return web.json_response({"result": "exists", "id": ddoc, "name": index_name})
+        indexes.append({"ddoc": ddoc, "name": index_name, "type": "json", "def": {"fields": fields}})
+        return web.json_response({"result": "created", "id": ddoc, "name": index_name})
+
+    async def design_docs(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        rows = [{"id": d["_id"], "key": d["_id"], "value": {"rev": d["_rev"]}, "doc": d}
+                for d in self.dbs[name].values() if d["_id"].startswith("_design/")]
+        return web.json_response({"total_rows": len(rows), "rows": rows})
+
+    async def view(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        ddoc = self.dbs[name].get(f"_design/{request.match_info['ddoc']}")
+        definition = (ddoc or {}).get("views", {}).get(request.match_info["view"])
+        if definition is None:
+            return _error(404, "not_found", "missing_named_view")
+        params = await request.json()
+        rows = []
+        for doc in self.dbs[name].values():
+            if not doc["_id"].startswith("_design/"):
+                rows += [{"id": doc["_id"], "key": k, "value": v} for k, v in run_map(definition["map"], doc)]
+        rows.sort(key=lambda r: (json.dumps(r["key"]), r["id"]))
+        if "key" in params:
+            rows = [r for r in rows if r["key"] == params["key"]]
+        start, end = params.get("startkey", params.get("start_key")), params.get("endkey", params.get("end_key"))
+        if start is not None:
+            rows = [r for r in rows if r["key"] >= start]
+        if end is not None:
+            rows = [r for r in rows if r["key"] <= end]
+        if "reduce" in definition and params.get("reduce", True):
+            level = params.get("group_level", 99 if params.get("group") else 0)
+            groups: dict[str, list] = {}
+            for r in rows:
+                key = r["key"][:level] if isinstance(r["key"], list) else (r["key"] if level else None)
+                groups.setdefault(json.dumps(key), []).append(r["value"])
+            rows = [{"key": json.loads(k), "value": run_reduce(definition["reduce"], v)} for k, v in groups.items()]
+        skip = params.get("skip", 0)
+        return web.json_response({"rows": rows[skip:skip + params.get("limit", len(rows))]})
+
+    async def bulk_docs(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        db = self.dbs[name]
+        results = []
+        for doc in (await request.json())["docs"]:
+            doc_id = doc.get("_id")
+            if doc.get("_deleted"):
+                current = db.get(doc_id)
+                if current is None or current["_rev"] != doc.get("_rev"):
+                    results.append({"id": doc_id, "error": "conflict", "reason": "Document update conflict."})
+                    continue
+                del db[doc_id]
+                self.deleted[(name, doc_id)] = f"{next(self._revs)}-deleted"
+                results.append({"ok": True, "id": doc_id, "rev": self.deleted[(name, doc_id)]})
+                continue
+            saved = self._save(db, name, doc)
+            if saved is None:
+                results.append({"id": doc_id, "error": "conflict", "reason": "Document update conflict."})
+            else:
+                results.append({"ok": True, "id": saved["_id"], "rev": saved["_rev"]})
+        return web.json_response(results, status=201)
+
+    async def all_docs(self, request):
+        name = request.match_info["db"]
+        if name not in self.dbs:
+            return _missing_db()
+        db = self.dbs[name]
+        include_docs = request.query.get("include_docs") == "true"
+        rows = []
+        for key in (await request.json())["keys"]:
+            if key in db:
+                row = {"id": key, "key": key, "value": {"rev": db[key]["_rev"]}}
+                if include_docs:
+                    row["doc"] = db[key]
+            elif (name, key) in self.deleted:
+                row = {"id": key, "key": key, "value": {"rev": self.deleted[(name, key)], "deleted": True}, "doc": None}
+            else:
+                row = {"key": key, "error": "not_found"}
+            rows.append(row)
+        return web.json_response({"total_rows": len(db), "rows": rows})
+
+
+@asynccontextmanager
+async def fake_couch(latency: float = 0.0):
+    """Serve a FakeCouchDB on a free local port; yields (fake, url)."""
+    fake = FakeCouchDB(latency)
+    server = TestServer(fake.app)
+    await server.start_server()
+    try:
+        yield fake, f"http://admin:secret@{server.host}:{server.port}"
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an in-memory fake CouchDB server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5984)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    args = parser.parse_args()
+    web.run_app(FakeCouchDB(args.latency).app, host=args.host, port=args.port)
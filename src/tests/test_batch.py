@@ -0,0 +1,80 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+
+from src.interface.batch import completed_ids, load_queries, run_batch
+
+
+def write_queries(path, queries):
+    path.write_text("".join(json.dumps(q) + "\n" for q in queries))
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+
+def fake_workers(state, fail=()):
+    @asynccontextmanager
+    async def worker_factory():
+        state["sessions"] += 1
+
+        async def answer(query):
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+            await asyncio.sleep(0.01)
+            state["active"] -= 1
+            if query in fail:
+                raise RuntimeError("System error: API down")
+            return {"answer": query.upper(), "tool_calls": [{"name": "query_pg"}], "usage": {"requests": 1}}
+
+        yield answer
+
+    return worker_factory
+
+
+def new_state():
+    return {"sessions": 0, "active": 0, "peak": 0}
+
+
+def test_queries_run_across_bounded_sessions(tmp_path):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_queries(source, [{"id": i, "query": f"q{i}"} for i in range(10)] + ["bare question"])
+    state = new_state()
+
+    summary = asyncio.run(run_batch(str(source), str(output), fake_workers(state), concurrency=3))
+
+    results = read_results(output)
+    assert summary == {"total": 11, "skipped": 0, "ok": 11, "error": 0, "not_run": 0}
+    assert state["sessions"] == 3 and state["peak"] == 3
+    by_id = {r["id"]: r for r in results}
+    assert by_id["4"]["answer"] == "Q4" and by_id["4"]["tool_calls"] == [{"name": "query_pg"}]
+    assert by_id["line-11"]["query"] == "bare question"
+    assert all(r["status"] == "ok" and r["latency_s"] >= 0 for r in results)
+
+
+def test_rerun_resumes_and_retries_failures(tmp_path):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_queries(source, [{"id": i, "query": f"q{i}"} for i in range(5)])
+
+    first = asyncio.run(run_batch(str(source), str(output), fake_workers(new_state(), fail={"q2"}), concurrency=2))
+    assert (first["ok"], first["error"]) == (4, 1)
+    assert completed_ids(str(output)) == {"0", "1", "3", "4"}
+
+    # A run killed mid-write leaves a torn last line; it is ignored and not glued to the next result
+    with open(output, "a") as f:
+        f.write('{"id": "3", "status": "o')
+    state = new_state()
+    second = asyncio.run(run_batch(str(source), str(output), fake_workers(state), concurrency=2))
+
+    assert second == {"total": 5, "skipped": 4, "ok": 1, "error": 0, "not_run": 0}
+    assert state["sessions"] == 1  # workers with nothing left to do never open a session
+    assert completed_ids(str(output)) == {"0", "1", "2", "3", "4"}
+
+
+def test_load_queries_rejects_duplicate_ids(tmp_path):
+    source = tmp_path / "in.jsonl"
+    write_queries(source, [{"id": "a", "query": "x"}, {"id": "a", "query": "y"}])
+    with pytest.raises(ValueError, match="duplicate id 'a'"):
+        load_queries(str(source))
@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+from src.agent.batch_client import BatchAPIClient
+from src.agent.token_counter import content_text
+from src.tests.fake_anthropic import fake_anthropic
+
+TOOLS = [{"name": "query_pg", "description": "Run SQL", "input_schema": {"type": "object"}}]
+
+
+def agent(body: dict) -> dict:
+    """Asks for a row count on the first turn and answers from the tool result on the second."""
+    last = body["messages"][-1]["content"]
+    question = content_text(body["messages"][0]["content"])
+    if last[0]["type"] == "text":
+        if "hello" in question:
+            return {"content": [{"type": "text", "text": "Hi!"}], "stop_reason": "end_turn"}
+        table = question.split()[-1]
+        return {"content": [{"type": "text", "text": "Checking."},
+                            {"type": "tool_use", "id": f"toolu_{table}", "name": "query_pg",
+                             "input": {"sql": f"SELECT count(*) FROM {table}"}}],
+                "stop_reason": "tool_use"}
+    result = last[0]["content"]
+    return {"content": [{"type": "text", "text": f"There are {result} rows."}], "stop_reason": "end_turn"}
+
+
+def test_tool_calls_go_back_in_a_follow_up_batch():
+    counts = {"users": "42", "orders": "7"}
+    calls = []
+
+    async def run_tool(name, tool_input):
+        calls.append(tool_input["sql"])
+        return counts[tool_input["sql"].split()[-1]]
+
+    async def run():
+        async with fake_anthropic(responder=agent, batch_polls=3) as (fake, client):
+            batches = BatchAPIClient(client, model="m", max_tokens=100, system_prompt="sys", poll_interval=0.001)
+            jobs = await batches.run({"a": "count users", "b": "count orders", "c": "hello"}, TOOLS, run_tool)
+            return fake, batches, jobs
+
+    fake, batches, jobs = asyncio.run(run())
+    assert {i: j.answer for i, j in jobs.items()} == {"a": "There are 42 rows.", "b": "There are 7 rows.", "c": "Hi!"}
+    assert all(j.status == "succeeded" for j in jobs.values())
+    assert (jobs["a"].rounds, jobs["c"].rounds) == (2, 1)
+    assert sorted(calls) == ["SELECT count(*) FROM orders", "SELECT count(*) FROM users"]
+    assert jobs["a"].tool_calls[0]["result"] == "42"
+    assert len(fake.batches) == 2  # one batch per round, not one request per conversation
+    assert batches.polls == 6
+    # The follow-up carries the whole conversation with the prompt cache breakpoints set
+    follow_up = [b for b in fake.bodies if len(b["messages"]) == 3][0]
+    assert follow_up["system"][0]["cache_control"] == {"type": "ephemeral"}
+    assert follow_up["messages"][2]["content"][0]["type"] == "tool_result"
+
+
+def test_transient_errors_are_resubmitted_and_others_reported():
+    attempts = {}
+
+    def flaky(body):
+        question = content_text(body["messages"][0]["content"])
+        attempts[question] = attempts.get(question, 0) + 1
+        if question == "overloaded once" and attempts[question] == 1:
+            return {"error": "overloaded_error"}
+        if question == "bad request":
+            return {"error": "invalid_request_error"}
+        return {"content": [{"type": "text", "text": "done"}], "stop_reason": "end_turn"}
+
+    async def run():
+        async with fake_anthropic(responder=flaky, batch_polls=1) as (fake, client):
+            batches = BatchAPIClient(client, model="m", max_tokens=100, system_prompt="sys", poll_interval=0.001)
+            return await batches.run({"x": "overloaded once", "y": "bad request"}, TOOLS, None)
+
+    jobs = asyncio.run(run())
+    assert (jobs["x"].status, jobs["x"].answer, jobs["x"].retries) == ("succeeded", "done", 1)
+    assert (jobs["y"].status, jobs["y"].error) == ("errored", "Simulated invalid_request_error")
+    assert attempts == {"overloaded once": 2, "bad request": 1}
+    json.dumps(jobs["x"].messages)  # plain dicts, ready to write out
@@ -0,0 +1,125 @@
+import asyncio
+from types import SimpleNamespace
+
+from anthropic.types import TextBlock
+
+from src.agent.compaction import SUMMARY_PREFIX, Compactor, split_summary
+from src.agent.token_counter import TokenCounter
+from src.tests.test_token_counter import conversation, exchange
+
+
+class FakeMessages:
+    """messages.create stand-in whose responses are released by the test."""
+    def __init__(self, fail=False):
+        self.release = asyncio.Event()
+        self.requests = []
+        self.fail = fail
+
+    async def create(self, **kwargs):
+        self.requests.append(kwargs)
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("overloaded")
+        return SimpleNamespace(content=[TextBlock(type="text", text="users table has 1200 rows")])
+
+
+def compactor_for(fail=False):
+    api = FakeMessages(fail)
+    return Compactor(SimpleNamespace(messages=api), model="cheap-model"), api
+
+
+def test_compaction_starts_early_and_swaps_without_blocking():
+    async def run():
+        counter = TokenCounter()
+        messages = conversation(10)
+        budget = int(counter.count(messages) / 0.8)  # at 80%: past the trigger, under the limit
+        compactor, api = compactor_for()
+        assert compactor.maybe_start(messages, counter, budget)
+        await asyncio.sleep(0)
+        assert compactor.apply(messages, counter) is False  # still running: nothing waits on it
+        messages.extend(exchange(10))
+        api.release.set()
+        await asyncio.sleep(0)
+        assert compactor.apply(messages, counter)
+        return messages, api, counter.count(messages), budget
+
+    messages, api, tokens, budget = asyncio.run(run())
+    assert api.requests[0]["model"] == "cheap-model"
+    assert "[called query_pg" in api.requests[0]["messages"][0]["content"]
+    assert tokens <= budget * 0.5
+    first, summary = split_summary(messages[0])
+    assert first == [{"type": "text", "text": "How many users signed up?"}]
+    assert summary == "users table has 1200 rows"
+    # The kept history starts a fresh assistant turn and still ends with the newest exchange
+    assert messages[1]["role"] == "assistant"
+    assert messages[-1]["content"][0]["tool_use_id"] == "t10"
+    kept_uses = {m["content"][0]["id"] for m in messages[1:] if m["role"] == "assistant"}
+    kept_results = {m["content"][0]["tool_use_id"] for m in messages[1:] if m["role"] == "user"}
+    assert kept_results == kept_uses
+
+
+def test_second_compaction_folds_in_previous_summary():
+    async def run():
+        counter = TokenCounter()
+        messages = conversation(10)
+        messages[0] = {"role": "user", "content": [{"type": "text", "text": "hi"},
+                                                   {"type": "text", "text": SUMMARY_PREFIX + "old facts"}]}
+        compactor, api = compactor_for()
+        api.release.set()
+        compactor.maybe_start(messages, counter, counter.count(messages))
+        await asyncio.sleep(0)
+        compactor.apply(messages, counter)
+        return messages, api
+
+    messages, api = asyncio.run(run())
+    assert api.requests[0]["messages"][0]["content"].startswith("Summary so far:\nold facts")
+    assert split_summary(messages[0]) == ([{"type": "text", "text": "hi"}], "users table has 1200 rows")
+
+
+def test_below_trigger_does_nothing():
+    async def run():
+        counter = TokenCounter()
+        messages = conversation(4)
+        compactor, api = compactor_for()
+        return compactor.maybe_start(messages, counter, counter.count(messages) * 2), api
+
+    started, api = asyncio.run(run())
+    assert started is False and api.requests == []
+
+
+def test_no_background_summary_without_an_event_loop():
+    counter = TokenCounter()
+    messages = conversation(10)
+    compactor, api = compactor_for()
+
+    assert compactor.maybe_start(messages, counter, int(counter.count(messages) / 0.8)) is False
+    assert not compactor.running and api.requests == []
+
+
+def test_summary_is_discarded_if_history_was_truncated_meanwhile():
+    async def run():
+        counter = TokenCounter()
+        messages = conversation(10)
+        compactor, api = compactor_for()
+        compactor.maybe_start(messages, counter, counter.count(messages))
+        counter.truncate(messages, counter.count(messages) // 2)
+        api.release.set()
+        await asyncio.sleep(0)
+        before = list(messages)
+        return compactor.apply(messages, counter), before, messages
+
+    applied, before, after = asyncio.run(run())
+    assert applied is False and before == after
+
+
+def test_failed_summary_leaves_history_alone():
+    async def run():
+        counter = TokenCounter()
+        messages = conversation(10)
+        compactor, api = compactor_for(fail=True)
+        compactor.maybe_start(messages, counter, counter.count(messages))
+        api.release.set()
+        await asyncio.sleep(0)
+        return compactor.apply(messages, counter), len(messages), compactor.running
+
+    assert asyncio.run(run()) == (False, 21, False)
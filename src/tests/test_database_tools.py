@@ -1,131 +1,875 @@
+import asyncio
+import csv
+import io
+import time
+from types import SimpleNamespace
+
 import pytest
-from unittest.mock import patch, MagicMock
-from src.tools.database import DatabaseTools
-import psycopg2
-import couchdb
+import json
+from unittest.mock import patch, AsyncMock
+from src.tests.fake_couch import fake_couch
+from src.tools.encoding import ResultEncoder
+from src.tools.cost_guard import CostGuard, PG_STATEMENT_TIMEOUT_MS, plan_estimate
+from src.tools.database import DatabaseTools, PostgresEngine, PG_MAX_OPEN_CURSORS, split_statements
+import asyncpg
 from loguru import logger
 
+class FakeStatement:
+    """Stand-in for an asyncpg prepared statement."""
+    def __init__(self, conn, sql):
+        self.conn = conn
+        self.sql = sql
+        self.columns, self.rows, self.status = conn.results.get(sql, ([], [], "SELECT 0"))
+
+    def get_attributes(self):
+        return [SimpleNamespace(name=c, type=SimpleNamespace(name="text")) for c in self.columns]
+
+    async def fetch(self):
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        await asyncio.sleep(self.conn.delay)
+        return self.rows
+
+    async def cursor(self):
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        await asyncio.sleep(self.conn.delay)
+        return FakeCursor(self.conn, self.rows)
+
+    def get_statusmsg(self):
+        return self.status
+
+
+class FakeCursor:
+    """Stand-in for an asyncpg server-side cursor; records each fetch size."""
+    def __init__(self, conn, rows):
+        self.conn = conn
+        self.rows = iter(rows)
+
+    async def fetch(self, n):
+        self.conn.fetch_sizes.append(n)
+        return [row for _, row in zip(range(n), self.rows)]
+
+
+class FakeTransaction:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def start(self):
+        self.conn.tx_log.append("start")
+
+    async def commit(self):
+        self.conn.tx_log.append("commit")
+
+    async def rollback(self):
+        self.conn.tx_log.append("rollback")
+
+    async def __aenter__(self):
+        await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await (self.rollback() if exc_type else self.commit())
+
+
+class FakeConnection:
+    """Stand-in for an asyncpg connection; records every statement it runs."""
+    def __init__(self, pid, results, delay=0.0):
+        self.pid = pid
+        self.results = results
+        self.delay = delay
+        self.executed = []
+        self.fetch_sizes = []
+        self.tx_log = []
+        self.closed = False
+        self.healthy = True
+
+    def get_server_pid(self):
+        return self.pid
+
+    def is_closed(self):
+        return self.closed
+
+    def terminate(self):
+        self.closed = True
+
+    async def fetchval(self, sql, *args):
+        if not self.healthy:
+            raise asyncpg.InterfaceError("connection is closed")
+        if sql.startswith("EXPLAIN (FORMAT JSON) "):
+            cost, rows = self.results.get(("plan", sql.removeprefix("EXPLAIN (FORMAT JSON) ")), (1.0, 1))
+            return json.dumps([{"Plan": {"Node Type": "Seq Scan", "Total Cost": cost, "Plan Rows": rows}}])
+        return 1
+
+    async def execute(self, sql):
+        self.executed.append(sql)
+        return "EXECUTE"
+
+    async def prepare(self, sql):
+        self.executed.append(sql)
+        return FakeStatement(self, sql)
+
+    async def fetch(self, sql):
+        self.executed.append(sql)
+        columns, rows, _ = self.results.get(sql, ([], [], "SELECT 0"))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def copy_to_table(self, table_name, source, columns, schema_name=None, format=None):
+        """COPY ... FROM STDIN in CSV: refuses the whole batch if any row holds a value listed as bad."""
+        self.executed.append(f"COPY {table_name}")
+        if isinstance(self.results.get(("copy", table_name)), Exception):
+            raise self.results[("copy", table_name)]
+        rows = list(csv.reader(io.StringIO(source.decode())))
+        bad = self.results.get(("bad", table_name), set())
+        for row in rows:
+            if bad & set(row):
+                raise asyncpg.InvalidTextRepresentationError(f"invalid input syntax for type integer: {row[1]}")
+        self.results.setdefault(("copied", table_name), []).extend(rows)
+        self.results.setdefault(("sources", table_name), []).append(source)
+        return f"COPY {len(rows)}"
+
+
+class FakePool:
+    """Bounded stand-in for an asyncpg pool."""
+    def __init__(self, results, max_size=4, delay=0.0):
+        self.results = results
+        self.max_size = max_size
+        self.delay = delay
+        self.idle = []
+        self.created = []
+        self.in_use = 0
+        self.max_in_use = 0
+        self.released = 0
+
+    async def acquire(self):
+        if self.idle:
+            conn = self.idle.pop()
+        else:
+            conn = FakeConnection(len(self.created) + 1, self.results, self.delay)
+            self.created.append(conn)
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+        return conn
+
+    async def release(self, conn):
+        self.in_use -= 1
+        self.released += 1
+        if not conn.closed:
+            self.idle.append(conn)
+
+    def get_size(self):
+        return len(self.created)
+
+    def get_idle_size(self):
+        return len(self.idle)
+
+    def get_max_size(self):
+        return self.max_size
+
+    async def close(self):
+        self.idle.clear()
+
+
 # Test for PostgreSQL query
 @pytest.fixture
-def mock_postgres_connection():
-    # Mocking psycopg2.connect
-    with patch('psycopg2.connect') as mock_connect:
-        mock_conn = MagicMock()
-        mock_connect.return_value = mock_conn
-        yield mock_conn
-
-# Test for CouchDB query
-@pytest.fixture
-def mock_couchdb_server():
-    # Mocking couchdb.Server
-    with patch('couchdb.Server') as mock_server:
-        mock_db = MagicMock()
-        mock_server.return_value = mock_db
-        yield mock_db
+def mock_pg_pool():
+    # Mocking asyncpg.create_pool
+    pool = FakePool(results={})
+    with patch('asyncpg.create_pool', new=AsyncMock(return_value=pool)):
+        yield pool
 
-def test_query_pg_success(mock_postgres_connection):
+def test_query_pg_success(mock_pg_pool):
     db_tools = DatabaseTools()
 
-    # Setup mock cursor
-    mock_cursor = MagicMock()
-    mock_cursor.description = ['column1', 'column2']
-    mock_cursor.fetchall.return_value = [{'column1': 'value1', 'column2': 'value2'}]
-
-    mock_postgres_connection.cursor.return_value = mock_cursor
-
     sql = "SELECT * FROM users"
-    result = db_tools.query_pg(sql)
+    mock_pg_pool.results[sql] = (["column1", "column2"], [("value1", "value2")], "SELECT 1")
+    result = asyncio.run(db_tools.query_pg(sql))
 
     assert "value1" in result
     assert "value2" in result
-    mock_postgres_connection.cursor.return_value.close.assert_called_once()
+    assert mock_pg_pool.released == 1
 
-def test_query_pg_failure(mock_postgres_connection):
+def test_query_pg_failure(mock_pg_pool):
     db_tools = DatabaseTools()
 
-    # Setup mock cursor to raise an error
-    mock_cursor = MagicMock()
-    mock_cursor.description = None
-    mock_cursor.fetchall.side_effect = psycopg2.Error("Some database error")
-
-    mock_postgres_connection.cursor.return_value = mock_cursor
-
+    # Setup statement to raise an error
     sql = "SELECT * FROM non_existent_table"
-    result = db_tools.query_pg(sql)
+    mock_pg_pool.results[sql] = ([], asyncpg.UndefinedTableError("relation does not exist"), "")
+    result = asyncio.run(db_tools.query_pg(sql))
 
     assert "Query error" in result
-    mock_postgres_connection.cursor.return_value.close.assert_called_once()
+    assert mock_pg_pool.released == 1
 
-def test_query_couch_read(mock_couchdb_server):
+def test_query_pg_write_reports_rowcount(mock_pg_pool):
     db_tools = DatabaseTools()
 
-    # Mock a successful read operation
-    db_name = "test_db"
-    doc_id = "12345"
-    mock_db = mock_couchdb_server[db_name]
-    mock_doc = {"_id": doc_id, "data": "test data"}
-    mock_db.__getitem__.return_value = mock_doc
+    sql = "INSERT INTO users (name) VALUES ('a'), ('b')"
+    mock_pg_pool.results[sql] = ([], [], "INSERT 0 2")
+    result = asyncio.run(db_tools.query_pg(sql))
 
-    result = db_tools.query_couch(db_name=db_name, doc_id=doc_id, operation="read")
+    assert "Rows affected: 2" in result
 
-    assert doc_id in result
-    assert "data" in result
+def test_query_pg_multiple_statements_return_last_result(mock_pg_pool):
+    db_tools = DatabaseTools()
+
+    mock_pg_pool.results["SELECT COUNT(*) FROM users"] = (["count"], [(12,)], "SELECT 1")
+    sql = "INSERT INTO users (name) VALUES ('a;b'); SELECT COUNT(*) FROM users;"
+    result = asyncio.run(db_tools.query_pg(sql))
 
-def test_query_couch_read_document_not_found(mock_couchdb_server):
+    conn = mock_pg_pool.created[0]
+    timeout = f"SET LOCAL statement_timeout = {PG_STATEMENT_TIMEOUT_MS}"
+    assert conn.executed == [timeout, "INSERT INTO users (name) VALUES ('a;b')", "SELECT COUNT(*) FROM users",
+                             timeout, "SELECT COUNT(*) FROM users"]
+    assert result == "count:text\n12"
+
+def test_query_pg_commits_leading_writes_before_opening_a_cursor(mock_pg_pool):
     db_tools = DatabaseTools()
+    mock_pg_pool.results["SELECT id FROM users"] = (["id"], [(i,) for i in range(25)], "SELECT 25")
+    sql = "UPDATE users SET seen = true; SELECT id FROM users"
 
-    # Simulate document not found error
-    db_name = "test_db"
-    doc_id = "non_existing_doc"
-    mock_db = mock_couchdb_server[db_name]
-    mock_db.__getitem__.side_effect = couchdb.ResourceNotFound
+    result = asyncio.run(db_tools.query_pg(sql, page_size=10))
 
-    result = db_tools.query_couch(db_name=db_name, doc_id=doc_id, operation="read")
+    assert "fetch_pg_page" in result
+    conn = mock_pg_pool.created[0]
+    # The update is committed now, not when the cursor closes pages later
+    assert conn.tx_log == ["start", "commit", "start"]
 
-    assert "Error" in result
-    assert "not found" in result
+    mock_pg_pool.results["SELECT id FROM missing"] = (["id"], asyncpg.UndefinedTableError("relation does not exist"), "")
+    failed = asyncio.run(db_tools.query_pg("DELETE FROM users; SELECT id FROM missing", page_size=10))
+    assert failed.startswith("Query error: the earlier statements in the batch were committed; ")
 
-def test_query_couch_create(mock_couchdb_server):
+def test_query_pg_limits_reads_the_planner_expects_to_be_huge(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.guard = CostGuard(max_cost=1000, max_rows=5)
+    sql = "SELECT * FROM a CROSS JOIN b"
+    limited = f"SELECT * FROM (\n{sql}\n) AS guarded LIMIT 5"
+    mock_pg_pool.results[("plan", sql)] = (5000.0, 1_000_000)
+    mock_pg_pool.results[("plan", limited)] = (40.0, 5)
+    mock_pg_pool.results[limited] = (["x"], [(i,) for i in range(5)], "SELECT 5")
+
+    result = asyncio.run(db_tools.query_pg(sql))
+
+    assert result.splitlines()[:6] == ["x:text", "0", "1", "2", "3", "4"]
+    assert "limited to 5 rows: the planner estimated 1,000,000" in result
+    assert mock_pg_pool.created[0].executed[-1] == limited
+    assert db_tools.cache.get(sql, 200) is None
+    assert db_tools.guard_stats()["limited"] == 1
+
+def test_query_pg_rejects_costly_writes_and_reads_before_running_them(mock_pg_pool):
     db_tools = DatabaseTools()
+    db_tools.guard = CostGuard(max_cost=1000, max_rows=100)
+    write = "DELETE FROM events"
+    read = "SELECT count(*) FROM a, b"
+    mock_pg_pool.results[("plan", write)] = (20.0, 500)
+    mock_pg_pool.results[("plan", read)] = (90_000.0, 1)
+
+    async def run():
+        return await db_tools.query_pg(write), await db_tools.query_pg(read)
+
+    write_result, read_result = asyncio.run(run())
+
+    assert write_result.startswith("Query error: rejected before running: the planner estimated cost 20, 500 rows")
+    assert "split the change into batches" in write_result
+    assert read_result.startswith("Query error: rejected before running: the planner estimated cost 90,000")
+    executed = [sql for conn in mock_pg_pool.created for sql in conn.executed]
+    assert write not in executed and read not in executed
+    assert {step for conn in mock_pg_pool.created for step in conn.tx_log} == {"start", "rollback"}
+    assert mock_pg_pool.in_use == 0
+
+def test_query_pg_still_checks_the_cost_of_reads_with_a_small_limit(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.guard = CostGuard(max_cost=1000, max_rows=100)
+    costly, cheap = "SELECT * FROM a CROSS JOIN b ORDER BY a.x LIMIT 10", "SELECT * FROM a LIMIT 10"
+    mock_pg_pool.results[("plan", costly)] = (90_000.0, 10)
+    mock_pg_pool.results[("plan", cheap)] = (20.0, 10)
+    mock_pg_pool.results[cheap] = (["x"], [(1,)], "SELECT 1")
 
-    # Simulate successful document creation
-    db_name = "test_db"
-    data = {"name": "test document"}
-    mock_db = mock_couchdb_server[db_name]
-    mock_db.save.return_value = ("12345", "1-abc")
+    async def run():
+        return await db_tools.query_pg(costly), await db_tools.query_pg(cheap)
 
-    result = db_tools.query_couch(db_name=db_name, operation="create", data=data)
+    costly_result, cheap_result = asyncio.run(run())
+
+    assert costly_result.startswith("Query error: rejected before running: the planner estimated cost 90,000")
+    assert cheap_result.splitlines()[:2] == ["x:text", "1"]
+    assert mock_pg_pool.created[0].executed[-1] == cheap
+    assert db_tools.guard_stats()["limited"] == 0
 
-    assert "Document created" in result
-    assert "12345" in result
 
-def test_query_couch_update(mock_couchdb_server):
+def test_rejected_statement_reports_the_batch_was_not_applied(mock_pg_pool):
     db_tools = DatabaseTools()
+    db_tools.guard = CostGuard(max_cost=1000, max_rows=100)
+    mock_pg_pool.results[("plan", "DELETE FROM events")] = (20.0, 500)
 
-    # Simulate successful document update
-    db_name = "test_db"
-    doc_id = "12345"
-    data = {"name": "updated document"}
-    mock_db = mock_couchdb_server[db_name]
-    mock_db.__getitem__.return_value = {"_id": doc_id, "_rev": "1-abc", "name": "old document"}
-    mock_db.save.return_value = ("12345", "2-xyz")
+    result = asyncio.run(db_tools.query_pg("UPDATE a SET x = 1; DELETE FROM events"))
 
-    result = db_tools.query_couch(db_name=db_name, operation="update", doc_id=doc_id, data=data)
+    assert result.startswith("Query error: the earlier statements in the batch were not applied; rejected before running")
+    assert "commit" not in {step for conn in mock_pg_pool.created for step in conn.tx_log}
 
-    assert "updated" in result
-    assert "Document" in result
 
-def test_query_couch_delete(mock_couchdb_server):
+def test_plan_estimate_counts_the_rows_a_write_touches():
+    plan = {"Node Type": "ModifyTable", "Total Cost": 12.5, "Plan Rows": 0,
+            "Plans": [{"Node Type": "Seq Scan", "Total Cost": 12.5, "Plan Rows": 340}]}
+    assert plan_estimate(plan) == (12.5, 340)
+
+def test_query_pg_explains_a_statement_timeout(mock_pg_pool):
+    db_tools = DatabaseTools()
+    sql = "SELECT pg_sleep(60)"
+    mock_pg_pool.results[sql] = (["x"], asyncpg.QueryCanceledError("canceling statement due to statement timeout"), "")
+
+    result = asyncio.run(db_tools.query_pg(sql))
+
+    assert result.startswith(f"Query error: the statement ran longer than {PG_STATEMENT_TIMEOUT_MS} ms")
+    assert mock_pg_pool.in_use == 0
+
+def test_cancelled_query_pg_cancels_the_backend_query(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.delay = 5
+    mock_pg_pool.results["SELECT * FROM huge"] = (["x"], [(1,)], "SELECT 1")
+    canceller = AsyncMock()
+
+    async def run():
+        task = asyncio.create_task(db_tools.query_pg("SELECT * FROM huge"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with patch("asyncpg.connect", new=AsyncMock(return_value=canceller)):
+        asyncio.run(run())
+
+    conn = mock_pg_pool.created[0]
+    canceller.fetchval.assert_awaited_once_with("SELECT pg_cancel_backend($1)", conn.pid)
+    canceller.close.assert_awaited_once()
+    assert conn.closed and mock_pg_pool.in_use == 0
+
+def test_bulk_load_pg_copies_in_batches_and_isolates_bad_rows(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.results[("bad", "users")] = {"oops"}
+    rows = [[i, str(i)] for i in range(1, 11)]
+    rows[6][1] = "oops"
+    rows += [{"id": 11, "age": "11"}, [12], {"id": 13, "mood": "x"}]
+    asyncio.run(db_tools.query_pg("SELECT * FROM users"))
+    mock_pg_pool.results["SELECT * FROM users"] = (["id"], [(1,)], "SELECT 1")
+
+    with patch("src.tools.database.PG_COPY_BATCH_ROWS", 4):
+        result = asyncio.run(db_tools.bulk_load_pg("users", ["id", "age"], rows=rows))
+
+    lines = result.splitlines()
+    assert lines[0] == "bulk_load_pg: 10 rows loaded into users in 3 batches, 3 rejected"
+    assert lines[1:] == ["row:int4\terror:text", "7\tinvalid input syntax for type integer: oops",
+                         "12\texpected 2 values, got 1", "13\tunknown columns: mood"]
+    copied = mock_pg_pool.results[("copied", "users")]
+    assert [int(row[0]) for row in copied] == [1, 2, 3, 4, 5, 6, 8, 9, 10, 11]
+    # The failing batch of four was split down to the bad row: 4 -> 2 + 2 -> 1 + 1
+    assert sum(sql == "COPY users" for conn in mock_pg_pool.created for sql in conn.executed) == 3 + 4
+    assert db_tools.cache.get("SELECT * FROM users", 200) is None
+    assert mock_pg_pool.in_use == 0
+
+def test_bulk_load_pg_reads_csv_and_keeps_nulls_apart_from_empty_strings(mock_pg_pool):
+    db_tools = DatabaseTools()
+    text = 'id,name,note\n1,"Ann ""A"" Lee",\n2,Bob,""\n'
+
+    result = asyncio.run(db_tools.bulk_load_pg("public.people", ["id", "name", "note"], csv_text=text, header=True))
+
+    assert result == "bulk_load_pg: 2 rows loaded into public.people in 1 batches, 0 rejected"
+    [source] = mock_pg_pool.results[("sources", "people")]
+    # NULL goes out unquoted, the empty string quoted, as COPY's CSV format reads them
+    assert source.decode() == '"1","Ann ""A"" Lee",\n"2","Bob",\n'
+    json_result = asyncio.run(db_tools.bulk_load_pg("people", ["id", "name", "note"], rows=[[3, "Cy", ""], [4, None, {"a": 1}]]))
+    assert json_result.startswith("bulk_load_pg: 2 rows loaded")
+    assert mock_pg_pool.results[("sources", "people")][1].decode() == '"3","Cy",""\n"4",,"{""a"": 1}"\n'
+
+def test_bulk_load_pg_reports_only_uncommitted_rows_after_a_failure_mid_split(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.results[("bad", "users")] = {"oops"}
+    copy, calls = FakeConnection.copy_to_table, []
+
+    async def dropping_copy(self, *args, **kwargs):
+        calls.append(args)
+        if len(calls) == 5:
+            raise ConnectionResetError("connection lost")
+        return await copy(self, *args, **kwargs)
+
+    rows = [[i, "oops" if i == 2 else str(i)] for i in range(1, 9)]
+    with patch("src.tools.database.PG_COPY_BATCH_ROWS", 4), patch.object(FakeConnection, "copy_to_table", dropping_copy):
+        result = asyncio.run(db_tools.bulk_load_pg("users", ["id", "age"], rows=rows))
+
+    # 1-4 fails, 1-2 fails, 1 loads, 2 is rejected, then the connection drops on 3-4
+    lines = result.splitlines()
+    assert lines[0] == "bulk_load_pg: 1 rows loaded into users in 0 batches, 7 rejected"
+    assert lines[2].startswith("2\tinvalid input syntax")
+    assert lines[3:] == [f"{n}\tnot loaded: connection lost" for n in range(3, 9)]
+
+def test_bulk_load_pg_abandons_batches_past_the_reject_limit(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.results[("bad", "Big.Table")] = {"oops"}
+    rows = [[i, "oops" if i in (1, 3) else str(i)] for i in range(1, 5)]
+
+    with patch("src.tools.database.PG_COPY_MAX_REJECTS", 1):
+        result = asyncio.run(db_tools.bulk_load_pg('"Sales"."Big.Table"', ["id", "age"], rows=rows))
+
+    lines = result.splitlines()
+    assert lines[0] == 'bulk_load_pg: 1 rows loaded into "Sales"."Big.Table" in 1 batches, 3 rejected'
+    assert lines[3:] == [f"{n}\tbatch abandoned after 1 rejected rows: invalid input syntax for type integer: oops"
+                         for n in (3, 4)]
+    assert [row[0] for row in mock_pg_pool.results[("copied", "Big.Table")]] == ["2"]
+    assert asyncio.run(db_tools.bulk_load_pg("a.b.c", ["id"], rows=[[1]])).startswith("Error: 'table' must be")
+
+def test_bulk_load_pg_stops_when_every_row_would_fail(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.results[("copy", "missing")] = asyncpg.UndefinedTableError('relation "missing" does not exist')
+
+    result = asyncio.run(db_tools.bulk_load_pg("missing", ["id"], rows=[[1], [2]]))
+
+    assert result.splitlines()[0] == "bulk_load_pg: 0 rows loaded into missing in 0 batches, 2 rejected"
+    assert 'not loaded: relation "missing" does not exist' in result
+    assert asyncio.run(db_tools.bulk_load_pg("t", [], rows=[[1]])).startswith("Error: 'columns' is required")
+    assert asyncio.run(db_tools.bulk_load_pg("t", ["id"])).startswith("Error: give the rows")
+    assert mock_pg_pool.in_use == 0
+
+def test_query_pg_stores_a_row_too_large_for_any_page_instead_of_losing_it(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.encoder = ResultEncoder(fmt="tsv", max_bytes=60)
+    sql = "SELECT body FROM notes"
+    mock_pg_pool.results[sql] = (["body"], [("x" * 200,), ("a",), ("b",)], "SELECT 3")
+
+    async def run():
+        first = await db_tools.query_pg(sql, page_size=10)
+        token = first.split("cursor_token='")[1].split("'")[0]
+        return first, await db_tools.fetch_pg_page(token)
+
+    first, second = asyncio.run(run())
+
+    assert "…[truncated]" in first and "2 more rows not shown" in first
+    assert second.splitlines()[:3] == ["body:text", "a", "b"]
+    handle = first.split("handle='")[1].split("'")[0]
+    assert db_tools.results.rows(handle, 0, 1)[1] == [("x" * 200,)]
+
+def test_query_pg_runs_concurrently_on_separate_connections(mock_pg_pool):
+    db_tools = DatabaseTools()
+    mock_pg_pool.delay = 0.2
+    mock_pg_pool.results["SELECT 1"] = (["x"], [(1,)], "SELECT 1")
+
+    async def run():
+        start = time.monotonic()
+        results = await asyncio.gather(*[db_tools.query_pg("SELECT 1") for _ in range(4)])
+        return results, time.monotonic() - start
+
+    results, elapsed = asyncio.run(run())
+
+    assert results == ["x:text\n1"] * 4
+    assert mock_pg_pool.max_in_use == 4
+    assert elapsed < 0.6
+
+def test_query_pg_pages_large_results_through_a_cursor(mock_pg_pool):
+    db_tools = DatabaseTools()
+    sql = "SELECT id FROM big_table"
+    mock_pg_pool.results[sql] = (["id"], [(i,) for i in range(25)], "SELECT 25")
+
+    async def run():
+        first = await db_tools.query_pg(sql, page_size=10)
+        token = first.split("cursor_token='")[1].split("'")[0]
+        second = await db_tools.fetch_pg_page(token, page_size=10)
+        third = await db_tools.fetch_pg_page(token, page_size=10)
+        again = await db_tools.fetch_pg_page(token)
+        return first, second, third, again
+
+    first, second, third, again = asyncio.run(run())
+
+    assert first.splitlines()[:11] == ["id:text"] + [str(i) for i in range(10)]
+    assert "fetch_pg_page" in first
+    assert second.splitlines()[1] == "10"
+    assert third.splitlines()[1:6] == [str(i) for i in range(20, 25)]
+    assert "end of results: 25 rows in 3 pages" in third
+    assert "expired" in again
+    conn = mock_pg_pool.created[0]
+    # Never more than one page (plus one row of look-ahead) is read at a time
+    assert max(conn.fetch_sizes) == 11
+    assert conn.tx_log == ["start", "commit"]
+    assert mock_pg_pool.in_use == 0
+
+def test_small_result_releases_connection_immediately(mock_pg_pool):
+    db_tools = DatabaseTools()
+    sql = "SELECT id FROM small_table"
+    mock_pg_pool.results[sql] = (["id"], [(1,), (2,)], "SELECT 2")
+
+    result = asyncio.run(db_tools.query_pg(sql, page_size=10))
+
+    assert result == "id:text\n1\n2"
+    assert mock_pg_pool.in_use == 0
+    assert db_tools._cursors == {}
+
+def test_rows_over_the_output_budget_carry_over_to_the_next_page(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.encoder = ResultEncoder(max_bytes=40)
+    sql = "SELECT name FROM wide_table"
+    mock_pg_pool.results[sql] = (["name"], [("x" * 10,) for _ in range(6)], "SELECT 6")
+
+    async def run():
+        first = await db_tools.query_pg(sql, page_size=10)
+        token = first.split("cursor_token='")[1].split("'")[0]
+        return first, await db_tools.fetch_pg_page(token, page_size=10)
+
+    first, second = asyncio.run(run())
+
+    assert first.count("x" * 10) == 2
+    assert "-- 4 more rows not shown" in first
+    assert second.count("x" * 10) == 2
+
+def test_open_cursors_are_capped(mock_pg_pool):
+    db_tools = DatabaseTools()
+    for i in range(PG_MAX_OPEN_CURSORS + 1):
+        mock_pg_pool.results[f"SELECT {i}"] = (["id"], [(n,) for n in range(5)], "SELECT 5")
+
+    async def run():
+        return [await db_tools.query_pg(f"SELECT {i}", page_size=1) for i in range(PG_MAX_OPEN_CURSORS + 1)]
+
+    pages = asyncio.run(run())
+
+    assert len(db_tools._cursors) == PG_MAX_OPEN_CURSORS
+    assert mock_pg_pool.in_use == PG_MAX_OPEN_CURSORS
+    oldest = pages[0].split("cursor_token='")[1].split("'")[0]
+    assert oldest not in db_tools._cursors
+
+def test_repeated_reads_are_served_from_cache_until_a_write(mock_pg_pool):
+    db_tools = DatabaseTools()
+    count_sql = "SELECT COUNT(*) FROM orders"
+    write_sql = "INSERT INTO orders (id) VALUES (1)"
+    mock_pg_pool.results[count_sql] = (["count"], [(12,)], "SELECT 1")
+    mock_pg_pool.results[write_sql] = ([], [], "INSERT 0 1")
+
+    async def run():
+        first = await db_tools.query_pg(count_sql)
+        second = await db_tools.query_pg("select count(*) from orders;")
+        await db_tools.query_pg(write_sql)
+        third = await db_tools.query_pg(count_sql)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+
+    assert first == second == third
+    executed = [sql for conn in mock_pg_pool.created for sql in conn.executed]
+    assert executed.count(count_sql) == 2
+    assert db_tools.cache_stats()["hits"] == 1
+
+def test_write_returning_rows_invalidates_the_cache_when_it_commits(mock_pg_pool):
     db_tools = DatabaseTools()
+    count_sql = "SELECT COUNT(*) FROM orders"
+    write_sql = "INSERT INTO orders (id) VALUES (1) RETURNING id"
+    mock_pg_pool.results[count_sql] = (["count"], [(12,)], "SELECT 1")
+    mock_pg_pool.results[write_sql] = (["id"], [(1,)], "INSERT 0 1")
+
+    async def run():
+        await db_tools.query_pg(count_sql)
+        returned = await db_tools.query_pg(write_sql)
+        await db_tools.query_pg(count_sql)
+        return returned
+
+    returned = asyncio.run(run())
+
+    assert returned.splitlines()[:2] == ["id:text", "1"]
+    executed = [sql for conn in mock_pg_pool.created for sql in conn.executed]
+    assert executed.count(count_sql) == 2
+    assert db_tools.cache_stats()["invalidations"] == 1
+
+def test_unhealthy_connection_is_replaced(mock_pg_pool):
+    engine = PostgresEngine("postgresql://test", health_check_interval=0)
+
+    async def run():
+        async with engine.acquire() as first:
+            pass
+        first.healthy = False
+        async with engine.acquire() as second:
+            return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first.closed
+    assert second is not first
+
+def test_split_statements_respects_quotes_and_comments():
+    sql = "CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql; -- done;\nSELECT 'x;y'"
+    assert split_statements(sql) == [
+        "CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ LANGUAGE sql",
+        "SELECT 'x;y'",
+    ]
+
+# Tests for CouchDB query, against an in-memory CouchDB HTTP server
+def run_couch(scenario, docs=({"_id": "12345", "data": "test data"},)):
+    async def run():
+        async with fake_couch() as (fake, url):
+            fake.create_db("test_db", docs)
+            db_tools = DatabaseTools(couch_server=url)
+            try:
+                return await scenario(db_tools, fake)
+            finally:
+                await db_tools.close()
+    return asyncio.run(run())
+
+def test_query_couch_read():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", doc_id="12345", operation="read")
+
+    result = run_couch(scenario)
+
+    assert "12345" in result
+    assert "data" in result
+
+def test_query_couch_read_document_not_found():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", doc_id="non_existing_doc", operation="read")
+
+    result = run_couch(scenario)
+
+    assert "Error" in result
+    assert "not found" in result
+
+def test_query_couch_missing_database():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="nope", doc_id="12345", operation="read")
+
+    result = run_couch(scenario)
+
+    assert "Database 'nope' does not exist" in result
+
+def test_query_couch_create():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="create", data={"name": "test document"}), fake
+
+    result, fake = run_couch(scenario)
+
+    assert "Document created" in result
+    assert len(fake.dbs["test_db"]) == 2
 
-    # Simulate successful document deletion
-    db_name = "test_db"
-    doc_id = "12345"
-    mock_db = mock_couchdb_server[db_name]
-    mock_db.__getitem__.return_value = {"_id": doc_id, "_rev": "1-abc", "name": "old document"}
-    mock_db.delete.return_value = None
+def test_query_couch_update():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="update", doc_id="12345", data={"name": "updated document"}), fake
 
-    result = db_tools.query_couch(db_name=db_name, operation="delete", doc_id=doc_id)
+    result, fake = run_couch(scenario)
+
+    assert "updated" in result
+    assert "Document" in result
+    assert fake.dbs["test_db"]["12345"]["name"] == "updated document"
+    assert fake.dbs["test_db"]["12345"]["data"] == "test data"
+
+def test_query_couch_delete():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="delete", doc_id="12345"), fake
+
+    result, fake = run_couch(scenario)
 
     assert "deleted" in result
     assert "Document" in result
+    assert "12345" not in fake.dbs["test_db"]
+
+def test_query_couch_find():
+    docs = [{"_id": str(i), "type": "order" if i % 2 else "user"} for i in range(6)]
+
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "order"}})
+
+    result = run_couch(scenario, docs)
+
+    doc_lines = [line for line in result.splitlines() if not line.startswith("--")]
+    assert len(doc_lines) == 3
+    assert all('"type":"order"' in line for line in doc_lines)
+
+def test_warm_document_read_is_one_round_trip():
+    async def scenario(db_tools, fake):
+        await db_tools.query_couch(db_name="test_db", doc_id="12345")
+        fake.requests.clear()
+        await db_tools.query_couch(db_name="test_db", doc_id="12345")
+        return list(fake.requests)
+
+    requests = run_couch(scenario)
+
+    assert requests == [("GET", "/test_db/12345")]
+
+def test_concurrent_callers_share_one_existence_check():
+    async def scenario(db_tools, fake):
+        await asyncio.gather(*[db_tools.query_couch(db_name="test_db", doc_id="12345") for _ in range(10)])
+        return list(fake.requests)
+
+    requests = run_couch(scenario)
+
+    assert requests.count(("HEAD", "/test_db")) == 1
+    assert requests.count(("GET", "/test_db/12345")) == 10
+
+def test_bulk_create_uses_one_request_and_reports_each_document():
+    docs = [{"_id": f"rec-{i}", "n": i} for i in range(200)] + [{"_id": "12345", "data": "duplicate"}]
+
+    async def scenario(db_tools, fake):
+        fake.requests.clear()
+        result = await db_tools.query_couch(db_name="test_db", operation="bulk_create", docs=docs)
+        return result, fake
+
+    result, fake = run_couch(scenario)
+
+    lines = result.splitlines()
+    assert lines[0] == "bulk_create: 200 succeeded, 1 failed"
+    # Failures are listed first
+    assert lines[2].startswith("12345\terror\tconflict")
+    assert len(fake.dbs["test_db"]) == 201
+    assert fake.requests == [("HEAD", "/test_db"), ("POST", "/test_db/_bulk_docs")]
+
+def test_bulk_read_fetches_many_ids_at_once():
+    docs = [{"_id": str(i), "n": i} for i in range(5)]
+
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="bulk_read", doc_ids=["1", "3", "missing"]), fake
+
+    result, fake = run_couch(scenario, docs)
+
+    assert '"n":1' in result and '"n":3' in result
+    assert "-- not found: missing" in result
+    assert fake.requests.count(("POST", "/test_db/_all_docs")) == 1
+
+def test_bulk_update_merges_into_current_revisions():
+    docs = [{"_id": str(i), "n": i, "keep": True} for i in range(3)]
+
+    async def scenario(db_tools, fake):
+        result = await db_tools.query_couch(
+            db_name="test_db", operation="bulk_update",
+            docs=[{"_id": "0", "n": 10}, {"_id": "2", "n": 12}, {"_id": "9", "n": 19}],
+        )
+        return result, fake
+
+    result, fake = run_couch(scenario, docs)
+
+    assert result.splitlines()[0] == "bulk_update: 2 succeeded, 1 failed"
+    assert "9\terror\tnot_found" in result
+    assert fake.dbs["test_db"]["0"]["n"] == 10
+    assert fake.dbs["test_db"]["0"]["keep"] is True
+    assert fake.dbs["test_db"]["2"]["n"] == 12
+
+def test_bulk_delete_reports_missing_ids():
+    docs = [{"_id": str(i)} for i in range(3)]
+
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="bulk_delete", doc_ids=["0", "1", "7"]), fake
+
+    result, fake = run_couch(scenario, docs)
+
+    assert result.splitlines()[0] == "bulk_delete: 2 succeeded, 1 failed"
+    assert list(fake.dbs["test_db"]) == ["2"]
+
+def test_bulk_operations_require_their_inputs():
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", operation="bulk_create")
+
+    assert "'docs' is required" in run_couch(scenario)
+
+def test_mango_read_is_limited_projected_and_continues_from_bookmark():
+    docs = [{"_id": f"{i:02}", "type": "order", "total": i, "notes": "x" * 50} for i in range(5)]
+
+    async def scenario(db_tools, fake):
+        first = await db_tools.query_couch(db_name="test_db", query={}, limit=2, fields=["_id", "total"])
+        bookmark = first.split("bookmark='")[1].split("'")[0]
+        second = await db_tools.query_couch(db_name="test_db", query={}, limit=2, fields=["_id", "total"], bookmark=bookmark)
+        return first, second
+
+    first, second = run_couch(scenario, docs)
+
+    assert first.splitlines()[:2] == ['{"_id":"00","total":0}', '{"_id":"01","total":1}']
+    assert "notes" not in first
+    assert second.splitlines()[0] == '{"_id":"02","total":2}'
+
+def test_unindexed_selector_warns_on_small_databases():
+    docs = [{"_id": str(i), "type": "order"} for i in range(3)]
+
+    async def scenario(db_tools, fake):
+        return await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "order"}})
+
+    result = run_couch(scenario, docs)
+
+    assert "warning: no index covers this selector" in result
+    assert "operation='create_index'" in result
+    assert '"type"' in result
+
+def test_unindexed_selector_is_refused_on_large_databases(monkeypatch):
+    monkeypatch.setattr("src.tools.database.COUCH_UNINDEXED_MAX_DOCS", 2)
+    docs = [{"_id": str(i), "type": "order"} for i in range(3)]
+
+    async def scenario(db_tools, fake):
+        refused = await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "order"}})
+        created = await db_tools.query_couch(db_name="test_db", operation="create_index", data={"fields": ["type"]})
+        allowed = await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "order"}})
+        return refused, created, allowed, fake
+
+    refused, created, allowed, fake = run_couch(scenario, docs)
+
+    assert refused.startswith("Error: No index covers this selector")
+    assert not any(path == "/test_db/_find" for _, path in fake.requests[:fake.requests.index(("POST", "/test_db/_index"))])
+    assert "created" in created
+    assert "warning" not in allowed
+    assert len(allowed.splitlines()) == 3
+
+def test_query_plans_are_cached_per_selector_shape():
+    docs = [{"_id": str(i), "type": "order"} for i in range(3)]
+
+    async def scenario(db_tools, fake):
+        await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "order"}})
+        await db_tools.query_couch(db_name="test_db", query={"selector": {"type": "user"}})
+        return fake.requests
+
+    requests = run_couch(scenario, docs)
+
+    assert requests.count(("POST", "/test_db/_explain")) == 1
+    assert requests.count(("POST", "/test_db/_find")) == 2
+
+ORDERS = [
+    {"_id": f"o{i}", "type": "order", "country": country, "total": total}
+    for i, (country, total) in enumerate([("KE", 10), ("KE", 5), ("UG", 7), ("TZ", 1)])
+]
+
+def test_define_view_then_aggregate_inside_couch():
+    async def scenario(db_tools, fake):
+        defined = await db_tools.query_couch(db_name="test_db", operation="define_view", data={
+            "design": "stats", "view": "total_by_country",
+            "map": "function(doc) { if (doc.type == 'order') emit(doc.country, doc.total); }",
+            "reduce": "_sum",
+        })
+        grouped = await db_tools.query_couch(db_name="test_db", operation="view", view="stats/total_by_country",
+                                             query={"group_level": 1})
+        overall = await db_tools.query_couch(db_name="test_db", operation="view", view="stats/total_by_country")
+        return defined, grouped, overall
+
+    defined, grouped, overall = run_couch(scenario, ORDERS)
+
+    assert "saved" in defined
+    assert grouped.splitlines() == ["key:json\tvalue:json", "KE\t15", "TZ\t1", "UG\t7"]
+    assert overall.splitlines()[1] == "\\N\t23"
+
+def test_view_key_ranges_and_map_rows():
+    async def scenario(db_tools, fake):
+        await db_tools.query_couch(db_name="test_db", operation="define_view", data={
+            "design": "stats", "view": "by_country", "map": "function(doc) { emit(doc.country, 1); }", "reduce": "_count",
+        })
+        return await db_tools.query_couch(db_name="test_db", operation="view", view="stats/by_country",
+                                          query={"reduce": False, "startkey": "TZ", "endkey": "UG"})
+
+    result = run_couch(scenario, ORDERS)
+
+    assert result.splitlines() == ["id:text\tkey:json\tvalue:json", "o3\tTZ\t1", "o2\tUG\t1"]
+
+def test_list_views_and_errors():
+    async def scenario(db_tools, fake):
+        await db_tools.query_couch(db_name="test_db", operation="define_view", data={
+            "design": "stats", "view": "by_country", "map": "function(doc) { emit(doc.country, 1); }", "reduce": "_count",
+        })
+        listed = await db_tools.query_couch(db_name="test_db", operation="list_views")
+        missing = await db_tools.query_couch(db_name="test_db", operation="view", view="stats/nope")
+        bad_param = await db_tools.query_couch(db_name="test_db", operation="view", view="stats/by_country", query={"selector": {}})
+        bad_reduce = await db_tools.query_couch(db_name="test_db", operation="define_view", data={
+            "design": "stats", "view": "x", "map": "function(doc) {}", "reduce": "_median",
+        })
+        return listed, missing, bad_param, bad_reduce
+
+    listed, missing, bad_param, bad_reduce = run_couch(scenario, ORDERS)
+
+    assert listed.startswith("stats/by_country\treduce=_count")
+    assert "View 'stats/nope' not found" in missing
+    assert "Unsupported view parameters: selector" in bad_param
+    assert "Unknown built-in reduce '_median'" in bad_reduce
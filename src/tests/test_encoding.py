@@ -0,0 +1,56 @@
+import datetime
+import json
+
+import pytest
+from src.tools.encoding import ResultEncoder
+
+COLUMNS = [("id", "int4"), ("name", "text"), ("created", "date")]
+
+def test_tsv_header_and_rows():
+    encoder = ResultEncoder(fmt="tsv")
+    rows = [(1, "Ann", datetime.date(2024, 1, 2)), (2, None, None)]
+
+    result = encoder.encode_rows(COLUMNS, rows)
+
+    assert result.text == "id:int4\tname:text\tcreated:date\n1\tAnn\t2024-01-02\n2\t\\N\t\\N"
+    assert result.rows_encoded == 2
+    assert result.rows_omitted == 0
+
+def test_tsv_escapes_separators():
+    encoder = ResultEncoder(fmt="tsv")
+
+    result = encoder.encode_rows([("note", "text")], [("a\tb\nc",)])
+
+    assert result.text.splitlines()[1] == "a\\tb\\nc"
+
+def test_jsonl_rows_are_dense_arrays():
+    encoder = ResultEncoder(fmt="jsonl")
+
+    result = encoder.encode_rows(COLUMNS, [(1, "Ann", datetime.date(2024, 1, 2))])
+
+    header, row = result.text.splitlines()
+    assert json.loads(header) == {"columns": ["id", "name", "created"], "types": ["int4", "text", "date"]}
+    assert row == '[1,"Ann","2024-01-02"]'
+
+def test_budget_stops_encoding_and_counts_omitted_rows():
+    encoder = ResultEncoder(fmt="tsv", max_bytes=60)
+    rows = [(i, "name", None) for i in range(100)]
+
+    result = encoder.encode_rows(COLUMNS, rows)
+
+    assert len(result.text.encode()) <= 60
+    assert result.rows_encoded + result.rows_omitted == 100
+    assert result.rows_omitted > 90
+
+def test_first_row_is_clipped_rather_than_dropped():
+    encoder = ResultEncoder(fmt="tsv", max_bytes=20)
+
+    result = encoder.encode_docs([{"body": "x" * 100}, {"body": "y"}])
+
+    # The clipped row is not counted as sent, so callers do not drop the rest of it
+    assert (result.rows_encoded, result.rows_omitted, result.clipped) == (0, 2, True)
+    assert result.text.endswith("…[truncated]")
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        ResultEncoder(fmt="csv")
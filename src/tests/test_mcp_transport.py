@@ -0,0 +1,55 @@
+import asyncio
+import socket
+
+import uvicorn
+from mcp import ClientSession
+from mcp.server.fastmcp import FastMCP
+
+from src.agent.mcp_transport import connect_mcp, transport_name
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_transport_is_chosen_from_the_url():
+    assert transport_name("") == "stdio"
+    assert transport_name("http://node-1:8000/sse") == "sse"
+    assert transport_name("http://node-1:8000/mcp") == "streamable-http"
+
+
+def test_many_sessions_share_one_http_server():
+    server = FastMCP("shared")
+    state = {"calls": 0}
+
+    @server.tool()
+    async def hit() -> str:
+        """Counts calls across every session"""
+        state["calls"] += 1
+        call = state["calls"]
+        await asyncio.sleep(0.01)
+        return str(call)
+
+    async def client(url):
+        async with connect_mcp(url) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                return [int((await session.call_tool("hit", {})).content[0].text) for _ in range(3)]
+
+    async def run():
+        port = free_port()
+        config = uvicorn.Config(server.streamable_http_app(), host="127.0.0.1", port=port, log_level="error")
+        http = uvicorn.Server(config)
+        serving = asyncio.create_task(http.serve())
+        while not http.started:
+            await asyncio.sleep(0.01)
+        try:
+            return await asyncio.gather(*[client(f"http://127.0.0.1:{port}/mcp") for _ in range(4)])
+        finally:
+            http.should_exit = True
+            await serving
+
+    results = asyncio.run(run())
+    assert sorted(n for calls in results for n in calls) == list(range(1, 13))
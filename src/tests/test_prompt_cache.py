@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from anthropic.types import TextBlock, ToolUseBlock
+
+from src.agent.prompt_cache import CACHE_CONTROL, CacheUsage, cached_request
+
+TOOLS = [
+    {"name": "query_pg", "description": "", "input_schema": {"type": "object"}},
+    {"name": "query_couch", "description": "", "input_schema": {"type": "object"}},
+]
+
+
+def test_breakpoints_on_system_last_tool_and_last_message():
+    messages = [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": [TextBlock(type="text", text="checking"),
+                                          ToolUseBlock(type="tool_use", id="t1", name="query_pg", input={})]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "1"}]},
+    ]
+    request = cached_request("system", TOOLS, messages)
+    assert request["system"] == [{"type": "text", "text": "system", "cache_control": CACHE_CONTROL}]
+    assert "cache_control" not in request["tools"][0]
+    assert request["tools"][1]["cache_control"] == CACHE_CONTROL
+    assert request["messages"][-1]["content"][-1]["cache_control"] == CACHE_CONTROL
+    assert request["messages"][1] is messages[1]
+    # Stored history and tool list stay unmarked, so breakpoints roll forward instead of piling up
+    assert "cache_control" not in messages[-1]["content"][-1]
+    assert "cache_control" not in TOOLS[1]
+
+
+def test_string_content_becomes_a_marked_text_block():
+    request = cached_request("system", [], [{"role": "user", "content": "hi"}])
+    assert request["messages"] == [{"role": "user", "content": [{"type": "text", "text": "hi", "cache_control": CACHE_CONTROL}]}]
+    assert request["tools"] == []
+
+
+def test_cache_usage_accumulates_per_session():
+    usage = CacheUsage()
+    usage.record(SimpleNamespace(input_tokens=50, output_tokens=10, cache_read_input_tokens=0, cache_creation_input_tokens=900))
+    usage.record(SimpleNamespace(input_tokens=30, output_tokens=20, cache_read_input_tokens=900, cache_creation_input_tokens=None))
+    assert (usage.requests, usage.cache_read_tokens, usage.cache_write_tokens) == (2, 900, 900)
+    assert round(usage.hit_rate, 3) == round(900 / 1880, 3)
+    assert "900 cache read / 900 cache write" in usage.summary()
@@ -0,0 +1,95 @@
+import time
+
+from src.tools.query_cache import QueryCache, is_cacheable, normalize_sql, referenced_tables, statement_kind
+
+def test_normalize_sql_keeps_literals():
+    assert normalize_sql("SELECT  *\n FROM Users WHERE name = 'Ann  Lee';") == "select * from users where name = 'Ann  Lee'"
+
+def test_statement_kind():
+    assert statement_kind("SELECT COUNT(*) FROM orders") == "read"
+    assert statement_kind("WITH x AS (DELETE FROM orders RETURNING *) SELECT * FROM x") == "write"
+    assert statement_kind("insert into orders values (1)") == "write"
+    assert statement_kind("ALTER TABLE orders ADD COLUMN note text") == "ddl"
+    assert statement_kind("VACUUM orders") == "other"
+    # EXPLAIN ANALYZE runs the statement it explains
+    assert statement_kind("EXPLAIN ANALYZE DELETE FROM orders") == "write"
+    assert statement_kind("explain (analyze, buffers) update orders set x = 1") == "write"
+    assert statement_kind("EXPLAIN DELETE FROM orders") == "read"
+
+def test_is_cacheable_skips_volatile_and_locking_reads():
+    assert is_cacheable("SELECT * FROM orders")
+    assert not is_cacheable("SELECT now(), * FROM orders")
+    assert not is_cacheable("SELECT * FROM orders FOR UPDATE")
+    assert not is_cacheable("UPDATE orders SET total = 0")
+
+def test_referenced_tables():
+    assert referenced_tables("SELECT * FROM public.orders o JOIN customers c ON c.id = o.customer_id") == {"orders", "customers"}
+    assert referenced_tables("select * from a, b as bb where a.id = bb.id") == {"a", "b"}
+    assert referenced_tables("UPDATE \"Orders\" SET total = 1") == {"Orders"}
+    assert referenced_tables("DROP TABLE IF EXISTS products") == {"products"}
+    assert referenced_tables("SELECT 'from nowhere'") == set()
+
+def test_hits_misses_and_normalized_keys():
+    cache = QueryCache()
+    assert cache.get("SELECT COUNT(*) FROM orders") is None
+    cache.put("SELECT COUNT(*) FROM orders", "12")
+
+    assert cache.get("select count(*)\n  from orders;") == "12"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_writes_invalidate_only_affected_tables():
+    cache = QueryCache(base_tables=lambda: {"orders", "customers"})
+    cache.put("SELECT * FROM orders", "orders")
+    cache.put("SELECT * FROM customers", "customers")
+
+    cache.observe("INSERT INTO orders VALUES (1)")
+
+    assert cache.get("SELECT * FROM orders") is None
+    assert cache.get("SELECT * FROM customers") == "customers"
+
+def test_reads_of_views_and_functions_are_dropped_by_any_write():
+    cache = QueryCache(base_tables=lambda: {"orders", "customers"})
+    cache.put("SELECT * FROM order_totals", "view")
+    cache.put("SELECT * FROM top_customers(5)", "function")
+    cache.put("SELECT * FROM customers", "customers")
+
+    cache.observe("INSERT INTO orders VALUES (1)")
+
+    assert cache.get("SELECT * FROM order_totals") is None
+    assert cache.get("SELECT * FROM top_customers(5)") is None
+    assert cache.get("SELECT * FROM customers") == "customers"
+
+    # Before the table names are known nothing can be tied to a table
+    unknown = QueryCache()
+    unknown.put("SELECT * FROM customers", "customers")
+    unknown.observe("INSERT INTO orders VALUES (1)")
+    assert unknown.get("SELECT * FROM customers") is None
+
+def test_unparseable_ddl_clears_everything():
+    cache = QueryCache()
+    cache.put("SELECT * FROM orders", "orders")
+
+    cache.observe("CREATE INDEX idx_total ON orders (total)")
+
+    assert cache.get("SELECT * FROM orders") is None
+
+def test_entries_expire_and_lru_is_bounded():
+    cache = QueryCache(max_entries=2, ttl=0.05)
+    cache.put("SELECT 1", "1")
+    cache.put("SELECT 2", "2")
+    cache.put("SELECT 3", "3")
+
+    assert cache.get("SELECT 1") is None
+    assert cache.get("SELECT 3") == "3"
+    time.sleep(0.06)
+    assert cache.get("SELECT 3") is None
+
+def test_results_read_before_a_write_are_not_stored():
+    cache = QueryCache()
+    generation = cache.generation
+    cache.observe("DELETE FROM orders")
+
+    cache.put("SELECT * FROM orders", "stale", generation=generation)
+
+    assert cache.get("SELECT * FROM orders") is None
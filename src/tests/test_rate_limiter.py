@@ -0,0 +1,97 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import anthropic
+
+from src.agent.rate_limiter import RateLimiter
+from src.agent.streaming import stream_message
+from src.tests.fake_anthropic import fake_anthropic
+
+REQUEST = {"model": "m", "max_tokens": 100, "messages": [{"role": "user", "content": "how many users?"}]}
+
+
+async def create_with_retry(limiter, client, attempts=10):
+    """What callers do through tenacity: retry 429s straight away and let the limiter hold them back."""
+    for attempt in range(attempts):
+        try:
+            return await limiter.create(client, **REQUEST)
+        except anthropic.RateLimitError:
+            if attempt == attempts - 1:
+                raise
+
+
+def test_burst_is_paced_under_the_request_limit():
+    async def run():
+        # 20 requests per second; 30 callers at once
+        async with fake_anthropic(requests_per_minute=20, window=1.0) as (fake, client):
+            limiter = RateLimiter(requests_per_minute=20, window=1.0)
+            started = time.monotonic()
+            messages = await asyncio.gather(*[limiter.create(client, **REQUEST) for _ in range(30)])
+            return fake, limiter, messages, time.monotonic() - started
+
+    fake, limiter, messages, elapsed = asyncio.run(run())
+    assert fake.rejected == 0
+    assert all(m.content[0].text == "echo: how many users?" for m in messages)
+    assert elapsed >= 0.5  # 18 go at once (90% headroom), the other 12 as the budget refills at 18/s
+    assert limiter.waits >= 12
+
+
+def test_limits_are_learned_from_headers_and_429s_pause_everyone():
+    async def run():
+        async with fake_anthropic(requests_per_minute=5, window=0.5) as (fake, client):
+            # Starts out believing the account allows far more than it does
+            limiter = RateLimiter(requests_per_minute=1000, window=0.5)
+            await asyncio.gather(*[create_with_retry(limiter, client) for _ in range(12)])
+            first_wave = fake.rejected
+            await asyncio.gather(*[create_with_retry(limiter, client) for _ in range(12)])
+            return fake, limiter, first_wave
+
+    fake, limiter, first_wave = asyncio.run(run())
+    assert first_wave > 0 and limiter.rate_limited == first_wave
+    assert limiter.buckets["requests"].capacity == 5 * limiter.headroom
+    assert fake.rejected == first_wave  # once the real limit is known no request is refused
+
+
+def test_callers_are_served_in_arrival_order():
+    async def run():
+        limiter = RateLimiter(requests_per_minute=2, window=0.1)
+        served = []
+
+        async def call(n, tokens):
+            await asyncio.sleep(n * 0.001)
+            await limiter.acquire(tokens)
+            served.append(n)
+
+        # Caller 2 needs a big input budget; the small ones behind it must not overtake it
+        await asyncio.gather(*[call(n, 25000 if n == 2 else 10) for n in range(6)])
+        return served
+
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4, 5]
+
+
+def test_unused_output_reservation_is_refunded():
+    async def run():
+        limiter = RateLimiter(output_tokens_per_minute=8000, output_reserve=1024)
+        reservation = await limiter.acquire(100, max_tokens=4000)
+        after_acquire = limiter.buckets["output_tokens"].level
+        limiter.settle(reservation, SimpleNamespace(input_tokens=90, output_tokens=24, cache_creation_input_tokens=0))
+        return reservation, after_acquire, limiter.buckets["output_tokens"].level
+
+    reservation, after_acquire, after_settle = asyncio.run(run())
+    assert reservation["output_tokens"] == 1024
+    assert after_acquire < 8000 - 1000
+    assert after_settle - after_acquire >= 1000
+
+
+def test_streamed_requests_report_headers_to_the_limiter():
+    async def run():
+        async with fake_anthropic(requests_per_minute=300, input_tokens_per_minute=40000) as (fake, client):
+            limiter = RateLimiter()
+            message, tasks = await stream_message(client, lambda text: None, None, limiter=limiter, **REQUEST)
+            return message, limiter
+
+    message, limiter = asyncio.run(run())
+    assert message.content[0].text == "echo: how many users?"
+    assert limiter.buckets["requests"].capacity == 300 * limiter.headroom
+    assert limiter.buckets["input_tokens"].capacity == 40000 * limiter.headroom
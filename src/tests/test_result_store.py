@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from src.tests.fake_couch import fake_couch
+from src.tests.test_database_tools import mock_pg_pool  # noqa: F401
+from src.tools.database import DatabaseTools
+from src.tools.encoding import ResultEncoder
+from src.tools.result_store import ResultStore, doc_columns
+
+COLUMNS = [("id", "int4"), ("region", "text"), ("amount", "numeric")]
+ROWS = [(i, ["north", "south", "east"][i % 3], i * 1.5) for i in range(300)]
+
+
+@pytest.fixture
+def store():
+    store = ResultStore(":memory:")
+    yield store
+    store.close()
+
+
+def test_slice_filter_and_aggregate_a_stored_result(store):
+    handle = store.save("query_pg: SELECT ...", COLUMNS, ROWS)
+
+    columns, rows, total = store.rows(handle, offset=10, limit=2)
+    assert columns == COLUMNS and rows == [(10, "south", 15), (11, "east", 16.5)] and total == 300
+
+    _, rows, total = store.rows(handle, where=[["region", "=", "east"], ["amount", ">=", 300]],
+                                columns=["id"], order_by="id", descending=True, limit=3)
+    assert rows == [(299,), (296,), (293,)] and total == 34
+
+    columns, rows, groups = store.aggregate(handle, ["count", "max:amount"], group_by=["region"])
+    assert [c for c, _ in columns] == ["region", "count", "max:amount"]
+    assert rows == [("east", 100, 448.5), ("north", 100, 445.5), ("south", 100, 447)] and groups == 3
+
+
+def test_bad_requests_raise_value_errors(store):
+    handle = store.save("x", COLUMNS, ROWS[:3])
+    for call in (lambda: store.rows("r_missing"),
+                 lambda: store.rows(handle, columns=["nope"]),
+                 lambda: store.rows(handle, where=[["id", "; drop", 1]]),
+                 lambda: store.aggregate(handle, ["median:amount"])):
+        with pytest.raises(ValueError):
+            call()
+
+
+def test_oldest_results_are_evicted(store):
+    store.max_results = 2
+    handles = [store.save("x", COLUMNS, ROWS[:1]) for _ in range(3)]
+    with pytest.raises(ValueError):
+        store.info(handles[0])
+    assert store.info(handles[2])[2] == 1
+
+
+def test_each_store_keeps_its_own_file_and_removes_it(tmp_path):
+    first, second = ResultStore(str(tmp_path / "results.sqlite3"), 1), ResultStore(str(tmp_path / "results.sqlite3"), 1)
+    handles = [first.save("x", COLUMNS, ROWS[:1]), second.save("y", COLUMNS, ROWS[:2])]
+
+    # One session's results never evict another's
+    assert first.info(handles[0])[2] == 1 and second.info(handles[1])[2] == 2
+    assert len(list(tmp_path.iterdir())) == 2
+    first.close()
+    second.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_doc_columns_types_numeric_fields():
+    assert doc_columns([{"_id": "a", "n": 1}, {"_id": "b", "n": None, "tags": ["x"]}]) == [
+        ("_id", "json"), ("n", "numeric"), ("tags", "json")
+    ]
+
+
+def test_large_query_pg_result_returns_preview_and_handle(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.results = ResultStore(":memory:")
+    sql = "SELECT id, region, amount FROM sales"
+    mock_pg_pool.results[sql] = (["id", "region", "amount"], ROWS, "SELECT 300")
+
+    async def run():
+        preview = await db_tools.query_pg(sql)
+        handle = preview.split("handle='")[1].split("'")[0]
+        total = await db_tools.result_aggregate(handle, ["count"], group_by=["region"])
+        window = await db_tools.result_slice(handle, offset=298)
+        filtered = await db_tools.result_filter(handle, [["id", "in", ["5", "7"]]], columns=["id"])
+        return preview, total, window, filtered
+
+    preview, total, window, filtered = asyncio.run(run())
+    assert len(preview.splitlines()) == 1 + 20 + 1
+    assert "300 rows stored as handle=" in preview
+    assert mock_pg_pool.in_use == 0 and db_tools._cursors == {}
+    assert total.splitlines()[1:] == ["east\t100", "north\t100", "south\t100"]
+    assert window.splitlines()[-1] == "-- rows 299-300 of 300"
+    assert filtered.splitlines()[1:] == ["5", "7", "-- rows 1-2 of 2"]
+
+
+def test_large_query_pg_result_is_stored_a_page_at_a_time(mock_pg_pool, monkeypatch):
+    monkeypatch.setattr("src.tools.database.PG_MAX_PAGE_SIZE", 40)
+    db_tools = DatabaseTools()
+    db_tools.results = ResultStore(":memory:")
+    chunks = []
+    append = db_tools.results.append
+    monkeypatch.setattr(db_tools.results, "append", lambda handle, rows: chunks.append(len(rows)) or append(handle, rows))
+    sql = "SELECT id, region, amount FROM sales"
+    mock_pg_pool.results[sql] = (["id", "region", "amount"], ROWS, "SELECT 300")
+
+    preview = asyncio.run(db_tools.query_pg(sql))
+
+    handle = preview.split("handle='")[1].split("'")[0]
+    assert max(chunks) <= 40 and sum(chunks) == 300
+    assert db_tools.results.info(handle)[2] == 300 and "300 rows stored" in preview
+    assert preview.splitlines()[1].startswith("0\t")
+
+
+def test_explicit_page_size_keeps_cursor_paging(mock_pg_pool):
+    db_tools = DatabaseTools()
+    db_tools.results = ResultStore(":memory:")
+    sql = "SELECT id, region, amount FROM sales"
+    mock_pg_pool.results[sql] = (["id", "region", "amount"], ROWS, "SELECT 300")
+
+    result = asyncio.run(db_tools.query_pg(sql, page_size=50))
+
+    assert "cursor_token=" in result and "handle=" not in result
+    asyncio.run(db_tools.close())
+
+
+def test_couch_docs_over_the_budget_are_stored():
+    async def run():
+        async with fake_couch() as (fake, url):
+            fake.create_db("orders", [{"_id": f"o{i}", "total": i} for i in range(60)])
+            db_tools = DatabaseTools(couch_server=url)
+            db_tools.results = ResultStore(":memory:")
+            db_tools.encoder = ResultEncoder(max_bytes=200)
+            try:
+                preview = await db_tools.query_couch("orders", operation="bulk_read", doc_ids=[f"o{i}" for i in range(60)])
+                handle = preview.split("handle='")[1].split("'")[0]
+                return preview, await db_tools.result_aggregate(handle, ["sum:total"])
+            finally:
+                await db_tools.close()
+
+    preview, total = asyncio.run(run())
+    assert "60 rows stored as handle=" in preview
+    assert total.splitlines()[1] == str(sum(range(60)))
+
+
+def test_unknown_handle_is_reported():
+    db_tools = DatabaseTools()
+    db_tools.results = ResultStore(":memory:")
+    assert asyncio.run(db_tools.result_slice("r_gone")).startswith("Error: Unknown result handle 'r_gone'")
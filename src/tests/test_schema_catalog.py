@@ -0,0 +1,143 @@
+import asyncio
+
+from src.tests.fake_couch import fake_couch
+from src.tests.test_database_tools import mock_pg_pool  # noqa: F401
+from src.tools.database import DatabaseTools
+from src.tools.schema_catalog import PG_COLUMNS_SQL, PG_KEYS_SQL, PG_ROW_ESTIMATES_SQL
+
+COLUMNS = ["table_schema", "table_name", "column_name", "data_type", "nullable"]
+KEYS = ["table_schema", "table_name", "constraint_type", "column_name", "ref_table", "ref_column"]
+ESTIMATES = ["table_schema", "table_name", "row_estimate"]
+
+
+def load_schema(pool, extra_columns=()):
+    pool.results[PG_COLUMNS_SQL] = (COLUMNS, [
+        ("public", "users", "id", "integer", False),
+        ("public", "users", "email", "text", True),
+        ("public", "orders", "id", "integer", False),
+        ("public", "orders", "user_id", "integer", True),
+        *extra_columns,
+    ], "SELECT")
+    pool.results[PG_KEYS_SQL] = (KEYS, [
+        ("public", "users", "PRIMARY KEY", "id", None, None),
+        ("public", "orders", "PRIMARY KEY", "id", None, None),
+        ("public", "orders", "FOREIGN KEY", "user_id", "users", "id"),
+    ], "SELECT")
+    pool.results[PG_ROW_ESTIMATES_SQL] = (ESTIMATES, [("public", "users", 1200), ("public", "orders", 5400)], "SELECT")
+
+
+def catalog_queries(pool):
+    return sum(sql in (PG_COLUMNS_SQL, PG_KEYS_SQL, PG_ROW_ESTIMATES_SQL)
+               for conn in pool.created for sql in conn.executed)
+
+
+def run_catalog(scenario):
+    async def run():
+        async with fake_couch() as (fake, url):
+            fake.create_db("mobilization", [{"_id": "a", "type": "request"}])
+            db_tools = DatabaseTools(couch_server=url)
+            try:
+                return await scenario(db_tools, fake)
+            finally:
+                await db_tools.close()
+    return asyncio.run(run())
+
+
+def test_describe_schema_lists_tables_and_databases(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        await db_tools.query_couch("mobilization", operation="create_index", data={"fields": ["type"]})
+        return await db_tools.describe_schema()
+
+    result = run_catalog(scenario)
+    assert "users (~1200 rows) PK(id)" in result
+    assert "  user_id integer -> users.id" in result
+    assert "  id integer not null" in result
+    assert "mobilization (1 docs) indexes: type" in result
+
+
+def test_warm_catalog_makes_no_database_calls(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        await db_tools.describe_schema()
+        couch_requests = len(fake.requests)
+        described = await db_tools.describe_schema("orders")
+        return described, couch_requests, len(fake.requests)
+
+    described, before, after = run_catalog(scenario)
+    assert described.startswith("orders (~5400 rows) PK(id)")
+    assert catalog_queries(mock_pg_pool) == 3
+    assert before == after
+
+
+def test_background_load_starts_once_for_many_sessions(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        for _ in range(3):
+            db_tools.catalog.load_in_background()
+        task = db_tools.catalog._background
+        await task
+        db_tools.catalog.load_in_background()
+        return task, db_tools.catalog._background
+
+    first, after = run_catalog(scenario)
+    assert first is after
+    assert catalog_queries(mock_pg_pool) == 3
+
+
+def test_failed_load_is_reported_instead_of_an_empty_catalog(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def refused():
+        raise OSError("connection refused")
+
+    async def scenario(db_tools, fake):
+        db_tools.pg.checkout = refused
+        failed = await db_tools.describe_schema()
+        missing = await db_tools.describe_schema("users")
+        del db_tools.pg.checkout
+        return failed, missing, await db_tools.describe_schema(refresh=True)
+
+    failed, missing, recovered = run_catalog(scenario)
+    assert "(none loaded)" in failed
+    assert "-- loading the Postgres catalog failed (connection refused)" in failed and "nothing is known about it yet" in failed
+    assert "loading the Postgres catalog failed" in missing
+    assert "failed" not in recovered and "users (~1200 rows)" in recovered
+
+
+def test_ddl_through_query_pg_refreshes_the_catalog(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        await db_tools.describe_schema()
+        await db_tools.query_pg("ALTER TABLE users ADD COLUMN name text")
+        load_schema(mock_pg_pool, [("public", "users", "name", "text", True)])
+        return await db_tools.describe_schema("users")
+
+    result = run_catalog(scenario)
+    assert "  name text" in result
+    assert catalog_queries(mock_pg_pool) == 6
+
+
+def test_describe_schema_unknown_name(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        return await db_tools.describe_schema("missing")
+
+    assert run_catalog(scenario).startswith("Error: 'missing' is not a known")
+
+
+def test_describe_schema_falls_back_to_names_over_budget(mock_pg_pool):
+    load_schema(mock_pg_pool)
+
+    async def scenario(db_tools, fake):
+        db_tools.encoder.max_bytes = 100
+        return await db_tools.describe_schema()
+
+    result = run_catalog(scenario)
+    assert result.startswith("# Postgres tables: orders, users")
+    assert "call describe_schema with name=" in result
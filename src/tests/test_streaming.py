@@ -0,0 +1,91 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import anthropic
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src.agent.streaming import StreamInterrupted, stream_message
+
+
+def sse(event: dict) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def tool_then_text_events():
+    yield {"type": "message_start", "message": {
+        "id": "msg_1", "type": "message", "role": "assistant", "model": "m", "content": [],
+        "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 0}}}
+    yield {"type": "content_block_start", "index": 0, "content_block": {"type": "tool_use", "id": "t1", "name": "query_pg", "input": {}}}
+    yield {"type": "content_block_delta", "index": 0, "delta": {"type": "input_json_delta", "partial_json": '{"sql": "SELECT'}}
+    yield {"type": "content_block_delta", "index": 0, "delta": {"type": "input_json_delta", "partial_json": ' 1"}'}}
+    yield {"type": "content_block_stop", "index": 0}
+    yield "pause"
+    yield {"type": "content_block_start", "index": 1, "content_block": {"type": "text", "text": ""}}
+    yield {"type": "content_block_delta", "index": 1, "delta": {"type": "text_delta", "text": "Counting rows"}}
+    yield {"type": "content_block_stop", "index": 1}
+    yield {"type": "message_delta", "delta": {"stop_reason": "tool_use", "stop_sequence": None}, "usage": {"output_tokens": 12}}
+    yield {"type": "message_stop"}
+
+
+@asynccontextmanager
+async def streaming_api(events, fail_after_tool=False):
+    """Serve one canned event stream on /v1/messages; yields a client pointed at it."""
+    async def messages(request):
+        response = web.StreamResponse(headers={"content-type": "text/event-stream"})
+        await response.prepare(request)
+        for event in events():
+            if event == "pause":
+                await asyncio.sleep(0.05)
+                if fail_after_tool:
+                    request.transport.close()
+                    return response
+                continue
+            await response.write(sse(event))
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/messages", messages)
+    server = TestServer(app)
+    await server.start_server()
+    client = anthropic.AsyncAnthropic(api_key="test", max_retries=0, base_url=f"http://{server.host}:{server.port}")
+    try:
+        yield client
+    finally:
+        await client.close()
+        await server.close()
+
+
+def test_tool_starts_before_the_response_finishes():
+    log = []
+
+    async def run_tool(block):
+        log.append(("tool", block.input))
+        return {"tool_use_id": block.id, "content": "1"}
+
+    async def run():
+        async with streaming_api(tool_then_text_events) as client:
+            message, tasks = await stream_message(client, lambda text: log.append(("text", text)), run_tool,
+                                                  model="m", max_tokens=10, messages=[])
+            return message, await asyncio.gather(*tasks)
+
+    message, results = asyncio.run(run())
+    assert log == [("tool", {"sql": "SELECT 1"}), ("text", "Counting rows")]
+    assert results == [{"tool_use_id": "t1", "content": "1"}]
+    assert [block.type for block in message.content] == ["tool_use", "text"]
+    assert message.stop_reason == "tool_use"
+
+
+def test_failure_after_dispatch_carries_started_tools():
+    async def run_tool(block):
+        return {"tool_use_id": block.id, "content": "1"}
+
+    async def run():
+        async with streaming_api(tool_then_text_events, fail_after_tool=True) as client:
+            with pytest.raises(StreamInterrupted) as info:
+                await stream_message(client, lambda text: None, run_tool, model="m", max_tokens=10, messages=[])
+            return await asyncio.gather(*info.value.tool_tasks)
+
+    assert asyncio.run(run()) == [{"tool_use_id": "t1", "content": "1"}]
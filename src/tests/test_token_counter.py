@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+from src.agent.token_counter import TokenCounter, usage_input_tokens
+
+
+def exchange(i, size=400):
+    """A tool round trip: assistant tool_use followed by the user's tool_result."""
+    return [
+        {"role": "assistant", "content": [{"type": "tool_use", "id": f"t{i}", "name": "query_pg", "input": {"sql": "x" * size}}]},
+        {"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{i}", "content": "y" * size}]},
+    ]
+
+
+def conversation(exchanges=10):
+    messages = [{"role": "user", "content": "How many users signed up?"}]
+    for i in range(exchanges):
+        messages += exchange(i)
+    return messages
+
+
+def test_message_estimates_are_cached_by_identity():
+    counter = TokenCounter()
+    messages = conversation(2)
+    first = counter.count(messages)
+    messages[1]["content"][0]["input"]["sql"] = ""  # mutation in place is not re-estimated
+    assert counter.count(messages) == first
+    assert counter.count(messages[:1]) < first
+
+
+def test_calibration_moves_estimate_toward_reported_usage():
+    counter = TokenCounter()
+    messages = conversation(3)
+    estimate = counter.count(messages)
+    for _ in range(10):
+        counter.calibrate(estimate * 2, messages)
+    assert abs(counter.count(messages) - estimate * 2) <= estimate * 0.01
+
+
+def test_truncate_fits_budget_and_keeps_tool_pairs():
+    counter = TokenCounter()
+    messages = conversation(10)
+    budget = counter.count(messages) // 2
+    removed = counter.truncate(messages, budget)
+    assert removed and counter.count(messages) <= budget
+    assert messages[0]["content"] == "How many users signed up?"
+    assert messages[1]["role"] == "assistant"
+    kept_uses = {m["content"][0]["id"] for m in messages if m["role"] == "assistant"}
+    kept_results = {m["content"][0]["tool_use_id"] for m in messages[1:] if m["role"] == "user"}
+    assert kept_results == kept_uses
+
+
+def test_truncate_under_budget_is_a_no_op():
+    counter = TokenCounter()
+    messages = conversation(2)
+    assert counter.truncate(messages, counter.count(messages)) == []
+    assert len(messages) == 5
+
+
+def test_truncate_keeps_latest_exchange_when_nothing_fits():
+    counter = TokenCounter()
+    messages = conversation(3)
+    counter.truncate(messages, 1)
+    assert [m["role"] for m in messages] == ["user", "assistant", "user"]
+    assert messages[1]["content"][0]["id"] == "t2"
+
+
+def test_usage_input_tokens_includes_cached_prefix():
+    usage = SimpleNamespace(input_tokens=10, cache_read_input_tokens=900, cache_creation_input_tokens=None)
+    assert usage_input_tokens(usage) == 910
@@ -0,0 +1,111 @@
+import asyncio
+from types import SimpleNamespace
+
+from src.agent.tool_memo import ToolMemo, classify
+
+
+def tool_result(text, error=False):
+    return SimpleNamespace(content=[SimpleNamespace(text=text)], isError=error)
+
+
+class FakeSession:
+    """call_tool stand-in that counts real calls and takes a little time."""
+    def __init__(self):
+        self.calls = []
+
+    async def call_tool(self, name, tool_input):
+        self.calls.append((name, tool_input))
+        await asyncio.sleep(0.01)
+        if tool_input.get("fail"):
+            return tool_result("Error: boom")
+        return tool_result(f"result {len(self.calls)}")
+
+
+def call(memo, session, name, tool_input):
+    return memo.call(name, tool_input, lambda: session.call_tool(name, tool_input))
+
+
+def test_identical_reads_in_one_batch_run_once():
+    async def run():
+        memo, session = ToolMemo(), FakeSession()
+        results = await asyncio.gather(
+            call(memo, session, "query_pg", {"sql": "SELECT 1"}),
+            call(memo, session, "query_pg", {"sql": "SELECT 1"}),
+            call(memo, session, "query_couch", {"operation": "read", "db_name": "a", "doc_id": "1"}),
+            call(memo, session, "query_couch", {"db_name": "a", "doc_id": "1", "operation": "read"}),
+        )
+        return memo, session, results
+
+    memo, session, results = asyncio.run(run())
+    assert len(session.calls) == 2
+    assert results[0] is results[1] and results[2] is results[3]
+    assert memo.stats()["saved"] == 2
+
+
+def test_write_invalidates_its_scope_only():
+    async def run():
+        memo, session = ToolMemo(), FakeSession()
+        read_pg = {"sql": "SELECT count(*) FROM orders"}
+        read_couch = {"db_name": "a", "doc_id": "1"}
+        await call(memo, session, "query_pg", read_pg)
+        await call(memo, session, "query_couch", read_couch)
+        await call(memo, session, "query_pg", {"sql": "INSERT INTO orders VALUES (1)"})
+        await call(memo, session, "query_pg", read_pg)
+        await call(memo, session, "query_couch", read_couch)
+        await call(memo, session, "query_couch", {"db_name": "a", "operation": "update", "doc_id": "1", "data": {}})
+        await call(memo, session, "query_couch", read_couch)
+        return session
+
+    names = [c[1].get("sql") or c[1].get("operation", "read") for c in asyncio.run(run()).calls]
+    assert names == ["SELECT count(*) FROM orders", "read", "INSERT INTO orders VALUES (1)",
+                     "SELECT count(*) FROM orders", "update", "read"]
+
+
+def test_read_overlapping_a_write_is_not_kept():
+    async def run():
+        memo, session = ToolMemo(), FakeSession()
+        read = {"sql": "SELECT * FROM t"}
+        await asyncio.gather(call(memo, session, "query_pg", read),
+                             call(memo, session, "query_pg", {"sql": "DELETE FROM t"}))
+        await call(memo, session, "query_pg", read)
+        return session
+
+    assert len(asyncio.run(run()).calls) == 3
+
+
+def test_errors_and_paging_are_not_memoized():
+    async def run():
+        memo, session = ToolMemo(), FakeSession()
+        for _ in range(2):
+            await call(memo, session, "query_pg", {"sql": "SELECT 1", "fail": True})
+            await call(memo, session, "fetch_pg_page", {"cursor_token": "abc"})
+        return memo, session
+
+    memo, session = asyncio.run(run())
+    assert len(session.calls) == 4 and memo.saved == 0
+
+
+def test_volatile_reads_run_every_time():
+    async def run():
+        memo, session = ToolMemo(), FakeSession()
+        for _ in range(2):
+            await call(memo, session, "query_pg", {"sql": "SELECT nextval('order_ids')"})
+            await call(memo, session, "query_pg", {"sql": "EXPLAIN ANALYZE DELETE FROM users"})
+        return memo, session
+
+    memo, session = asyncio.run(run())
+    assert len(session.calls) == 4 and memo.saved == 0
+
+
+def test_classification():
+    assert classify("query_pg", {"sql": "select 1; delete from t"}) == ("write", {"pg"})
+    assert classify("query_pg", {"sql": "ALTER TABLE t ADD c int"}) == ("write", {"pg", "schema"})
+    assert classify("query_pg", {"sql": "SELECT 1", "page_size": 10}) == ("skip", set())
+    assert classify("query_pg", {"sql": "SELECT nextval('s')"}) == ("skip", set())
+    assert classify("query_pg", {"sql": "SELECT now()"}) == ("skip", set())
+    assert classify("query_pg", {"sql": "EXPLAIN ANALYZE SELECT * FROM t"}) == ("skip", set())
+    assert classify("query_pg", {"sql": "EXPLAIN ANALYZE DELETE FROM users"}) == ("write", {"pg"})
+    assert classify("query_couch", {"db_name": "a", "operation": "create_index"}) == ("write", {"couch:a", "schema"})
+    assert classify("describe_schema", {}) == ("read", {"schema"})
+    assert classify("bulk_load_pg", {"table": "t", "columns": ["a"], "rows": [[1]]}) == ("write", {"pg"})
+    assert classify("mystery_tool", {}) == ("write", {"*"})
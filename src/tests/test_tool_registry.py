@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from jsonschema import ValidationError
+from mcp.server.fastmcp import Context, FastMCP
+from mcp.shared.memory import create_connected_server_and_client_session
+
+from src.agent.tool_registry import ToolRegistry
+
+SCHEMA = {"type": "object", "properties": {"sql": {"type": "string"}}, "required": ["sql"]}
+
+
+def tool(name, schema=SCHEMA, description=""):
+    return SimpleNamespace(name=name, description=description, inputSchema=schema)
+
+
+def test_lookup_and_precompiled_validation():
+    registry = ToolRegistry()
+    registry.load([tool("query_pg"), tool("describe_schema", {"type": "object"})])
+
+    assert "query_pg" in registry and "nope" not in registry
+    assert [t["name"] for t in registry.params] == ["query_pg", "describe_schema"]
+    registry.validate("query_pg", {"sql": "SELECT 1"})
+    with pytest.raises(ValidationError, match="'sql' is a required property"):
+        registry.validate("query_pg", {})
+
+
+def test_reload_recompiles_only_changed_tools():
+    registry = ToolRegistry()
+    registry.load([tool("a"), tool("b")])
+    validator_a = registry._validators["a"]
+    params = registry.params
+
+    assert registry.load([tool("a"), tool("b")]) == ([], [], [])
+    assert registry.params is params  # unchanged listing keeps the same list, so cached prefixes still match
+
+    added, removed, changed = registry.load([tool("a"), tool("b", {"type": "object"}), tool("c")])
+    assert (added, removed, changed) == (["c"], [], ["b"])
+    assert registry._validators["a"] is validator_a
+    registry.validate("b", {})
+
+    assert registry.load([tool("c")]) == ([], ["a", "b"], [])
+    assert len(registry) == 1
+
+
+def test_list_changed_notification_refreshes_the_registry():
+    server = FastMCP("test")
+
+    @server.tool()
+    async def enable_reports(ctx: Context) -> str:
+        """Registers another tool and tells the client"""
+        server.add_tool(lambda period: period, name="run_report", description="Run a report")
+        await ctx.session.send_tool_list_changed()
+        return "ok"
+
+    async def run():
+        registry = ToolRegistry()
+        holder = {}
+
+        async def on_message(message):
+            registry.on_message(message, holder["session"])
+
+        async with create_connected_server_and_client_session(server, message_handler=on_message) as session:
+            holder["session"] = session
+            await registry.refresh(session)
+            before = [t["name"] for t in registry.params]
+            await session.call_tool("enable_reports", {})
+            for _ in range(50):
+                if "run_report" in registry:
+                    break
+                await asyncio.sleep(0.01)
+            return before, [t["name"] for t in registry.params], registry.refreshes
+
+    before, after, refreshes = asyncio.run(run())
+    assert before == ["enable_reports"]
+    assert after == ["enable_reports", "run_report"]
+    assert refreshes == 2
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+from src.utils.tracing import JsonlSink, Tracer, current_span, load_spans, summarize, trace_meta
+
+
+def test_spans_nest_across_tasks_and_continue_remote_traces(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = Tracer(path=str(path), enabled=True)
+
+    async def tool(name):
+        with tracer.span("tool.call", tool=name):
+            await asyncio.sleep(0.01)
+            return trace_meta()["traceparent"]
+
+    async def run():
+        with tracer.span("query") as query:
+            with tracer.span("iteration", number=1):
+                parents = await asyncio.gather(tool("a"), tool("b"))
+            query.set(iterations=1)
+        return parents
+
+    parents = asyncio.run(run())
+    # The server side picks up where the client's tool span left off
+    with tracer.span("mcp.query_pg", traceparent=parents[0]) as server_span:
+        server_span.set(result_chars=3)
+    assert current_span().traceparent() is None
+    tracer.close()
+
+    spans = {(s["name"], s["attributes"].get("tool")): s for s in load_spans([str(path)])}
+    query, iteration = spans[("query", None)], spans[("iteration", None)]
+    a, b, server = spans[("tool.call", "a")], spans[("tool.call", "b")], spans[("mcp.query_pg", None)]
+    assert len({s["trace_id"] for s in spans.values()}) == 1
+    assert iteration["parent_span_id"] == query["span_id"] and query["parent_span_id"] is None
+    assert a["parent_span_id"] == b["parent_span_id"] == iteration["span_id"]
+    assert server["parent_span_id"] == a["span_id"]
+    assert query["attributes"] == {"iterations": 1}
+
+
+def test_errors_are_recorded_and_disabled_tracer_writes_nothing(tmp_path):
+    tracer = Tracer(path=str(tmp_path / "traces.jsonl"), enabled=True)
+    try:
+        with tracer.span("claude.request"):
+            raise TimeoutError()
+    except TimeoutError:
+        pass
+    tracer.close()
+    [span] = load_spans([str(tmp_path / "traces.jsonl")])
+    assert (span["status"], span["attributes"]["error"]) == ("error", "TimeoutError")
+
+    off = Tracer(path=str(tmp_path / "off.jsonl"), enabled=False)
+    with off.span("query") as span:
+        span.set(x=1)
+    assert not (tmp_path / "off.jsonl").exists()
+
+
+def test_sink_drops_instead_of_blocking_when_full(tmp_path):
+    sink = JsonlSink(str(tmp_path / "traces.jsonl"), max_queued=1)
+    for n in range(1000):
+        sink.emit({"n": n})
+    sink.close()
+    written = len((tmp_path / "traces.jsonl").read_text().splitlines())
+    assert written + sink.dropped == 1000 and written >= 1
+
+
+def span(name, span_id, parent, start_ms, end_ms, **attributes):
+    return {"trace_id": "t", "span_id": span_id, "parent_span_id": parent, "name": name, "status": "ok",
+            "start_time_unix_nano": int(start_ms * 1e6), "end_time_unix_nano": int(end_ms * 1e6),
+            "duration_ms": end_ms - start_ms, "attributes": attributes}
+
+
+def test_summary_self_time_counts_parallel_children_once():
+    spans = [
+        span("query", "q", None, 0, 100),
+        span("claude.request", "c", "q", 0, 40, input_tokens=500, output_tokens=20, cache_read_tokens=400),
+        span("tool.call", "t1", "q", 50, 90, memo_hit=False),
+        span("tool.call", "t2", "q", 60, 80, memo_hit=True),
+        span("db.query_pg", "d", "t1", 55, 85, cache_hit=False),
+    ]
+    summary = summarize(spans)
+    rows = {r["name"]: r for r in summary["spans"]}
+    assert summary["wall_ms"] == 100
+    assert round(rows["query"]["self_ms"], 3) == 20  # 100 minus 0-40 and the overlapping 50-90
+    assert round(rows["tool.call"]["self_ms"], 3) == 30  # t1 minus its db query, plus all of t2
+    assert (rows["tool.call"]["count"], rows["tool.call"]["p99_ms"]) == (2, 40)
+    assert summary["totals"]["input_tokens"] == 500 and summary["totals"]["cache_read_tokens"] == 400
+    assert (summary["totals"]["cache_hits"], summary["totals"]["cache_lookups"]) == (1, 3)
+    json.dumps(summary)
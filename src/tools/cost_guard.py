@@ -0,0 +1,84 @@
+import json
+import os
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from .query_cache import normalize_sql, statement_kind
+
+load_dotenv()
+
+# Planner limits for query_pg: reads estimated above PG_GUARD_MAX_ROWS get a LIMIT of that many
+# rows; anything still above PG_GUARD_MAX_COST, and writes above either limit, are rejected
+PG_GUARD_MAX_COST = float(os.getenv("PG_GUARD_MAX_COST", "1000000"))
+PG_GUARD_MAX_ROWS = int(os.getenv("PG_GUARD_MAX_ROWS", "100000"))
+# Applied to every statement of a query_pg call; 0 disables it
+PG_STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "30000"))
+
+# Statements EXPLAIN accepts; everything else (DDL, SET, COPY...) is only bound by the timeout
+EXPLAINABLE = {"select", "with", "values", "table", "insert", "update", "delete", "merge"}
+
+
+class QueryRejected(Exception):
+    """The planner's estimate for a statement is over the guard's limits."""
+
+
+def plan_estimate(plan: dict) -> tuple[float, float]:
+    """(total cost, rows) from the top node of an EXPLAIN (FORMAT JSON) plan.
+
+    A write's top node reports the rows it returns, not the rows it touches, so for
+    ModifyTable the estimate comes from the scan feeding it.
+    """
+    rows = plan.get("Plan Rows", 0)
+    if plan.get("Node Type") == "ModifyTable" and plan.get("Plans"):
+        rows = plan["Plans"][0].get("Plan Rows", rows)
+    return plan.get("Total Cost", 0.0), rows
+
+
+class CostGuard:
+    """Checks each agent-written statement against the planner's estimate before it runs."""
+
+    def __init__(self, max_cost: float = PG_GUARD_MAX_COST, max_rows: int = PG_GUARD_MAX_ROWS):
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.rejected = 0
+        self.limited = 0
+
+    async def explain(self, conn, statement: str) -> tuple[float, float]:
+        result = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {statement}")
+        plans = json.loads(result) if isinstance(result, str) else result
+        return plan_estimate(plans[0]["Plan"])
+
+    async def review(self, conn, statement: str) -> tuple[str, str]:
+        """Return the statement to run, possibly with a LIMIT added, and a note for the caller.
+
+        Raises QueryRejected when the statement is over the limits and a LIMIT cannot bring it under.
+        """
+        normalized = normalize_sql(statement)
+        kind = statement_kind(statement)
+        if normalized.split(" ", 1)[0] not in EXPLAINABLE or kind not in ("read", "write"):
+            return statement, None
+        cost, rows = await self.explain(conn, statement)
+        if cost <= self.max_cost and rows <= self.max_rows:
+            return statement, None
+        estimate = f"estimated cost {cost:,.0f}, {rows:,.0f} rows (limits {self.max_cost:,.0f} and {self.max_rows:,})"
+        if kind == "write":
+            self.rejected += 1
+            logger.warning(f"Rejected write by cost guard, {estimate}: {statement}")
+            raise QueryRejected(f"the planner {estimate}. Narrow the WHERE clause or split the change into batches.")
+        # Only the rows the caller reads are produced, so the limit usually cuts the cost too. A read
+        # that already has a LIMIT within max_rows never gets here unless its cost alone is too high
+        limited = f"SELECT * FROM (\n{statement}\n) AS guarded LIMIT {self.max_rows}"
+        if rows > self.max_rows:
+            cost, _ = await self.explain(conn, limited)
+        if cost > self.max_cost:
+            self.rejected += 1
+            logger.warning(f"Rejected query by cost guard, {estimate}: {statement}")
+            raise QueryRejected(f"the planner {estimate}. Add filters, join conditions or aggregate in SQL.")
+        self.limited += 1
+        logger.info(f"Cost guard limited query to {self.max_rows} rows, {estimate}")
+        return limited, f"-- limited to {self.max_rows:,} rows: the planner estimated {rows:,.0f}. Add filters or aggregate for a complete answer."
+
+    def stats(self) -> dict:
+        return {"rejected": self.rejected, "limited": self.limited,
+                "max_cost": self.max_cost, "max_rows": self.max_rows}
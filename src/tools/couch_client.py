@@ -0,0 +1,278 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from urllib.parse import quote
+
+import aiohttp
+from dotenv import load_dotenv
+from yarl import URL
+
+load_dotenv()
+
+# CouchDB HTTP client settings
+COUCH_POOL_SIZE = int(os.getenv("COUCH_POOL_SIZE", "20"))
+COUCH_KEEPALIVE_TIMEOUT = float(os.getenv("COUCH_KEEPALIVE_TIMEOUT", "60"))
+COUCH_REQUEST_TIMEOUT = float(os.getenv("COUCH_REQUEST_TIMEOUT", "30"))
+COUCH_DB_CACHE_TTL = float(os.getenv("COUCH_DB_CACHE_TTL", "30"))
+COUCH_BULK_BATCH_SIZE = int(os.getenv("COUCH_BULK_BATCH_SIZE", "500"))
+COUCH_EXPLAIN_CACHE_TTL = float(os.getenv("COUCH_EXPLAIN_CACHE_TTL", "300"))
+
+MISSING_DB_REASON = "Database does not exist."
+
+
+class CouchError(Exception):
+    """An error response from CouchDB."""
+
+    def __init__(self, status: int, error: str, reason: str):
+        super().__init__(f"{error}: {reason}" if reason else error)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+    @property
+    def missing_db(self) -> bool:
+        return self.status == 404 and self.reason == MISSING_DB_REASON
+
+
+def doc_path(doc_id: str) -> str:
+    """URL path segment for a document id; design documents keep their slash."""
+    if doc_id.startswith("_design/"):
+        return "_design/" + quote(doc_id[len("_design/"):], safe="")
+    return quote(doc_id, safe="")
+
+
+def selector_fields(selector, prefix: str = "") -> list[str]:
+    """Field paths a Mango selector filters on, in the order they first appear."""
+    fields = []
+    if isinstance(selector, list):
+        for item in selector:
+            fields += [f for f in selector_fields(item, prefix) if f not in fields]
+        return fields
+    if not isinstance(selector, dict):
+        return fields
+    for key, value in selector.items():
+        if key.startswith("$"):
+            nested = selector_fields(value, prefix)
+        else:
+            path = f"{prefix}.{key}" if prefix else key
+            nested = selector_fields(value, path) or [path]
+        fields += [f for f in nested if f not in fields]
+    return fields
+
+
+class AsyncCouchClient:
+    """Async CouchDB client on a shared keep-alive connection pool."""
+
+    def __init__(self, url: str, pool_size: int = COUCH_POOL_SIZE, db_cache_ttl: float = COUCH_DB_CACHE_TTL,
+                 timeout: float = COUCH_REQUEST_TIMEOUT):
+        parsed = URL(url)
+        self.headers = {}
+        if parsed.user:
+            credentials = base64.b64encode(f"{parsed.user}:{parsed.password or ''}".encode()).decode()
+            self.headers["Authorization"] = f"Basic {credentials}"
+        self.base_url = str(parsed.with_user(None).with_password(None)).rstrip("/")
+        self.pool_size = pool_size
+        self.db_cache_ttl = db_cache_ttl
+        self.timeout = timeout
+        self._session = None
+        # db name -> (exists, expires_at)
+        self._db_cache: dict[str, tuple[bool, float]] = {}
+        # db name -> in-flight existence check shared by concurrent callers
+        self._db_checks: dict[str, asyncio.Future] = {}
+        # (db name, query shape) -> (explain result, expires_at)
+        self._explain_cache: dict[tuple[str, str], tuple[dict, float]] = {}
+        self.round_trips = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=COUCH_KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                json_serialize=lambda obj: json.dumps(obj, separators=(",", ":")),
+            )
+        return self._session
+
+    async def request(self, method: str, path: str, params: dict = None, body=None):
+        """Send one request and return (status, headers, decoded JSON body), raising CouchError on failure."""
+        session = self._get_session()
+        url = URL(f"{self.base_url}/{path}", encoded=True)
+        self.round_trips += 1
+        async with session.request(method, url, params=params, json=body) as response:
+            payload = await response.json(content_type=None) if method != "HEAD" else None
+            if response.status >= 400:
+                payload = payload or {}
+                raise CouchError(response.status, payload.get("error", response.reason or ""), payload.get("reason", ""))
+            return response.status, response.headers, payload
+
+    async def db_request(self, method: str, db_name: str, path: str = "", params: dict = None, body=None):
+        """Request under a database, keeping the existence cache in step with what CouchDB reports."""
+        try:
+            result = await self.request(method, f"{quote(db_name, safe='')}/{path}".rstrip("/"), params, body)
+        except CouchError as e:
+            if e.missing_db:
+                self._remember_db(db_name, False)
+            raise
+        self._remember_db(db_name, True)
+        return result
+
+    def _remember_db(self, db_name: str, exists: bool) -> None:
+        self._db_cache[db_name] = (exists, time.monotonic() + self.db_cache_ttl)
+
+    async def db_exists(self, db_name: str) -> bool:
+        """Whether a database exists, cached for db_cache_ttl seconds and checked once for concurrent callers."""
+        cached = self._db_cache.get(db_name)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        pending = self._db_checks.get(db_name)
+        if pending is None:
+            pending = asyncio.ensure_future(self._check_db(db_name))
+            self._db_checks[db_name] = pending
+            pending.add_done_callback(lambda _: self._db_checks.pop(db_name, None))
+        return await asyncio.shield(pending)
+
+    async def _check_db(self, db_name: str) -> bool:
+        try:
+            await self.request("HEAD", quote(db_name, safe=""))
+            exists = True
+        except CouchError as e:
+            if e.status != 404:
+                raise
+            exists = False
+        self._remember_db(db_name, exists)
+        return exists
+
+    def forget_db(self, db_name: str = None) -> None:
+        """Drop cached existence for one database, or all of them."""
+        if db_name is None:
+            self._db_cache.clear()
+        else:
+            self._db_cache.pop(db_name, None)
+
+    async def all_dbs(self) -> list[str]:
+        _, _, dbs = await self.request("GET", "_all_dbs")
+        return dbs
+
+    async def get_doc(self, db_name: str, doc_id: str) -> dict:
+        _, _, doc = await self.db_request("GET", db_name, doc_path(doc_id))
+        return doc
+
+    async def find(self, db_name: str, query: dict) -> dict:
+        _, _, result = await self.db_request("POST", db_name, "_find", body=query)
+        return result
+
+    async def explain(self, db_name: str, query: dict) -> dict:
+        """Ask CouchDB which index a query would use; cached per selector shape since values do not change the plan."""
+        shape = json.dumps({
+            "fields": sorted(selector_fields(query.get("selector", {}))),
+            "sort": query.get("sort"),
+            "use_index": query.get("use_index"),
+        }, sort_keys=True)
+        cached = self._explain_cache.get((db_name, shape))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        _, _, plan = await self.db_request("POST", db_name, "_explain", body=query)
+        self._explain_cache[(db_name, shape)] = (plan, time.monotonic() + COUCH_EXPLAIN_CACHE_TTL)
+        return plan
+
+    async def db_info(self, db_name: str) -> dict:
+        """Database metadata such as doc_count, cached for as long as query plans."""
+        cached = self._explain_cache.get((db_name, "_info"))
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        _, _, info = await self.db_request("GET", db_name)
+        self._explain_cache[(db_name, "_info")] = (info, time.monotonic() + COUCH_EXPLAIN_CACHE_TTL)
+        return info
+
+    async def list_indexes(self, db_name: str) -> list[dict]:
+        _, _, result = await self.db_request("GET", db_name, "_index")
+        return result["indexes"]
+
+    async def create_index(self, db_name: str, fields: list, name: str = None, ddoc: str = None,
+                           partial_filter_selector: dict = None) -> dict:
+        """Create a JSON Mango index and forget cached plans for the database."""
+        body = {"index": {"fields": fields}, "type": "json"}
+        if partial_filter_selector:
+            body["index"]["partial_filter_selector"] = partial_filter_selector
+        if name:
+            body["name"] = name
+        if ddoc:
+            body["ddoc"] = ddoc
+        _, _, result = await self.db_request("POST", db_name, "_index", body=body)
+        self._explain_cache = {k: v for k, v in self._explain_cache.items() if k[0] != db_name}
+        return result
+
+    async def query_view(self, db_name: str, design: str, view: str, params: dict = None) -> dict:
+        """Query a map/reduce view; parameters go in a POST body so keys need no URL encoding."""
+        path = f"{doc_path('_design/' + design)}/_view/{quote(view, safe='')}"
+        _, _, result = await self.db_request("POST", db_name, path, body=params or {})
+        return result
+
+    async def design_docs(self, db_name: str) -> list[dict]:
+        _, _, result = await self.db_request("GET", db_name, "_design_docs", params={"include_docs": "true"})
+        return [row["doc"] for row in result["rows"] if row.get("doc")]
+
+    async def put_view(self, db_name: str, design: str, view: str, map_fn: str, reduce_fn: str = None) -> str:
+        """Add or replace one view in a design document, creating the document if needed; returns the new rev."""
+        doc_id = f"_design/{design}"
+        try:
+            ddoc = await self.get_doc(db_name, doc_id)
+        except CouchError as e:
+            if e.status != 404 or e.missing_db:
+                raise
+            ddoc = {"_id": doc_id, "language": "javascript"}
+        definition = {"map": map_fn}
+        if reduce_fn:
+            definition["reduce"] = reduce_fn
+        ddoc.setdefault("views", {})[view] = definition
+        _, rev = await self.save(db_name, ddoc)
+        return rev
+
+    async def save(self, db_name: str, doc: dict) -> tuple[str, str]:
+        """Create or overwrite a document; returns (id, rev)."""
+        if "_id" in doc:
+            _, _, result = await self.db_request("PUT", db_name, doc_path(doc["_id"]), body=doc)
+        else:
+            _, _, result = await self.db_request("POST", db_name, body=doc)
+        return result["id"], result["rev"]
+
+    async def update(self, db_name: str, doc_id: str, data: dict) -> str:
+        """Merge data into an existing document; returns the new rev."""
+        doc = await self.get_doc(db_name, doc_id)
+        doc.update(data)
+        _, rev = await self.save(db_name, doc)
+        return rev
+
+    async def delete(self, db_name: str, doc_id: str) -> str:
+        """Delete a document, reading its current rev from a HEAD request's ETag."""
+        _, headers, _ = await self.db_request("HEAD", db_name, doc_path(doc_id))
+        rev = headers.get("ETag", "").strip('"')
+        _, _, result = await self.db_request("DELETE", db_name, doc_path(doc_id), params={"rev": rev})
+        return result["rev"]
+
+    async def all_docs(self, db_name: str, keys: list[str], include_docs: bool = False) -> list[dict]:
+        """Fetch many documents (or just their revs) by id in one request per batch."""
+        rows = []
+        for start in range(0, len(keys), COUCH_BULK_BATCH_SIZE):
+            batch = keys[start:start + COUCH_BULK_BATCH_SIZE]
+            params = {"include_docs": "true"} if include_docs else None
+            _, _, result = await self.db_request("POST", db_name, "_all_docs", params=params, body={"keys": batch})
+            rows.extend(result["rows"])
+        return rows
+
+    async def bulk_docs(self, db_name: str, docs: list[dict]) -> list[dict]:
+        """Write many documents through _bulk_docs; returns one result per document."""
+        results = []
+        for start in range(0, len(docs), COUCH_BULK_BATCH_SIZE):
+            batch = docs[start:start + COUCH_BULK_BATCH_SIZE]
+            _, _, result = await self.db_request("POST", db_name, "_bulk_docs", body={"docs": batch})
+            results.extend(result)
+        return results
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
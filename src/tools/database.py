@@ -1,9 +1,25 @@
-import psycopg2
-import couchdb
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import asyncpg
 # from ..utils.config import load_config
 from loguru import logger
-import os
 from dotenv import load_dotenv
+from .cost_guard import PG_STATEMENT_TIMEOUT_MS, CostGuard, QueryRejected
+from .couch_client import AsyncCouchClient, CouchError, selector_fields
+from .encoding import ResultEncoder
+from .query_cache import QueryCache, is_cacheable, statement_kind
+from .result_store import RESULT_PREVIEW_ROWS, RESULT_STORE_MAX_ROWS, ResultStore, doc_columns
+from .schema_catalog import SchemaCatalog
+from ..utils.tracing import current_span, tracer
 
 load_dotenv()
 # TODO: Add a config file for the database connection details
@@ -14,12 +30,40 @@ PG_PASSWORD = os.getenv("PG_PASSWORD")
 PG_DB = os.getenv("PG_DB")
 DB_HOST = os.getenv("DB_HOST")
 
+# PostgreSQL pool settings
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_HEALTH_CHECK_INTERVAL = float(os.getenv("PG_HEALTH_CHECK_INTERVAL", "30"))
+
+# Result paging settings
+PG_PAGE_SIZE = int(os.getenv("PG_PAGE_SIZE", "200"))
+PG_MAX_PAGE_SIZE = int(os.getenv("PG_MAX_PAGE_SIZE", "1000"))
+PG_MAX_OPEN_CURSORS = int(os.getenv("PG_MAX_OPEN_CURSORS", "4"))
+PG_CURSOR_IDLE_TIMEOUT = float(os.getenv("PG_CURSOR_IDLE_TIMEOUT", "300"))
+
+# bulk_load_pg settings: rows per COPY, and how many bad rows are isolated before the rest of a
+# failing batch is rejected as a whole
+PG_COPY_BATCH_ROWS = int(os.getenv("PG_COPY_BATCH_ROWS", "5000"))
+PG_COPY_MAX_REJECTS = int(os.getenv("PG_COPY_MAX_REJECTS", "50"))
+
 # CouchDB connection details
 COUCH_USER = os.getenv("COUCH_USER")
 COUCH_PASSWORD = os.getenv("COUCH_PASSWORD")
 COUCH_HOST = os.getenv("COUCH_HOST", "localhost")
 COUCH_PORT = os.getenv("COUCH_PORT", "5984")
 
+# CouchDB Mango query settings
+COUCH_FIND_LIMIT = int(os.getenv("COUCH_FIND_LIMIT", "25"))
+COUCH_MAX_FIND_LIMIT = int(os.getenv("COUCH_MAX_FIND_LIMIT", "200"))
+COUCH_UNINDEXED_MAX_DOCS = int(os.getenv("COUCH_UNINDEXED_MAX_DOCS", "10000"))
+COUCH_VIEW_LIMIT = int(os.getenv("COUCH_VIEW_LIMIT", "100"))
+VIEW_PARAMS = {
+    "key", "keys", "startkey", "start_key", "endkey", "end_key", "startkey_docid", "endkey_docid",
+    "group", "group_level", "reduce", "limit", "skip", "descending", "include_docs", "inclusive_end",
+    "update", "stable",
+}
+BUILTIN_REDUCES = {"_count", "_sum", "_stats", "_approx_count_distinct"}
+
 postgres_url = f"postgresql://{PG_USER}:{PG_PASSWORD}@{DB_HOST}/{PG_DB}"
 couch_url = f"http://{COUCH_USER}:{COUCH_PASSWORD}@{COUCH_HOST}:{COUCH_PORT}"
 
@@ -27,59 +71,703 @@ print(f"Postgres URL: {postgres_url}")
 print(f"CouchDB URL: {couch_url}")
 
 
+def split_statements(sql: str) -> list[str]:
+    """Split a SQL string into statements, respecting quotes, dollar quotes and comments."""
+    statements, current = [], []
+    i, n = 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch in ("'", '"'):
+            end = i + 1
+            while end < n:
+                if sql[end] == ch:
+                    if end + 1 < n and sql[end + 1] == ch:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(sql[i:end + 1])
+            i = end + 1
+        elif ch == "$":
+            tag_end = sql.find("$", i + 1)
+            tag = sql[i:tag_end + 1] if tag_end != -1 else ""
+            if tag and (tag == "$$" or tag[1:-1].replace("_", "").isalnum()):
+                close = sql.find(tag, tag_end + 1)
+                close = n if close == -1 else close + len(tag)
+                current.append(sql[i:close])
+                i = close
+            else:
+                current.append(ch)
+                i += 1
+        elif sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = n if end == -1 else end
+        elif sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        elif ch == ";":
+            statements.append("".join(current))
+            current = []
+            i += 1
+        else:
+            current.append(ch)
+            i += 1
+    statements.append("".join(current))
+    return [s.strip() for s in statements if s.strip()]
+
+
+_IDENTIFIER = r'\s*(?:"((?:[^"]|"")+)"|([^."\s]+))\s*'
+
+
+def _table_name(table: str) -> tuple[str, str]:
+    """(schema or None, table) from a possibly quoted, schema-qualified name, folded the way Postgres does."""
+    match = re.fullmatch(rf"(?:{_IDENTIFIER}\.)?{_IDENTIFIER}", table)
+    if match is None:
+        return None
+    quoted_schema, schema, quoted, name = match.groups()
+    schema = quoted_schema.replace('""', '"') if quoted_schema else schema and schema.lower()
+    return schema, quoted.replace('""', '"') if quoted else name.lower()
+
+
+def _query_error(e: Exception) -> str:
+    if isinstance(e, QueryRejected):
+        return f"rejected before running: {str(e)}"
+    if isinstance(e, asyncpg.QueryCanceledError) and "statement timeout" in str(e):
+        return (f"the statement ran longer than {PG_STATEMENT_TIMEOUT_MS} ms and was cancelled. "
+                f"Add filters or a LIMIT, or aggregate in SQL.")
+    return str(e)
+
+
+def _csv_value(value) -> str:
+    """One field of a COPY CSV line: unquoted empty for NULL, everything else quoted."""
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _copy_rows(columns: list[str], rows: list = None, csv_text: str = None, header: bool = False) -> tuple[list, list]:
+    """Split bulk_load_pg input into ([(row number, values)], [(row number, reason)]) by shape alone."""
+    if csv_text is not None:
+        records = list(csv.reader(io.StringIO(csv_text)))
+        if header and records:
+            records = records[1:]
+        # An empty CSV field is NULL, as in COPY's own CSV format
+        rows = [[value if value != "" else None for value in record] for record in records if record]
+    good, bad = [], []
+    for number, row in enumerate(rows or [], 1):
+        if isinstance(row, dict):
+            unknown = set(row) - set(columns)
+            if unknown:
+                bad.append((number, f"unknown columns: {', '.join(sorted(unknown))}"))
+                continue
+            row = [row.get(column) for column in columns]
+        if not isinstance(row, (list, tuple)) or len(row) != len(columns):
+            bad.append((number, f"expected {len(columns)} values, got {len(row) if isinstance(row, (list, tuple)) else type(row).__name__}"))
+            continue
+        good.append((number, row))
+    return good, bad
+
+
+def _rowcount(status: str) -> int:
+    """Extract the affected row count from a Postgres command tag such as 'INSERT 0 5'."""
+    last = (status or "").rsplit(" ", 1)[-1]
+    return int(last) if last.isdigit() else 0
+
+
+class PostgresEngine:
+    """Bounded asyncpg connection pool with per-query acquire/release and health checks."""
+
+    def __init__(self, dsn: str, min_size: int = PG_POOL_MIN_SIZE, max_size: int = PG_POOL_MAX_SIZE,
+                 health_check_interval: float = PG_HEALTH_CHECK_INTERVAL):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self._pool = None
+        self._lock = asyncio.Lock()
+        # Last successful health check per backend pid
+        self._checked_at: dict[int, float] = {}
+
+    async def pool(self) -> asyncpg.Pool:
+        """Create the pool on first use, inside the running event loop."""
+        if self._pool is None:
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn, min_size=self.min_size, max_size=self.max_size
+                    )
+                    logger.info(f"Postgres pool ready (min={self.min_size}, max={self.max_size})")
+        return self._pool
+
+    async def _is_healthy(self, conn) -> bool:
+        """Ping a connection that has been idle longer than the health check interval."""
+        if conn.is_closed():
+            return False
+        pid = conn.get_server_pid()
+        now = time.monotonic()
+        if now - self._checked_at.get(pid, 0.0) < self.health_check_interval:
+            return True
+        try:
+            await conn.fetchval("SELECT 1")
+        except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+            logger.warning(f"Discarding unhealthy Postgres connection (pid {pid}): {str(e)}")
+            self._checked_at.pop(pid, None)
+            return False
+        self._checked_at[pid] = now
+        return True
+
+    async def checkout(self):
+        """Take a healthy connection out of the pool; the caller must hand it back with checkin()."""
+        pool = await self.pool()
+        conn = await pool.acquire()
+        if not await self._is_healthy(conn):
+            conn.terminate()
+            await pool.release(conn)
+            conn = await pool.acquire()
+        return conn
+
+    async def checkin(self, conn) -> None:
+        await self._pool.release(conn)
+
+    async def cancel(self, conn) -> None:
+        """Stop whatever a checked-out connection is running on the server, then discard the connection.
+
+        Closing the socket alone leaves the backend working until it next writes to it, so the
+        cancel request goes over a separate short-lived connection.
+        """
+        pid = conn.get_server_pid()
+        try:
+            canceller = await asyncpg.connect(self.dsn, timeout=5)
+            try:
+                await canceller.fetchval("SELECT pg_cancel_backend($1)", pid)
+            finally:
+                await canceller.close()
+            logger.info(f"Cancelled Postgres backend {pid}")
+        except Exception as e:
+            logger.warning(f"Cancelling Postgres backend {pid} failed: {str(e)}")
+        conn.terminate()
+        await self.checkin(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Check a healthy connection out of the pool for the duration of one query."""
+        conn = await self.checkout()
+        try:
+            yield conn
+        finally:
+            await self.checkin(conn)
+
+    async def health_check(self) -> dict:
+        """Report pool usage and whether the server answers a ping."""
+        pool = await self.pool()
+        try:
+            async with self.acquire() as conn:
+                await conn.fetchval("SELECT 1")
+            healthy = True
+        except Exception as e:
+            logger.error(f"Postgres health check failed: {str(e)}")
+            healthy = False
+        return {
+            "healthy": healthy,
+            "size": pool.get_size(),
+            "idle": pool.get_idle_size(),
+            "max_size": pool.get_max_size(),
+        }
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+            self._checked_at.clear()
+
+
+class PgCursor:
+    """A server-side cursor kept open between tool calls on its own pooled connection."""
+
+    def __init__(self, token: str, engine: PostgresEngine, conn, transaction, cursor, columns: list):
+        self.token = token
+        self.columns = columns
+        self.engine = engine
+        self.conn = conn
+        self.transaction = transaction
+        self.cursor = cursor
+        # Rows already read from the server but not yet returned to the caller
+        self.pending = deque()
+        self.exhausted = False
+        self.closed = False
+        self.pages = 0
+        self.rows_returned = 0
+        self.touched = time.monotonic()
+        self.lock = asyncio.Lock()
+        # (sql, page size, cache generation) when a complete single-page result may be cached
+        self.cache_key = None
+        # Called once the transaction commits, for a cursor over a write's RETURNING rows
+        self.on_commit = None
+
+    async def next_page(self, page_size: int) -> tuple[list, bool]:
+        """Return up to page_size rows and whether more remain, reading one row ahead."""
+        self.touched = time.monotonic()
+        wanted = page_size + 1 - len(self.pending)
+        if wanted > 0 and not self.exhausted:
+            chunk = await self.cursor.fetch(wanted)
+            if len(chunk) < wanted:
+                self.exhausted = True
+            self.pending.extend(chunk)
+        rows = [self.pending.popleft() for _ in range(min(page_size, len(self.pending)))]
+        self.pages += 1
+        self.rows_returned += len(rows)
+        return rows, bool(self.pending)
+
+    def push_back(self, rows: list) -> None:
+        """Return rows that were read but not shown, so the next page starts with them."""
+        self.pending.extendleft(reversed(rows))
+        self.rows_returned -= len(rows)
+
+    async def close(self, commit: bool = True) -> None:
+        """End the cursor's transaction and hand the connection back to the pool."""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        try:
+            if commit:
+                await self.transaction.commit()
+                if self.on_commit:
+                    self.on_commit()
+            else:
+                await self.transaction.rollback()
+        except Exception as e:
+            logger.warning(f"Closing cursor {self.token} failed: {str(e)}")
+            self.conn.terminate()
+        finally:
+            await self.engine.checkin(self.conn)
+
+
+BULK_OPERATIONS = ("bulk_create", "bulk_read", "bulk_update", "bulk_delete")
+
+
+def _dumps_fields(fields: list) -> str:
+    return json.dumps(fields, separators=(", ", ": "))
+
+
+def _clamp_page_size(page_size: int = None) -> int:
+    return max(1, min(page_size or PG_PAGE_SIZE, PG_MAX_PAGE_SIZE))
+
+
 class DatabaseTools:
     """Database connection and query execution tools."""
-    def __init__(self):
+    def __init__(self, pg_dsn: str = postgres_url, couch_server: str = couch_url):
         # config = load_config()
-        self.conn = psycopg2.connect(postgres_url)
-        self.couch = couchdb.Server(couch_url)
+        self.pg = PostgresEngine(pg_dsn)
+        self.couch = AsyncCouchClient(couch_server)
+        self.encoder = ResultEncoder()
+        self.catalog = SchemaCatalog(self.pg, self.couch)
+        self.cache = QueryCache(base_tables=self.catalog.base_table_names)
+        self.guard = CostGuard()
+        self.results = ResultStore()
+        self._cursors: OrderedDict[str, PgCursor] = OrderedDict()
 
-    def query_pg(self, sql: str) -> str:
-        """Execute SQL queries safely"""
+    @tracer.traced("db.query_pg")
+    async def query_pg(self, sql: str, page_size: int = None) -> str:
+        """Execute SQL queries safely, returning row sets one page at a time."""
+        await self._expire_cursors()
+        statements = split_statements(sql) or [sql]
+        cache_key = None
+        if all(is_cacheable(statement) for statement in statements):
+            cache_key = (sql, _clamp_page_size(page_size), self.cache.generation)
+            cached = self.cache.get(*cache_key[:2])
+            current_span().set(cache_hit=cached is not None)
+            if cached is not None:
+                logger.debug(f"Query cache hit: {sql}")
+                return cached
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(sql)
-
-            if cursor.description:
-                result = cursor.fetchall()
-                return "\n".join(str(row) for row in result)
+            conn = await self.pg.checkout()
+        except Exception as e:
+            return f"Query error: {str(e)}"
+        transaction = conn.transaction()
+        committed = False
+        try:
+            await self._begin(conn, transaction)
+            *leading, last = statements
+            for statement in leading:
+                statement, _ = await self.guard.review(conn, statement)
+                await conn.execute(statement)
+            last, note = await self.guard.review(conn, last)
+            stmt = await conn.prepare(last)
+            if not stmt.get_attributes():
+                await stmt.fetch()
+                await transaction.commit()
+                await self.pg.checkin(conn)
+                self._invalidate_cache(statements)
+                return f"Query executed successfully. Rows affected: {_rowcount(stmt.get_statusmsg())}"
+            if any(statement_kind(statement) != "read" for statement in leading):
+                # The cursor's transaction may stay open for minutes between pages; commit the
+                # earlier statements now instead of holding their locks and hiding their changes
+                await transaction.commit()
+                committed = True
+                self._invalidate_cache(leading)
+                transaction = conn.transaction()
+                await self._begin(conn, transaction)
+                stmt = await conn.prepare(last)
+            columns = [(a.name, a.type.name) for a in stmt.get_attributes()]
+            writes = statement_kind(last) != "read"
+            if writes:
+                # A write with RETURNING: reads that start now must not be cached as current,
+                # and what it changed is invalidated once the cursor's transaction commits
+                self.cache.generation += 1
+            cursor = PgCursor(secrets.token_hex(8), self.pg, conn, transaction, await stmt.cursor(), columns)
+            if writes:
+                cursor.on_commit = lambda: self._invalidate_cache([last])
+            # A limited result is not the answer to the query as written, so it is not cached
+            cursor.cache_key = cache_key if note is None else None
+        except asyncio.CancelledError:
+            # The MCP request was cancelled: stop the statement on the server as well
+            await asyncio.shield(self.pg.cancel(conn))
+            raise
+        except Exception as e:
+            try:
+                await transaction.rollback()
+            except Exception:
+                conn.terminate()
+            await self.pg.checkin(conn)
+            if committed:
+                applied = "the earlier statements in the batch were committed; "
+            elif len(statements) > 1:
+                applied = "the earlier statements in the batch were not applied; "
             else:
-                self.conn.commit()
-                return f"Query executed successfully. Rows affected: {cursor.rowcount}"
+                applied = ""
+            return f"Query error: {applied}{_query_error(e)}"
+        # Without an explicit page size, results larger than one page go to the result store
+        text = await self._read_page(cursor, page_size, store_source=sql if page_size is None else None)
+        return f"{text}\n{note}" if note else text
+
+    @tracer.traced("db.bulk_load_pg")
+    async def bulk_load_pg(self, table: str, columns: list[str], rows: list = None, csv_text: str = None,
+                           header: bool = False) -> str:
+        """Load rows into a table with COPY FROM STDIN, in batches that commit independently.
+
+        A batch that fails is split in half until the rows Postgres refuses are isolated, so one
+        bad row costs a few extra COPYs instead of the whole load.
+        """
+        if not columns:
+            return "Error: 'columns' is required, in the order the row values are given."
+        if (rows is None) == (csv_text is None):
+            return "Error: give the rows either as 'rows' (a JSON list) or as 'csv', not both."
+        qualified = _table_name(table)
+        if qualified is None:
+            return "Error: 'table' must be a table name, optionally schema-qualified."
+        schema, name = qualified
+        good, rejected = _copy_rows(columns, rows, csv_text, header)
+        if not good:
+            return self._load_report(table, 0, 0, rejected)
+        try:
+            conn = await self.pg.checkout()
         except Exception as e:
             return f"Query error: {str(e)}"
-        # finally:
-        #     self.conn.close()
+        loaded, batches = [], 0
+        try:
+            for start in range(0, len(good), PG_COPY_BATCH_ROWS):
+                batch = good[start:start + PG_COPY_BATCH_ROWS]
+                await self._copy_batch(conn, schema, name, columns, batch, loaded, rejected)
+                batches += 1
+        except asyncio.CancelledError:
+            await asyncio.shield(self.pg.cancel(conn))
+            raise
+        except Exception as e:
+            logger.error(f"bulk_load_pg into {table} stopped: {str(e)}")
+            # Batches before this one, and halves of it, may already be committed
+            done = set(loaded) | {number for number, _ in rejected}
+            rejected += [(number, f"not loaded: {str(e)}") for number, _ in good if number not in done]
+        await self.pg.checkin(conn)
+        if loaded:
+            self.cache.generation += 1
+            self.cache.invalidate({name.lower()})
+        current_span().set(rows_loaded=len(loaded), rows_rejected=len(rejected), batches=batches)
+        return self._load_report(table, len(loaded), batches, rejected)
+
+    async def _copy_batch(self, conn, schema: str, table: str, columns: list[str], batch: list,
+                          loaded: list, rejected: list) -> None:
+        """COPY one batch in its own transaction; on failure bisect it. Adds the row numbers to loaded or rejected."""
+        data = "".join(",".join(_csv_value(v) for v in row) + "\n" for _, row in batch).encode()
+        try:
+            async with conn.transaction():
+                if PG_STATEMENT_TIMEOUT_MS:
+                    await conn.execute(f"SET LOCAL statement_timeout = {PG_STATEMENT_TIMEOUT_MS}")
+                await conn.copy_to_table(table, source=data, columns=columns, schema_name=schema, format="csv")
+            loaded += [number for number, _ in batch]
+        except (asyncpg.PostgresError, asyncpg.DataError) as e:
+            if isinstance(e, (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError,
+                              asyncpg.InsufficientPrivilegeError, asyncpg.QueryCanceledError)):
+                # Every row would fail the same way
+                raise
+            if len(batch) == 1:
+                rejected.append((batch[0][0], str(e).splitlines()[0]))
+                return
+            if len(rejected) >= PG_COPY_MAX_REJECTS:
+                # Past the limit the bad rows are no longer isolated; the good rows in the batch are not loaded either
+                reason = f"batch abandoned after {PG_COPY_MAX_REJECTS} rejected rows: {str(e).splitlines()[0]}"
+                rejected += [(number, reason) for number, _ in batch]
+                return
+            middle = len(batch) // 2
+            await self._copy_batch(conn, schema, table, columns, batch[:middle], loaded, rejected)
+            await self._copy_batch(conn, schema, table, columns, batch[middle:], loaded, rejected)
+
+    def _load_report(self, table: str, loaded: int, batches: int, rejected: list) -> str:
+        """Summary line plus the rejected rows and why, within the output budget."""
+        lines = [f"bulk_load_pg: {loaded} rows loaded into {table} in {batches} batches, {len(rejected)} rejected"]
+        if rejected:
+            encoded = self.encoder.encode_rows([("row", "int4"), ("error", "text")], sorted(rejected))
+            lines.append(encoded.text)
+            if encoded.rows_omitted:
+                lines.append(f"-- {encoded.rows_omitted} more rejected rows not shown (output budget reached).")
+        return "\n".join(lines)
+
+    async def _begin(self, conn, transaction) -> None:
+        await transaction.start()
+        if PG_STATEMENT_TIMEOUT_MS:
+            # Scoped to this transaction, so the pooled connection goes back without it
+            await conn.execute(f"SET LOCAL statement_timeout = {PG_STATEMENT_TIMEOUT_MS}")
+
+    def _invalidate_cache(self, statements: list[str]) -> None:
+        for statement in statements:
+            self.cache.observe(statement)
+            if statement_kind(statement) == "ddl":
+                self.catalog.mark_stale(pg=True)
+
+    async def describe_schema(self, name: str = None, refresh: bool = False) -> str:
+        """Describe tables and CouchDB databases from the in-memory catalog, without querying either database."""
+        if refresh:
+            self.catalog.mark_stale(pg=True, couch=True)
+        await self.catalog.ensure_loaded()
+        text = self.catalog.describe(name)
+        if not name and len(text.encode()) > self.encoder.max_bytes:
+            return self.catalog.summary()
+        return text
+
+    def cache_stats(self) -> dict:
+        """Hit and miss counters for the query_pg read cache."""
+        return self.cache.stats()
+
+    def guard_stats(self) -> dict:
+        """Statements the cost guard rejected or limited, and its thresholds."""
+        return self.guard.stats()
+
+    async def fetch_pg_page(self, cursor_token: str, page_size: int = None) -> str:
+        """Return the next page of a result set opened by query_pg."""
+        await self._expire_cursors()
+        cursor = self._cursors.get(cursor_token)
+        if cursor is None:
+            return f"Error: Cursor '{cursor_token}' is closed or has expired. Run the query again."
+        self._cursors.move_to_end(cursor_token)
+        return await self._read_page(cursor, page_size)
+
+    async def _read_page(self, cursor: PgCursor, page_size: int = None, store_source: str = None) -> str:
+        """Format one page of rows and keep the cursor open only while rows remain.
 
-        
-    def query_couch(self, db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None) -> str:
+        With store_source set, a first page that does not hold the whole result is stored
+        out of band instead, and only a preview and the result handle are returned.
+        """
+        async with cursor.lock:
+            if cursor.closed:
+                return f"Error: Cursor '{cursor.token}' is closed or has expired. Run the query again."
+            try:
+                return await self._format_page(cursor, page_size, store_source)
+            except asyncio.CancelledError:
+                # The MCP request was cancelled mid-fetch: stop the query on the server as well
+                self._cursors.pop(cursor.token, None)
+                if not cursor.closed:
+                    cursor.closed = True
+                    await asyncio.shield(self.pg.cancel(cursor.conn))
+                raise
+
+    async def _format_page(self, cursor: PgCursor, page_size: int = None, store_source: str = None) -> str:
+        try:
+            rows, has_more = await cursor.next_page(_clamp_page_size(page_size))
+        except Exception as e:
+            self._cursors.pop(cursor.token, None)
+            await cursor.close(commit=False)
+            return f"Query error: {_query_error(e)}"
+        encoded = self.encoder.encode_rows(cursor.columns, rows)
+        if store_source and cursor.pages == 1 and (has_more or encoded.rows_omitted):
+            return await self._store_cursor(cursor, rows, store_source)
+        lines = [encoded.text]
+        if encoded.clipped:
+            # A row over the whole budget would be clipped on every page: keep it whole in the result store
+            handle = await asyncio.to_thread(self.results.save, "query_pg: oversized row", cursor.columns, rows[:1])
+            lines.append(f"-- the row above was clipped to the output budget; it is stored in full as handle='{handle}'. "
+                         f"Use result_slice with fewer columns to read it.")
+        if encoded.rows_omitted - encoded.clipped:
+            cursor.push_back(rows[encoded.rows_encoded + encoded.clipped:])
+            has_more = True
+        if has_more:
+            if cursor.token not in self._cursors:
+                await self._register_cursor(cursor)
+            if encoded.rows_omitted - encoded.clipped:
+                lines.append(
+                    f"-- {encoded.rows_omitted - encoded.clipped}{'+' if not cursor.exhausted else ''} more rows not shown "
+                    f"(output budget reached). Call fetch_pg_page with cursor_token='{cursor.token}' to continue."
+                )
+            else:
+                lines.append(
+                    f"-- page {cursor.pages}: {cursor.rows_returned} rows so far. More rows available: "
+                    f"call fetch_pg_page with cursor_token='{cursor.token}'."
+                )
+        else:
+            self._cursors.pop(cursor.token, None)
+            await cursor.close()
+            if cursor.pages == 1 and cursor.cache_key:
+                sql, variant, generation = cursor.cache_key
+                self.cache.put(sql, encoded.text, variant, generation)
+            if cursor.pages > 1:
+                lines.append(f"-- end of results: {cursor.rows_returned} rows in {cursor.pages} pages.")
+        return "\n".join(lines)
+
+    async def _store_cursor(self, cursor: PgCursor, rows: list, source: str) -> str:
+        """Drain a cursor into the result store a page at a time, up to RESULT_STORE_MAX_ROWS, and return a preview."""
+        preview, stored, has_more, handle = [], 0, True, None
+        while True:
+            if rows:
+                try:
+                    if handle is None:
+                        handle = await asyncio.to_thread(self.results.create, f"query_pg: {source}", cursor.columns)
+                    await asyncio.to_thread(self.results.append, handle, rows)
+                except Exception as e:
+                    self._cursors.pop(cursor.token, None)
+                    await cursor.close(commit=False)
+                    return f"Query error: storing the result failed: {str(e)}"
+                preview += rows[:RESULT_PREVIEW_ROWS - len(preview)]
+                stored += len(rows)
+            if not has_more or stored >= RESULT_STORE_MAX_ROWS:
+                break
+            # Only one page is held in memory at a time
+            rows, has_more = await cursor.next_page(min(PG_MAX_PAGE_SIZE, RESULT_STORE_MAX_ROWS - stored))
+        lines = [self._stored_preview(cursor.columns, preview, stored, handle)]
+        if has_more:
+            if cursor.token not in self._cursors:
+                await self._register_cursor(cursor)
+            lines.append(f"-- the result has more than {stored} rows; only those were stored. "
+                         f"Call fetch_pg_page with cursor_token='{cursor.token}' for the rest.")
+        else:
+            self._cursors.pop(cursor.token, None)
+            await cursor.close()
+        return "\n".join(lines)
+
+    def _stored_preview(self, columns: list, preview: list, total: int, handle: str) -> str:
+        """First rows of a stored result plus how to reach the rest without re-sending it."""
+        encoded = self.encoder.encode_rows(columns, preview[:RESULT_PREVIEW_ROWS])
+        return (f"{encoded.text}\n-- {total} rows stored as handle='{handle}'; showing the first {encoded.rows_encoded}. "
+                f"Use result_slice, result_filter or result_aggregate with this handle instead of re-running the query.")
+
+    async def _store_rows(self, source: str, columns: list, rows: list) -> str:
+        """Store rows that did not fit the output budget; returns the preview, or None if storing failed."""
+        try:
+            handle = await asyncio.to_thread(self.results.save, source, columns, rows[:RESULT_STORE_MAX_ROWS])
+        except Exception as e:
+            logger.error(f"Storing result from {source} failed: {str(e)}")
+            return None
+        return self._stored_preview(columns, rows, len(rows), handle)
+
+    async def result_slice(self, handle: str, offset: int = 0, limit: int = None, columns: list[str] = None,
+                           order_by: str = None, descending: bool = False) -> str:
+        """Return a window of rows from a stored result."""
+        return await self._stored_rows(handle, offset, limit, columns, None, order_by, descending)
+
+    async def result_filter(self, handle: str, where: list, columns: list[str] = None, limit: int = None,
+                            offset: int = 0, order_by: str = None, descending: bool = False) -> str:
+        """Return stored rows matching every [column, operator, value] condition."""
+        if not where:
+            return "Error: 'where' is required, as a list of [column, operator, value] conditions."
+        return await self._stored_rows(handle, offset, limit, columns, where, order_by, descending)
+
+    async def _stored_rows(self, handle: str, offset: int, limit: int, columns: list[str], where: list,
+                           order_by: str, descending: bool) -> str:
+        offset = max(0, offset or 0)
+        try:
+            chosen, rows, total = await asyncio.to_thread(
+                self.results.rows, handle, offset, _clamp_page_size(limit), columns, where, order_by, descending
+            )
+        except Exception as e:
+            return f"Error: {str(e)}"
+        encoded = self.encoder.encode_rows(chosen, rows)
+        shown = encoded.rows_encoded + encoded.clipped if rows else 0
+        lines = [encoded.text, f"-- rows {offset + 1}-{offset + shown} of {total}" if shown else f"-- no rows at offset {offset} of {total}"]
+        if encoded.clipped:
+            lines[-1] += f"; row {offset + shown} was clipped to the output budget, ask for fewer columns to see it whole"
+        if offset + shown < total:
+            lines[-1] += f"; call again with offset={offset + shown} for more."
+        return "\n".join(lines)
+
+    async def result_aggregate(self, handle: str, metrics: list[str], group_by: list[str] = None,
+                               where: list = None) -> str:
+        """Count, sum, average, min or max a stored result, optionally grouped and filtered."""
+        try:
+            columns, rows, groups = await asyncio.to_thread(
+                self.results.aggregate, handle, metrics, group_by, where, PG_MAX_PAGE_SIZE
+            )
+        except Exception as e:
+            return f"Error: {str(e)}"
+        encoded = self.encoder.encode_rows(columns, rows)
+        lines = [encoded.text]
+        if groups > encoded.rows_encoded:
+            lines.append(f"-- {groups - encoded.rows_encoded} more groups not shown; filter or group more coarsely.")
+        return "\n".join(lines)
+
+    async def _register_cursor(self, cursor: PgCursor) -> None:
+        """Keep a cursor open, closing the least recently used one beyond the limit."""
+        idle = [c for c in self._cursors.values() if not c.lock.locked()]
+        for oldest in idle[:max(0, len(self._cursors) - PG_MAX_OPEN_CURSORS + 1)]:
+            self._cursors.pop(oldest.token, None)
+            logger.info(f"Closing cursor {oldest.token} to make room for {cursor.token}")
+            await oldest.close()
+        self._cursors[cursor.token] = cursor
+
+    async def _expire_cursors(self) -> None:
+        """Close cursors that have sat idle longer than PG_CURSOR_IDLE_TIMEOUT."""
+        now = time.monotonic()
+        for token, cursor in list(self._cursors.items()):
+            if now - cursor.touched > PG_CURSOR_IDLE_TIMEOUT and not cursor.lock.locked():
+                self._cursors.pop(token, None)
+                logger.info(f"Cursor {token} expired after {PG_CURSOR_IDLE_TIMEOUT}s idle")
+                await cursor.close()
+
+    @tracer.traced("db.query_couch")
+    async def query_couch(self, db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None,
+                          docs: list[dict] = None, doc_ids: list[str] = None, limit: int = None, fields: list[str] = None,
+                          bookmark: str = None, view: str = None) -> str:
         """
         Perform CRUD operations on CouchDB documents in a specific database.
 
+        The bulk_* operations handle many documents per call: bulk_create and bulk_update take
+        docs, bulk_read and bulk_delete take doc_ids. Mango reads are limited, can project fields
+        and continue from a bookmark; create_index and list_indexes manage Mango indexes.
+        The view operation aggregates inside CouchDB through map/reduce views, which define_view
+        and list_views manage.
         """
-        logger.info(f"Performing operation '{operation}' on CouchDB database '{db_name}' - doc_id: {doc_id}, query: {query}, data: {data}")
+        logger.info(f"Performing operation '{operation}' on CouchDB database '{db_name}' - doc_id: {doc_id}, query: {query}, data: {data}, "
+                    f"docs: {len(docs or [])}, doc_ids: {len(doc_ids or [])}")
 
         try:
-            # Check if the database exists
-            if db_name not in self.couch:
+            # Check if the database exists (cached, so usually no extra round trip)
+            if not await self.couch.db_exists(db_name):
                 return f"Error: Database '{db_name}' does not exist."
 
-            db = self.couch[db_name]
-
             if operation == "read":
                 if doc_id:
                     # Fetch a specific document by ID
                     try:
-                        doc = db[doc_id]
-                        return str(doc)
-                    except couchdb.ResourceNotFound:
+                        doc = await self.couch.get_doc(db_name, doc_id)
+                        return self.encoder.encode_docs([doc]).text
+                    except CouchError as e:
+                        if e.status != 404 or e.missing_db:
+                            raise
                         return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
                 else:
                     # Use mango query to list documents
                     try:
-                        results = db.find(query)
-                        return "\n".join(str(doc) for doc in results)
-                    except Exception as e:
+                        return await self._find_couch(db_name, query, limit, fields, bookmark)
+                    except CouchError as e:
                         logger.error(f"Error querying CouchDB: {str(e)}")
                         return f"Error: {str(e)}"
 
@@ -87,36 +775,229 @@ class DatabaseTools:
                 if not data:
                     return "Error: 'data' is required for create operation."
                 # Create a new document
-                doc_id, doc_rev = db.save(data)
+                doc_id, doc_rev = await self.couch.save(db_name, data)
                 return f"Document created with ID: {doc_id} and revision: {doc_rev}"
 
             elif operation == "update":
                 if not doc_id or not data:
                     return "Error: 'doc_id' and 'data' are required for update operation."
-                # Fetch the existing document
+                # Fetch the existing document and save the merged copy
                 try:
-                    doc = db[doc_id]
-                    doc.update(data)
-                    db.save(doc)
+                    await self.couch.update(db_name, doc_id, data)
                     return f"Document with ID '{doc_id}' updated successfully."
-                except couchdb.ResourceNotFound:
+                except CouchError as e:
+                    if e.status == 409:
+                        return f"Error: Document with ID '{doc_id}' was changed concurrently; read it again and retry."
+                    if e.status != 404 or e.missing_db:
+                        raise
                     return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
 
             elif operation == "delete":
                 if not doc_id:
                     return "Error: 'doc_id' is required for delete operation."
-                # Fetch the existing document
                 try:
-                    doc = db[doc_id]
-                    db.delete(doc)
+                    await self.couch.delete(db_name, doc_id)
                     return f"Document with ID '{doc_id}' deleted successfully."
-                except couchdb.ResourceNotFound:
+                except CouchError as e:
+                    if e.status != 404 or e.missing_db:
+                        raise
                     return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
 
+            elif operation == "create_index":
+                if not data or not data.get("fields"):
+                    return "Error: 'data' with a 'fields' list is required for create_index operation."
+                result = await self.couch.create_index(
+                    db_name, data["fields"], data.get("name"), data.get("ddoc"), data.get("partial_filter_selector")
+                )
+                self.catalog.mark_stale(couch=True)
+                return f"Index '{result['name']}' on {data['fields']}: {result['result']} (design doc '{result['id']}')."
+
+            elif operation == "list_indexes":
+                indexes = await self.couch.list_indexes(db_name)
+                return "\n".join(
+                    f"{ix['name']}\t{ix['type']}\t{_dumps_fields(ix.get('def', {}).get('fields', []))}" for ix in indexes
+                )
+
+            elif operation in BULK_OPERATIONS:
+                return await self._bulk_couch(db_name, operation, docs, doc_ids)
+
+            elif operation == "view":
+                return await self._query_view(db_name, view, query, limit)
+
+            elif operation == "define_view":
+                required = ("design", "view", "map")
+                if not data or any(not data.get(k) for k in required):
+                    return "Error: 'data' with 'design', 'view' and 'map' (plus optional 'reduce') is required for define_view operation."
+                reduce_fn = data.get("reduce")
+                if reduce_fn and reduce_fn.startswith("_") and reduce_fn not in BUILTIN_REDUCES:
+                    return f"Error: Unknown built-in reduce '{reduce_fn}'. Use one of {', '.join(sorted(BUILTIN_REDUCES))}."
+                rev = await self.couch.put_view(db_name, data["design"], data["view"], data["map"], reduce_fn)
+                self.catalog.mark_stale(couch=True)
+                return f"View '{data['design']}/{data['view']}' saved (design doc revision {rev})."
+
+            elif operation == "list_views":
+                lines = []
+                for ddoc in await self.couch.design_docs(db_name):
+                    design = ddoc["_id"][len("_design/"):]
+                    for name, definition in ddoc.get("views", {}).items():
+                        lines.append(f"{design}/{name}\treduce={definition.get('reduce', 'none')}\tmap={definition.get('map', '')}")
+                return "\n".join(lines) or f"-- no views defined in '{db_name}'."
+
             else:
-                return f"Error: Invalid operation '{operation}'. Supported operations: 'create', 'read', 'update', 'delete'."
+                return (f"Error: Invalid operation '{operation}'. Supported operations: 'create', 'read', 'update', 'delete', "
+                        f"'create_index', 'list_indexes', 'view', 'define_view', 'list_views', "
+                        f"{', '.join(repr(op) for op in BULK_OPERATIONS)}.")
 
+        except CouchError as e:
+            if e.missing_db:
+                return f"Error: Database '{db_name}' does not exist."
+            logger.error(f"CouchDB error: {str(e)}")
+            return f"Error: {str(e)}"
         except Exception as e:
             logger.error(f"Failed to connect to CouchDB: {str(e)}")
             return f"Error: Failed to connect to CouchDB. {str(e)}"
-    
\ No newline at end of file
+
+    async def _find_couch(self, db_name: str, query: dict = None, limit: int = None, fields: list[str] = None,
+                          bookmark: str = None) -> str:
+        """Run a bounded Mango query, checking its plan first so full scans of large databases are refused."""
+        mango = dict(query or {})
+        if "selector" not in mango:
+            mango = {"selector": mango}
+        mango["limit"] = max(1, min(limit or mango.get("limit") or COUCH_FIND_LIMIT, COUCH_MAX_FIND_LIMIT))
+        if fields:
+            mango["fields"] = fields
+        if bookmark:
+            mango["bookmark"] = bookmark
+
+        notes = []
+        if mango["selector"] or mango.get("sort"):
+            plan = await self.couch.explain(db_name, mango)
+            if plan.get("index", {}).get("type") == "special":
+                suggested = selector_fields(mango["selector"]) or [
+                    next(iter(s)) if isinstance(s, dict) else s for s in mango.get("sort", [])
+                ]
+                doc_count = (await self.couch.db_info(db_name)).get("doc_count", 0)
+                create_hint = f"call query_couch with operation='create_index' and data={{'fields': {_dumps_fields(suggested)}}}"
+                if doc_count > COUCH_UNINDEXED_MAX_DOCS:
+                    return (f"Error: No index covers this selector and '{db_name}' has {doc_count} documents, "
+                            f"so CouchDB would scan all of them. To create one, {create_hint}, then retry.")
+                notes.append(f"-- warning: no index covers this selector, so all {doc_count} documents are scanned. "
+                             f"To add one, {create_hint}.")
+
+        results = await self.couch.find(db_name, mango)
+        found = results.get("docs", [])
+        lines = [await self._encode_docs(found, f"query_couch {db_name} find")] if found else ["-- no matching documents."]
+        if len(found) == mango["limit"] and results.get("bookmark"):
+            lines.append(f"-- {len(found)} documents shown; more may match. "
+                         f"Call again with bookmark='{results['bookmark']}' to continue.")
+        return "\n".join(lines + notes)
+
+    async def _query_view(self, db_name: str, view: str = None, params: dict = None, limit: int = None) -> str:
+        """Query a view so counting, summing and grouping happen inside CouchDB."""
+        if not view or view.count("/") != 1:
+            return "Error: 'view' is required for view operation, as 'design_name/view_name'."
+        params = dict(params or {})
+        unknown = set(params) - VIEW_PARAMS
+        if unknown:
+            return f"Error: Unsupported view parameters: {', '.join(sorted(unknown))}. Supported: {', '.join(sorted(VIEW_PARAMS))}."
+        if limit:
+            params["limit"] = limit
+        params.setdefault("limit", COUCH_VIEW_LIMIT)
+        design, view_name = view.split("/")
+        try:
+            result = await self.couch.query_view(db_name, design, view_name, params)
+        except CouchError as e:
+            if e.status == 404 and not e.missing_db:
+                return f"Error: View '{view}' not found in database '{db_name}'. Define it with operation='define_view'."
+            raise
+        rows = result.get("rows", [])
+        with_ids = any("id" in row for row in rows)
+        columns = ([("id", "text")] if with_ids else []) + [("key", "json"), ("value", "json")]
+        if params.get("include_docs"):
+            columns.append(("doc", "json"))
+        values = [([row.get("id")] if with_ids else []) + [row.get("key"), row.get("value")]
+                  + ([row.get("doc")] if params.get("include_docs") else []) for row in rows]
+        encoded = self.encoder.encode_rows(columns, values)
+        lines = [encoded.text]
+        if encoded.rows_omitted:
+            stored = await self._store_rows(f"query_couch {db_name} view {view}", columns, values)
+            lines = [stored] if stored else lines + [f"-- {encoded.rows_omitted} more rows not shown (output budget reached)."]
+        if len(rows) == params["limit"]:
+            lines.append(f"-- {len(rows)} rows returned (limit); more may exist. Use skip or startkey to continue.")
+        return "\n".join(lines)
+
+    async def _bulk_couch(self, db_name: str, operation: str, docs: list[dict] = None, doc_ids: list[str] = None) -> str:
+        """Run a bulk operation with one _all_docs and/or _bulk_docs request per batch."""
+        if operation in ("bulk_create", "bulk_update") and not docs:
+            return f"Error: 'docs' is required for {operation} operation."
+        if operation in ("bulk_read", "bulk_delete") and not doc_ids:
+            return f"Error: 'doc_ids' is required for {operation} operation."
+
+        if operation == "bulk_read":
+            rows = await self.couch.all_docs(db_name, doc_ids, include_docs=True)
+            found = [row["doc"] for row in rows if row.get("doc")]
+            missing = [row["key"] for row in rows if not row.get("doc")]
+            result = await self._encode_docs(found, f"query_couch {db_name} bulk_read")
+            if missing:
+                result += f"\n-- not found: {', '.join(missing)}"
+            return result
+
+        report = []
+        if operation == "bulk_create":
+            writes = docs
+        elif operation == "bulk_update":
+            if any("_id" not in doc for doc in docs):
+                return "Error: every document in 'docs' needs an '_id' for bulk_update."
+            rows = await self.couch.all_docs(db_name, [doc["_id"] for doc in docs], include_docs=True)
+            current = {row["key"]: row["doc"] for row in rows if row.get("doc")}
+            writes = []
+            for doc in docs:
+                if doc["_id"] in current:
+                    writes.append({**current[doc["_id"]], **{k: v for k, v in doc.items() if k != "_rev"}})
+                else:
+                    report.append((doc["_id"], "error", "not_found"))
+        else:
+            rows = await self.couch.all_docs(db_name, doc_ids)
+            writes = []
+            for row in rows:
+                if "value" in row and not row["value"].get("deleted"):
+                    writes.append({"_id": row["id"], "_rev": row["value"]["rev"], "_deleted": True})
+                else:
+                    report.append((row["key"], "error", "not_found"))
+
+        results = await self.couch.bulk_docs(db_name, writes) if writes else []
+        for result in results:
+            if "error" in result:
+                report.append((result.get("id"), "error", f"{result['error']}: {result.get('reason', '')}"))
+            else:
+                report.append((result["id"], "ok", result["rev"]))
+        return self._bulk_report(operation, report)
+
+    def _bulk_report(self, operation: str, report: list[tuple]) -> str:
+        """Summary line plus one row per document, failures first so they survive the output budget."""
+        failed = [row for row in report if row[1] != "ok"]
+        succeeded = [row for row in report if row[1] == "ok"]
+        encoded = self.encoder.encode_rows([("id", "text"), ("status", "text"), ("detail", "text")], failed + succeeded)
+        lines = [f"{operation}: {len(succeeded)} succeeded, {len(failed)} failed", encoded.text]
+        if encoded.rows_omitted:
+            lines.append(f"-- {encoded.rows_omitted} more documents not shown (output budget reached).")
+        return "\n".join(lines)
+
+    async def _encode_docs(self, docs: list[dict], source: str) -> str:
+        """Encode documents within the output budget; when they do not all fit, store them and show a preview."""
+        encoded = self.encoder.encode_docs(docs)
+        if encoded.rows_omitted:
+            columns = doc_columns(docs)
+            stored = await self._store_rows(source, columns, [[doc.get(c) for c, _ in columns] for doc in docs])
+            if stored:
+                return stored
+            return f"{encoded.text}\n-- {encoded.rows_omitted} more documents not shown (output budget reached)."
+        return encoded.text
+
+    async def close(self) -> None:
+        for cursor in list(self._cursors.values()):
+            await cursor.close()
+        self._cursors.clear()
+        await self.pg.close()
+        await self.couch.close()
+        self.results.close()
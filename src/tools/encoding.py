@@ -0,0 +1,104 @@
+import datetime
+import decimal
+import json
+import os
+import uuid
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tool result encoding settings
+TOOL_RESULT_FORMAT = os.getenv("TOOL_RESULT_FORMAT", "tsv")  # "tsv" or "jsonl"
+TOOL_RESULT_MAX_TOKENS = int(os.getenv("TOOL_RESULT_MAX_TOKENS", "4000"))
+TOOL_RESULT_MAX_BYTES = int(os.getenv("TOOL_RESULT_MAX_BYTES", "0")) or None
+# Rough bytes-per-token ratio used to turn a token budget into a byte budget
+BYTES_PER_TOKEN = 4
+
+_TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+@dataclass
+class EncodedResult:
+    text: str
+    rows_encoded: int
+    rows_omitted: int
+    # The text ends with a clipped copy of the first omitted row, which alone is over the budget
+    clipped: bool = False
+
+
+def _json_default(value):
+    """Serialize the non-JSON types asyncpg and CouchDB hand back."""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    return str(value)
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False, default=_json_default)
+
+
+def _tsv_cell(value) -> str:
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (dict, list, tuple)):
+        return _dumps(value).translate(_TSV_ESCAPES)
+    if isinstance(value, (bytes, bytearray, memoryview, datetime.date, datetime.time)):
+        return _json_default(value)
+    return str(value).translate(_TSV_ESCAPES)
+
+
+class ResultEncoder:
+    """Dense, budget-limited encoding of query results for tool output."""
+
+    def __init__(self, fmt: str = TOOL_RESULT_FORMAT, max_tokens: int = TOOL_RESULT_MAX_TOKENS,
+                 max_bytes: int = TOOL_RESULT_MAX_BYTES):
+        if fmt not in ("tsv", "jsonl"):
+            raise ValueError(f"Unsupported result format '{fmt}'. Use 'tsv' or 'jsonl'.")
+        self.fmt = fmt
+        self.max_bytes = max_bytes or max_tokens * BYTES_PER_TOKEN
+
+    def header(self, columns: list[tuple[str, str]]) -> str:
+        """Column names and types, written once ahead of the rows."""
+        if self.fmt == "jsonl":
+            return _dumps({"columns": [name for name, _ in columns], "types": [t for _, t in columns]})
+        return "\t".join(f"{name}:{type_name}" for name, type_name in columns)
+
+    def row(self, values) -> str:
+        if self.fmt == "jsonl":
+            return _dumps(list(values))
+        return "\t".join(_tsv_cell(v) for v in values)
+
+    def encode_rows(self, columns: list[tuple[str, str]], rows: list) -> EncodedResult:
+        """Encode a header plus as many rows as fit in the budget."""
+        return self._fill([self.header(columns)], [self.row(r) for r in rows])
+
+    def encode_docs(self, docs: list[dict]) -> EncodedResult:
+        """Encode documents as compact JSON lines, as many as fit in the budget."""
+        return self._fill([], [_dumps(doc) for doc in docs])
+
+    def _fill(self, lines: list[str], candidates: list[str]) -> EncodedResult:
+        used = sum(len(line.encode()) + 1 for line in lines)
+        encoded, clipped = 0, False
+        for line in candidates:
+            size = len(line.encode()) + 1
+            if used + size > self.max_bytes:
+                if encoded == 0:
+                    # Show a clipped first row rather than nothing; it still counts as omitted
+                    room = max(self.max_bytes - used, 0)
+                    lines.append(line.encode()[:room].decode(errors="ignore") + " …[truncated]")
+                    clipped = True
+                break
+            lines.append(line)
+            used += size
+            encoded += 1
+        return EncodedResult("\n".join(lines), encoded, len(candidates) - encoded, clipped)
@@ -0,0 +1,175 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+# Read cache settings for query_pg
+PG_CACHE_MAX_ENTRIES = int(os.getenv("PG_CACHE_MAX_ENTRIES", "256"))
+PG_CACHE_TTL = float(os.getenv("PG_CACHE_TTL", "60"))
+
+READ_KEYWORDS = {"select", "with", "values", "table", "show", "explain"}
+WRITE_KEYWORDS = {"insert", "update", "delete", "merge", "copy"}
+DDL_KEYWORDS = {"create", "alter", "drop", "truncate", "rename", "comment", "grant", "revoke"}
+# Functions whose result changes between calls even when the data does not
+VOLATILE_FUNCTIONS = re.compile(
+    r"\b(now|random|nextval|setval|currval|clock_timestamp|statement_timestamp|timeofday|"
+    r"gen_random_uuid|uuid_generate_v\d|txid_current|pg_sleep)\s*\(|\bcurrent_(timestamp|time|date)\b"
+)
+_TABLE_CLAUSE = re.compile(
+    r"\b(?:from|join|into|update|table|truncate)\s+(?:if\s+(?:not\s+)?exists\s+)?(?:only\s+)?"
+    r"((?:[\w\"]+\.)?[\w\"]+(?:\s*(?:as\s+)?[\w\"]+)?(?:\s*,\s*(?:[\w\"]+\.)?[\w\"]+(?:\s*(?:as\s+)?[\w\"]+)?)*)"
+)
+_CLAUSE_WORDS = {
+    "where", "group", "order", "limit", "offset", "having", "join", "inner", "left", "right", "full",
+    "cross", "natural", "on", "using", "union", "except", "intersect", "set", "values", "select",
+    "returning", "window", "fetch", "for", "lateral", "as", "default",
+}
+
+
+def _strip_literals(sql: str) -> str:
+    """Blank out string literals so keywords inside them are not matched."""
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and case outside string literals; drop trailing semicolons."""
+    parts = re.split(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")", sql.strip().rstrip(";").strip())
+    normalized = []
+    for i, part in enumerate(parts):
+        normalized.append(part if i % 2 else re.sub(r"\s+", " ", part).lower())
+    return "".join(normalized).strip()
+
+
+# EXPLAIN's options; with ANALYZE the explained statement really runs
+_EXPLAIN = re.compile(r"explain\s*(?:\(([^)]*)\)|((?:(?:analy[sz]e|verbose)\s+)*))\s*(.*)")
+
+
+def statement_kind(sql: str) -> str:
+    """Classify a single statement as 'read', 'write', 'ddl' or 'other'."""
+    text = _strip_literals(normalize_sql(sql))
+    words = text.split(" ", 1)
+    first = words[0] if words else ""
+    explain = _EXPLAIN.fullmatch(text) if first == "explain" else None
+    if explain and re.search(r"\banaly[sz]e\b(?!\s+(?:false|off|0)\b)", explain.group(1) or explain.group(2)):
+        return statement_kind(explain.group(3))
+    if first in READ_KEYWORDS:
+        if re.search(r"\b(insert|update|delete|merge)\b", text) and first == "with":
+            return "write"
+        if re.search(r"\binto\b", text) and first == "select":
+            return "write"
+        return "read"
+    if first in WRITE_KEYWORDS:
+        return "write"
+    if first in DDL_KEYWORDS:
+        return "ddl"
+    return "other"
+
+
+def is_cacheable(sql: str) -> bool:
+    """Only plain reads that give the same answer for the same data are cached."""
+    text = _strip_literals(normalize_sql(sql))
+    return (
+        statement_kind(sql) == "read"
+        and not text.startswith(("explain analyze", "show"))
+        and not re.search(r"\bfor (update|share|no key update|key share)\b", text)
+        and not VOLATILE_FUNCTIONS.search(text)
+    )
+
+
+def referenced_tables(sql: str) -> set[str]:
+    """Best-effort set of table names a statement reads or writes, without schema or quotes."""
+    text = _strip_literals(normalize_sql(sql))
+    tables = set()
+    for match in _TABLE_CLAUSE.finditer(text):
+        for item in match.group(1).split(","):
+            name = item.strip().split(" ")[0]
+            if not name or name in _CLAUSE_WORDS or name.startswith("("):
+                continue
+            tables.add(name.replace('"', "").split(".")[-1])
+    return tables
+
+
+class QueryCache:
+    """LRU cache of query_pg results with a TTL, invalidated by writes to the tables they read.
+
+    A read can only be tied to the tables it names when those are all known base tables.
+    Reads of views, functions or anything unknown may depend on any table, so every write
+    invalidates them.
+    """
+
+    def __init__(self, max_entries: int = PG_CACHE_MAX_ENTRIES, ttl: float = PG_CACHE_TTL,
+                 base_tables: Callable[[], set[str]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Names of the database's base tables, or None while they are unknown
+        self.base_tables = base_tables or (lambda: None)
+        # key -> (stored_at, tables, value); tables is None when the read could depend on any table
+        self._entries: OrderedDict[tuple, tuple[float, set[str], str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Bumped on every write so results read before it are not stored afterwards
+        self.generation = 0
+
+    def get(self, sql: str, variant=None):
+        key = (normalize_sql(sql), variant)
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, sql: str, value: str, variant=None, generation: int = None) -> None:
+        if self.max_entries <= 0 or (generation is not None and generation != self.generation):
+            return
+        key = (normalize_sql(sql), variant)
+        tables, known = referenced_tables(sql), self.base_tables()
+        if known is None or not tables <= known:
+            tables = None
+        self._entries[key] = (time.monotonic(), tables, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tables: set[str] = None) -> None:
+        """Drop entries that read any of the given tables or an unresolved relation, or everything when tables is None."""
+        if tables is None:
+            dropped = len(self._entries)
+            self._entries.clear()
+        else:
+            stale = [key for key, (_, read, _) in self._entries.items() if read is None or read & tables]
+            for key in stale:
+                del self._entries[key]
+            dropped = len(stale)
+        if dropped:
+            self.invalidations += dropped
+            logger.debug(f"Query cache invalidated {dropped} entries for tables {tables or 'all'}")
+
+    def observe(self, sql: str) -> None:
+        """Invalidate whatever a statement that just ran may have changed."""
+        kind = statement_kind(sql)
+        if kind == "read":
+            return
+        self.generation += 1
+        tables = referenced_tables(sql) if kind in ("write", "ddl") else set()
+        self.invalidate(tables or None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self._entries),
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,218 @@
+import atexit
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+from loguru import logger
+
+from .encoding import _json_default
+
+load_dotenv()
+
+# Out-of-band store for results too large to return in full; each store gets its own file,
+# named after this path with the process id added, and removes it on exit
+RESULT_STORE_PATH = os.getenv("RESULT_STORE_PATH", os.path.join("logs", "result_store.sqlite3"))
+RESULT_STORE_MAX_ROWS = int(os.getenv("RESULT_STORE_MAX_ROWS", "50000"))
+RESULT_STORE_MAX_RESULTS = int(os.getenv("RESULT_STORE_MAX_RESULTS", "50"))
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", "20"))
+
+FILTER_OPERATORS = {"=", "!=", "<", "<=", ">", ">=", "like", "not like", "in", "not in", "is null", "is not null"}
+AGGREGATES = {"count", "count_distinct", "sum", "avg", "min", "max"}
+_NUMERIC_TYPES = ("int", "numeric", "decimal", "float", "double", "real", "money", "serial")
+
+
+def _affinity(type_name: str) -> str:
+    return "NUMERIC" if any(t in type_name.lower() for t in _NUMERIC_TYPES) else "TEXT"
+
+
+def _cell(value):
+    """A value SQLite can store; nested values are kept as JSON text."""
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, separators=(",", ":"), default=_json_default)
+    return _json_default(value)
+
+
+def doc_columns(docs: list[dict]) -> list[tuple[str, str]]:
+    """Top-level document keys in first-seen order, typed numeric when every value is a number."""
+    names: dict[str, bool] = {}
+    for doc in docs:
+        for key, value in doc.items():
+            numeric = value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+            names[key] = names.get(key, True) and numeric
+    return [(name, "numeric" if numeric else "json") for name, numeric in names.items()]
+
+
+class ResultStore:
+    """SQLite-backed store of large tool results, addressed by a short handle.
+
+    Each result is one table; rows are only ever returned through bounded slice,
+    filter and aggregate reads, so the full result is never sent to the model.
+    Handles only mean something to the server that made them, so every store keeps
+    its own file: eviction never reaches another session's results, and concurrent
+    servers do not wait on each other's write lock.
+    """
+
+    def __init__(self, path: str = RESULT_STORE_PATH, max_results: int = RESULT_STORE_MAX_RESULTS):
+        if path != ":memory:":
+            root, ext = os.path.splitext(path)
+            path = f"{root}.{os.getpid()}.{secrets.token_hex(2)}{ext}"
+        self.path = path
+        self.max_results = max_results
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            atexit.register(self.close)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (handle TEXT PRIMARY KEY, source TEXT, columns TEXT, "
+                "row_count INTEGER, created_at REAL)"
+            )
+        return self._conn
+
+    def save(self, source: str, columns: list[tuple[str, str]], rows: list) -> str:
+        """Store rows under a new handle, evicting the oldest results beyond max_results."""
+        handle = self.create(source, columns)
+        self.append(handle, rows)
+        return handle
+
+    def create(self, source: str, columns: list[tuple[str, str]]) -> str:
+        """Register an empty result to fill with append, evicting the oldest results beyond max_results."""
+        handle = f"r_{secrets.token_hex(4)}"
+        with self._lock:
+            db = self._db()
+            definitions = ", ".join(f"c{i} {_affinity(t)}" for i, (_, t) in enumerate(columns))
+            db.execute(f"CREATE TABLE {handle} ({definitions})")
+            db.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?)",
+                       (handle, source, json.dumps(columns), 0, time.time()))
+            for (old,) in db.execute("SELECT handle FROM results ORDER BY created_at DESC LIMIT -1 OFFSET ?",
+                                     (self.max_results,)).fetchall():
+                db.execute(f"DROP TABLE IF EXISTS {old}")
+                db.execute("DELETE FROM results WHERE handle = ?", (old,))
+            db.commit()
+        return handle
+
+    def append(self, handle: str, rows: list) -> None:
+        """Add a chunk of rows to a result made by create."""
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT columns FROM results WHERE handle = ?", (handle,)).fetchone()
+            if row is None:
+                raise ValueError(f"Unknown result handle '{handle}'.")
+            width = len(json.loads(row[0]))
+            db.executemany(
+                f"INSERT INTO {handle} VALUES ({', '.join('?' * width)})",
+                ([_cell(v) for v in row] for row in rows),
+            )
+            db.execute("UPDATE results SET row_count = row_count + ? WHERE handle = ?", (len(rows), handle))
+            db.commit()
+        logger.info(f"Stored {len(rows)} rows in result {handle}")
+
+    def info(self, handle: str) -> tuple[str, list[tuple[str, str]], int]:
+        """(source, columns, row_count) for a handle; ValueError if it is unknown."""
+        with self._lock:
+            row = self._db().execute("SELECT source, columns, row_count FROM results WHERE handle = ?",
+                                     (handle,)).fetchone()
+        if row is None:
+            raise ValueError(f"Unknown result handle '{handle}'. It may have been evicted; run the query again.")
+        return row[0], [tuple(c) for c in json.loads(row[1])], row[2]
+
+    def _column(self, columns: list[tuple[str, str]], name: str) -> str:
+        for i, (column, _) in enumerate(columns):
+            if column == name:
+                return f"c{i}"
+        raise ValueError(f"Unknown column '{name}'. Columns: {', '.join(c for c, _ in columns)}.")
+
+    def _where(self, columns: list[tuple[str, str]], where: list) -> tuple[str, list]:
+        """SQL for a list of [column, operator, value] conditions, all of which must hold."""
+        clauses, params = [], []
+        for condition in where or []:
+            if not isinstance(condition, (list, tuple)) or len(condition) not in (2, 3):
+                raise ValueError(f"Each condition must be [column, operator, value]; got {condition!r}.")
+            column, op, value = (list(condition) + [None])[:3]
+            op = str(op).lower()
+            if op not in FILTER_OPERATORS:
+                raise ValueError(f"Unsupported operator '{op}'. Supported: {', '.join(sorted(FILTER_OPERATORS))}.")
+            target = self._column(columns, column)
+            if op in ("is null", "is not null"):
+                clauses.append(f"{target} {op.upper()}")
+            elif op in ("in", "not in"):
+                values = value if isinstance(value, list) else [value]
+                clauses.append(f"{target} {op.upper()} ({', '.join('?' * len(values))})")
+                params += [_cell(v) for v in values]
+            else:
+                clauses.append(f"{target} {op.upper()} ?")
+                params.append(_cell(value))
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _select(self, columns: list[tuple[str, str]], names: list[str] = None) -> tuple[str, list]:
+        names = names or [name for name, _ in columns]
+        selected = ", ".join(self._column(columns, name) for name in names)
+        types = dict(columns)
+        return selected, [(name, types[name]) for name in names]
+
+    def rows(self, handle: str, offset: int = 0, limit: int = RESULT_PREVIEW_ROWS, columns: list[str] = None,
+             where: list = None, order_by: str = None, descending: bool = False) -> tuple[list, list, int]:
+        """A window of stored rows, optionally filtered and sorted; returns (columns, rows, total matching)."""
+        _, stored, _ = self.info(handle)
+        selected, chosen = self._select(stored, columns)
+        condition, params = self._where(stored, where)
+        order = f" ORDER BY {self._column(stored, order_by)}{' DESC' if descending else ''}" if order_by else " ORDER BY rowid"
+        with self._lock:
+            db = self._db()
+            total = db.execute(f"SELECT COUNT(*) FROM {handle}{condition}", params).fetchone()[0]
+            rows = db.execute(f"SELECT {selected} FROM {handle}{condition}{order} LIMIT ? OFFSET ?",
+                              params + [max(0, limit), max(0, offset)]).fetchall()
+        return chosen, rows, total
+
+    def aggregate(self, handle: str, metrics: list[str], group_by: list[str] = None, where: list = None,
+                  limit: int = 100) -> tuple[list, list, int]:
+        """Grouped aggregates such as "count", "sum:amount" or "count_distinct:user_id"; returns (columns, rows, groups)."""
+        _, stored, _ = self.info(handle)
+        if not metrics:
+            raise ValueError("At least one metric is required, e.g. [\"count\", \"sum:amount\"].")
+        keys, key_columns = self._select(stored, group_by) if group_by else ("", [])
+        expressions, output = [], list(key_columns)
+        for metric in metrics:
+            function, _, column = metric.partition(":")
+            function = function.lower()
+            if function not in AGGREGATES:
+                raise ValueError(f"Unsupported metric '{metric}'. Use one of {', '.join(sorted(AGGREGATES))}, "
+                                 f"with ':column' except for count.")
+            if function == "count" and not column:
+                expressions.append("COUNT(*)")
+            elif function == "count_distinct":
+                expressions.append(f"COUNT(DISTINCT {self._column(stored, column)})")
+            else:
+                expressions.append(f"{function.upper()}({self._column(stored, column)})")
+            output.append((metric, dict(stored)[column] if function in ("min", "max") else "numeric"))
+        condition, params = self._where(stored, where)
+        group = f" GROUP BY {keys} ORDER BY {keys}" if keys else ""
+        select = ", ".join(filter(None, [keys, ", ".join(expressions)]))
+        with self._lock:
+            db = self._db()
+            rows = db.execute(f"SELECT {select} FROM {handle}{condition}{group}", params).fetchall()
+        return output, rows[:limit], len(rows)
+
+    def close(self) -> None:
+        """Close the store and delete its file; its handles are gone with it."""
+        with self._lock:
+            if self._conn is None:
+                return
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
+        if self.path != ":memory:":
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
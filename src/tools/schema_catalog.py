@@ -0,0 +1,218 @@
+import asyncio
+import time
+
+from loguru import logger
+
+from .couch_client import AsyncCouchClient
+
+PG_COLUMNS_SQL = """
+SELECT c.table_schema, c.table_name, c.column_name, c.data_type, c.is_nullable = 'YES' AS nullable
+FROM information_schema.columns c
+JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+WHERE t.table_type = 'BASE TABLE' AND c.table_schema NOT IN ('pg_catalog', 'information_schema')
+ORDER BY c.table_schema, c.table_name, c.ordinal_position
+"""
+
+PG_KEYS_SQL = """
+SELECT n.nspname AS table_schema, c.relname AS table_name,
+       CASE con.contype WHEN 'p' THEN 'PRIMARY KEY' ELSE 'FOREIGN KEY' END AS constraint_type,
+       a.attname AS column_name, rc.relname AS ref_table, ra.attname AS ref_column
+FROM pg_constraint con
+JOIN pg_class c ON c.oid = con.conrelid
+JOIN pg_namespace n ON n.oid = c.relnamespace
+-- conkey and confkey pair each key column with the column it references, in order
+CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY AS k(attnum, ref_attnum, ord)
+JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+LEFT JOIN pg_class rc ON rc.oid = con.confrelid
+LEFT JOIN pg_attribute ra ON ra.attrelid = con.confrelid AND ra.attnum = k.ref_attnum
+WHERE con.contype IN ('p', 'f') AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+ORDER BY n.nspname, c.relname, con.conname, k.ord
+"""
+
+PG_ROW_ESTIMATES_SQL = """
+SELECT n.nspname AS table_schema, c.relname AS table_name, GREATEST(c.reltuples, 0)::bigint AS row_estimate
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'p') AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+"""
+
+# Concurrent per-database requests while loading CouchDB metadata
+COUCH_CATALOG_CONCURRENCY = 8
+
+
+def _table_name(schema: str, table: str) -> str:
+    return table if schema == "public" else f"{schema}.{table}"
+
+
+class SchemaCatalog:
+    """In-memory description of Postgres tables and CouchDB databases, loaded once and refreshed after DDL."""
+
+    def __init__(self, pg, couch: AsyncCouchClient):
+        self.pg = pg
+        self.couch = couch
+        self.tables: dict[str, dict] = {}
+        self.couch_dbs: dict[str, dict] = {}
+        self.pg_loaded_at = None
+        self.couch_loaded_at = None
+        self._pg_stale = True
+        self._couch_stale = True
+        self._lock = asyncio.Lock()
+        self._background: asyncio.Task = None
+        # Why the last load of each side failed, cleared when one succeeds
+        self.errors: dict[str, str] = {}
+        self.refreshes = 0
+
+    async def ensure_loaded(self) -> None:
+        """Load whatever is missing or marked stale; a no-op once the catalog is current."""
+        if not (self._pg_stale or self._couch_stale):
+            return
+        async with self._lock:
+            if self._pg_stale:
+                # Cleared before loading so DDL that lands mid-refresh marks it stale again
+                self._pg_stale = False
+                self._pg_stale = not await self._refresh("Postgres", self.refresh_pg) or self._pg_stale
+            if self._couch_stale:
+                self._couch_stale = False
+                self._couch_stale = not await self._refresh("CouchDB", self.refresh_couch) or self._couch_stale
+
+    def load_in_background(self) -> None:
+        """Start loading whatever is stale, unless it is current or a load is already running."""
+        if not (self._pg_stale or self._couch_stale):
+            return
+        if self._background is None or self._background.done():
+            # Held here because the event loop keeps only a weak reference to running tasks
+            self._background = asyncio.create_task(self.ensure_loaded())
+
+    async def _refresh(self, label: str, refresh) -> bool:
+        try:
+            await refresh()
+            self.refreshes += 1
+            self.errors.pop(label, None)
+            return True
+        except Exception as e:
+            # Keep serving the last good catalog and retry on the next describe
+            logger.error(f"Loading the {label} schema catalog failed: {str(e)}")
+            self.errors[label] = str(e) or type(e).__name__
+            return False
+
+    def base_table_names(self) -> set[str]:
+        """Postgres base table names as query_pg's cache sees them, or None before the first load."""
+        if self.pg_loaded_at is None:
+            return None
+        return {name.split(".")[-1].lower() for name in self.tables}
+
+    def mark_stale(self, pg: bool = False, couch: bool = False) -> None:
+        """Called after DDL so the next describe reloads that side of the catalog."""
+        self._pg_stale = self._pg_stale or pg
+        self._couch_stale = self._couch_stale or couch
+
+    async def refresh_pg(self) -> None:
+        async with self.pg.acquire() as conn:
+            columns = await conn.fetch(PG_COLUMNS_SQL)
+            keys = await conn.fetch(PG_KEYS_SQL)
+            estimates = await conn.fetch(PG_ROW_ESTIMATES_SQL)
+        tables: dict[str, dict] = {}
+        for row in columns:
+            table = tables.setdefault(
+                _table_name(row["table_schema"], row["table_name"]),
+                {"columns": [], "primary_key": [], "foreign_keys": {}, "row_estimate": None},
+            )
+            table["columns"].append((row["column_name"], row["data_type"], row["nullable"]))
+        for row in keys:
+            table = tables.get(_table_name(row["table_schema"], row["table_name"]))
+            if table is None:
+                continue
+            if row["constraint_type"] == "PRIMARY KEY":
+                table["primary_key"].append(row["column_name"])
+            elif row["ref_table"]:
+                table["foreign_keys"][row["column_name"]] = f"{row['ref_table']}.{row['ref_column']}"
+        for row in estimates:
+            table = tables.get(_table_name(row["table_schema"], row["table_name"]))
+            if table is not None:
+                table["row_estimate"] = row["row_estimate"]
+        self.tables = tables
+        self.pg_loaded_at = time.time()
+        logger.info(f"Schema catalog loaded {len(tables)} Postgres tables")
+
+    async def refresh_couch(self) -> None:
+        names = [name for name in await self.couch.all_dbs() if not name.startswith("_")]
+        semaphore = asyncio.Semaphore(COUCH_CATALOG_CONCURRENCY)
+
+        async def describe(name: str) -> tuple[str, dict]:
+            async with semaphore:
+                info, indexes, ddocs = await asyncio.gather(
+                    self.couch.db_info(name), self.couch.list_indexes(name), self.couch.design_docs(name)
+                )
+            return name, {
+                "doc_count": info.get("doc_count"),
+                "indexes": [
+                    [next(iter(f)) if isinstance(f, dict) else f for f in ix["def"]["fields"]]
+                    for ix in indexes if ix.get("type") != "special"
+                ],
+                "views": [
+                    f"{ddoc['_id'][len('_design/'):]}/{view}" + (f" ({d['reduce']})" if d.get("reduce") else "")
+                    for ddoc in ddocs for view, d in ddoc.get("views", {}).items()
+                ],
+            }
+
+        self.couch_dbs = dict(await asyncio.gather(*[describe(name) for name in names]))
+        self.couch_loaded_at = time.time()
+        logger.info(f"Schema catalog loaded {len(self.couch_dbs)} CouchDB databases")
+
+    def describe_table(self, name: str) -> str:
+        table = self.tables[name]
+        estimate = table["row_estimate"]
+        header = f"{name} (~{estimate} rows)" if estimate is not None else name
+        if table["primary_key"]:
+            header += f" PK({', '.join(table['primary_key'])})"
+        lines = [header]
+        for column, data_type, nullable in table["columns"]:
+            line = f"  {column} {data_type}{'' if nullable else ' not null'}"
+            if column in table["foreign_keys"]:
+                line += f" -> {table['foreign_keys'][column]}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def describe_couch_db(self, name: str) -> str:
+        db = self.couch_dbs[name]
+        line = f"{name} ({db['doc_count']} docs)"
+        if db["indexes"]:
+            line += f" indexes: {'; '.join(', '.join(fields) for fields in db['indexes'])}"
+        if db["views"]:
+            line += f" views: {', '.join(db['views'])}"
+        return line
+
+    def load_errors(self) -> list[str]:
+        """Notes on failed loads, so an empty or old catalog is not taken for the database's real state."""
+        notes = []
+        for label, error in sorted(self.errors.items()):
+            shown = "this is the last catalog that loaded" if self._loaded(label) else "nothing is known about it yet"
+            notes.append(f"-- loading the {label} catalog failed ({error}); {shown}. "
+                         f"Call describe_schema with refresh=true to retry.")
+        return notes
+
+    def _loaded(self, label: str) -> bool:
+        return (self.pg_loaded_at if label == "Postgres" else self.couch_loaded_at) is not None
+
+    def describe(self, name: str = None) -> str:
+        """Text description of one table or database, or of everything known."""
+        if name:
+            if name in self.tables:
+                return self.describe_table(name)
+            if name in self.couch_dbs:
+                return self.describe_couch_db(name)
+            return "\n".join([f"Error: '{name}' is not a known Postgres table or CouchDB database. "
+                              f"Call describe_schema without a name to list them."] + self.load_errors())
+        sections = ["# Postgres tables"]
+        sections += [self.describe_table(t) for t in sorted(self.tables)] or ["(none loaded)"]
+        sections.append("# CouchDB databases")
+        sections += [self.describe_couch_db(d) for d in sorted(self.couch_dbs)] or ["(none loaded)"]
+        return "\n".join(sections + self.load_errors())
+
+    def summary(self) -> str:
+        """Names only, for when the full description does not fit the output budget."""
+        return "\n".join([
+            f"# Postgres tables: {', '.join(sorted(self.tables)) or '(none loaded)'}",
+            f"# CouchDB databases: {', '.join(sorted(self.couch_dbs)) or '(none loaded)'}",
+            "-- full description exceeds the output budget; call describe_schema with name=<table or database>.",
+        ] + self.load_errors())
@@ -0,0 +1,303 @@
+"""Nested timing spans for queries, model turns, API calls, tool calls and database work.
+
+Spans nest through a context variable, so tasks started inside a span (parallel tool calls)
+become its children. Finished spans are written as JSON lines by a background thread, with
+OTLP span field names, and tool calls carry a W3C traceparent to the MCP server so its spans
+join the client's trace.
+
+    python -m src.utils.tracing summarize logs/traces.jsonl
+"""
+import argparse
+import atexit
+import functools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "false").lower() == "true"
+TRACE_FILE = os.getenv("TRACE_FILE", "logs/traces.jsonl")
+# Finished spans waiting for the writer thread; more than this are dropped rather than waited on
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "status", "_start", "_start_ns")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.attributes = {k: v for k, v in (attributes or {}).items() if v is not None}
+        self.status = "ok"
+        self._start = time.perf_counter()
+        self._start_ns = time.time_ns()
+
+    def set(self, **attributes) -> None:
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def record(self, service: str) -> dict:
+        duration = time.perf_counter() - self._start
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "service": service,
+            "start_time_unix_nano": self._start_ns,
+            "end_time_unix_nano": self._start_ns + int(duration * 1e9),
+            "duration_ms": round(duration * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoSpan:
+    """Stands in when tracing is off or no span is open, so callers never need to check."""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def traceparent(self) -> None:
+        return None
+
+
+NO_SPAN = _NoSpan()
+_current: ContextVar[Span] = ContextVar("current_span", default=None)
+
+
+def current_span():
+    return _current.get() or NO_SPAN
+
+
+def trace_meta() -> dict:
+    """MCP request _meta carrying the current span, for the server to continue the trace."""
+    traceparent = current_span().traceparent()
+    return {"traceparent": traceparent} if traceparent else None
+
+
+def parse_traceparent(traceparent: str) -> tuple[str, str]:
+    try:
+        _, trace_id, parent_id, _ = traceparent.split("-")
+        return trace_id, parent_id
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def usage_attributes(usage) -> dict:
+    """Token counts from a Messages API usage object."""
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_read_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_write_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+    }
+
+
+class JsonlSink:
+    """Appends records to a JSONL file from a background thread; emit never blocks the caller."""
+
+    def __init__(self, path: str, max_queued: int = TRACE_QUEUE_SIZE):
+        self.path = path
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._write, name="trace-sink", daemon=True)
+        self._thread.start()
+
+    def emit(self, record: dict) -> None:
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                batch = [self._queue.get()]
+                while not self._queue.empty() and len(batch) < 500:
+                    batch.append(self._queue.get_nowait())
+                closing = batch[-1] is None
+                lines = [json.dumps(r, default=str) + "\n" for r in batch if r is not None]
+                if lines:
+                    # One write per batch keeps lines whole when two processes share the file
+                    f.write("".join(lines))
+                    f.flush()
+                if closing:
+                    return
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+        if self.dropped:
+            logger.warning(f"Tracing dropped {self.dropped} spans because the writer fell behind")
+
+
+class Tracer:
+    def __init__(self, path: str = TRACE_FILE, enabled: bool = TRACE_ENABLED, service: str = "agent"):
+        self.enabled = enabled
+        self.service = service
+        self.path = path
+        self._sink = None
+
+    @property
+    def sink(self) -> JsonlSink:
+        # Started on first use so importing this module costs nothing
+        if self._sink is None:
+            self._sink = JsonlSink(self.path)
+            atexit.register(self._sink.close)
+        return self._sink
+
+    @contextmanager
+    def span(self, name: str, traceparent: str = None, **attributes):
+        """Time the block as a child of the current span, or of a remote traceparent, or as a new trace."""
+        if not self.enabled:
+            yield NO_SPAN
+            return
+        parent = _current.get()
+        trace_id, parent_id = (parent.trace_id, parent.span_id) if parent else parse_traceparent(traceparent)
+        span = Span(name, trace_id or secrets.token_hex(16), parent_id, attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            self.sink.emit(span.record(self.service))
+
+    def traced(self, name: str):
+        """Decorator running an async function inside a span that also records the size of a text result."""
+        def decorate(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.span(name) as span:
+                    result = await fn(*args, **kwargs)
+                    if isinstance(result, str):
+                        span.set(result_chars=len(result))
+                    return result
+            return wrapper
+        return decorate
+
+    def close(self) -> None:
+        if self._sink is not None:
+            self._sink.close()
+
+
+tracer = Tracer()
+
+
+def _covered(intervals: list[tuple[int, int]]) -> int:
+    total, reach = 0, None
+    for start, end in sorted(intervals):
+        if reach is None or start > reach:
+            total += end - start
+            reach = end
+        elif end > reach:
+            total += end - reach
+            reach = end
+    return total
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def load_spans(paths: list[str]) -> list[dict]:
+    spans = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return spans
+
+
+def summarize(spans: list[dict]) -> dict:
+    """Per span name: count, total and self (exclusive) time, and p50/p99; plus token and cache totals.
+
+    Self time is a span's duration minus the time its children covered, counting overlapping
+    children (parallel tool calls) once.
+    """
+    children = defaultdict(list)
+    ids = {s["span_id"] for s in spans}
+    for s in spans:
+        if s.get("parent_span_id") in ids:
+            children[s["parent_span_id"]].append(s)
+    by_name = defaultdict(lambda: {"count": 0, "errors": 0, "durations": [], "self_ms": 0.0})
+    for s in spans:
+        start, end = s["start_time_unix_nano"], s["end_time_unix_nano"]
+        covered = _covered([(max(c["start_time_unix_nano"], start), min(c["end_time_unix_nano"], end))
+                            for c in children[s["span_id"]] if c["end_time_unix_nano"] > start])
+        entry = by_name[s["name"]]
+        entry["count"] += 1
+        entry["errors"] += s.get("status") == "error"
+        entry["durations"].append(s["duration_ms"])
+        entry["self_ms"] += max(0, end - start - covered) / 1e6
+    wall_ms = sum(s["duration_ms"] for s in spans if s.get("parent_span_id") not in ids)
+    rows = []
+    for name, entry in by_name.items():
+        rows.append({
+            "name": name, "count": entry["count"], "errors": entry["errors"],
+            "total_ms": sum(entry["durations"]), "self_ms": entry["self_ms"],
+            "self_share": entry["self_ms"] / wall_ms if wall_ms else 0.0,
+            "p50_ms": _percentile(entry["durations"], 50), "p99_ms": _percentile(entry["durations"], 99),
+        })
+    rows.sort(key=lambda r: r["self_ms"], reverse=True)
+    totals = defaultdict(float)
+    for s in spans:
+        attributes = s.get("attributes", {})
+        for key in ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens"):
+            totals[key] += attributes.get(key, 0)
+        if "cache_hit" in attributes or "memo_hit" in attributes:
+            totals["cache_lookups"] += 1
+            totals["cache_hits"] += bool(attributes.get("cache_hit") or attributes.get("memo_hit"))
+    return {"wall_ms": wall_ms, "traces": len({s["trace_id"] for s in spans}), "spans": rows, "totals": dict(totals)}
+
+
+def print_summary(summary: dict) -> None:
+    print(f"{summary['traces']} traces, {summary['wall_ms'] / 1000:.2f}s of root span time")
+    print(f"{'span':<24}{'count':>7}{'errors':>7}{'total ms':>11}{'self ms':>10}{'self %':>8}{'p50 ms':>9}{'p99 ms':>9}")
+    for r in summary["spans"]:
+        print(f"{r['name']:<24}{r['count']:>7}{r['errors']:>7}{r['total_ms']:>11.1f}{r['self_ms']:>10.1f}"
+              f"{r['self_share']:>8.1%}{r['p50_ms']:>9.1f}{r['p99_ms']:>9.1f}")
+    totals = summary["totals"]
+    if totals.get("input_tokens") or totals.get("output_tokens"):
+        print(f"tokens: {totals['input_tokens']:.0f} input, {totals['output_tokens']:.0f} output, "
+              f"{totals['cache_read_tokens']:.0f} cache read, {totals['cache_write_tokens']:.0f} cache write")
+    if totals.get("cache_lookups"):
+        print(f"cache hits: {totals['cache_hits']:.0f}/{totals['cache_lookups']:.0f} cacheable calls")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize trace files written by the agent and the MCP server")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    summarize_parser = subcommands.add_parser("summarize", help="Show where wall-clock time goes")
+    summarize_parser.add_argument("files", nargs="*", default=[TRACE_FILE])
+    summarize_parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+    result = summarize(load_spans(args.files))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_summary(result)
@@ -1,14 +1,28 @@
 import asyncio
+import argparse
+import contextlib
+import time
+from dataclasses import asdict
 from dataclasses import dataclass, field
 from typing import Union, cast, Dict, Any, List
-from jsonschema import validate, ValidationError
-from tenacity import retry, wait_exponential, stop_after_attempt
+from jsonschema import ValidationError
+from tenacity import retry, retry_if_not_exception_type, wait_exponential, stop_after_attempt
 import anthropic
 from anthropic.types import MessageParam, TextBlock, ToolUnionParam, ToolUseBlock
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
 from loguru import logger
+from src.agent.compaction import Compactor
+from src.agent.mcp_transport import MCP_SERVER_URL, connect_mcp, transport_name
+from src.agent.prompt_cache import CacheUsage, cached_request
+from src.agent.rate_limiter import RateLimiter, rate_limit_wait, shared_limiter
+from src.agent.streaming import StreamInterrupted, stream_message
+from src.agent.tool_registry import ToolRegistry
+from src.agent.tool_memo import ToolMemo
+from src.agent.token_counter import TokenCounter, content_text, usage_input_tokens
+from src.agent.batch_client import BatchAPIClient
+from src.interface.batch import BATCH_CONCURRENCY, ResultWriter, completed_ids, load_queries, run_batch
+from src.utils.tracing import trace_meta, tracer, usage_attributes
 import os
 import datetime
 
@@ -34,6 +48,8 @@ load_dotenv()
 anthropic_client = anthropic.AsyncAnthropic()
 MAX_TOKENS = 100000  # Conservative limit for Claude's 200k context window
 RETRY_ATTEMPTS = 3
+# Stream responses and start tools as soon as their input is complete
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
 
 # Create server parameters for stdio connection
 server_params = StdioServerParameters(
@@ -46,30 +62,48 @@ server_params = StdioServerParameters(
 class Chat:
     messages: list[MessageParam] = field(default_factory=list)
     system_prompt: str = """You are a Super Technical Support Assistant specializing in PostgreSQL and CouchDB operations. Your role is to provide users with accurate, concise, and user-friendly assistance for these databases. Maintain a professional and empathetic tone, prioritize clarity, and avoid unnecessary technical jargon. Break down complex issues into manageable steps, and if a problem requires further assistance beyond your capabilities, guide the user on how to seek additional help. Ensure that all information provided is up-to-date and relevant to the user's context.​"""
-    available_tools: list[ToolUnionParam] = field(default_factory=list)
+    tools: ToolRegistry = field(default_factory=ToolRegistry)
+    tokens: TokenCounter = field(default_factory=TokenCounter)
+    cache_usage: CacheUsage = field(default_factory=CacheUsage)
+    streaming: bool = STREAM_RESPONSES
+    compactor: Compactor = field(default_factory=lambda: Compactor(anthropic_client))
+    memo: ToolMemo = field(default_factory=ToolMemo)
+    # Shared by every Chat in the process so concurrent sessions stay under one account's limits
+    limiter: RateLimiter = field(default_factory=lambda: shared_limiter)
+    session: ClientSession = None
+    # Shared MCP server URL; empty launches a private server over stdio
+    server_url: str = MCP_SERVER_URL
+    # Every tool call made this session: name, input, result size and duration
+    tool_trace: list[dict] = field(default_factory=list)
 
     async def initialize_tools(self, session: ClientSession) -> None:
         """Fetch and cache available tools with schemas"""
         print("📋 Initializing available tools...")
-        response = await session.list_tools()
-        self.available_tools = [
-            {
-                "name": tool.name,
-                "description": tool.description or "",
-                "input_schema": tool.inputSchema,
-            }
-            for tool in response.tools
-        ]
+        await self.tools.refresh(session)
         logger.info(f"Available tools initialized: {[t['name'] for t in self.available_tools]}")
         print(f"✅ Initialized {len(self.available_tools)} tools")
 
-    @retry(wait=wait_exponential(multiplier=1, min=1, max=10), 
+    @property
+    def available_tools(self) -> list[ToolUnionParam]:
+        """Tool definitions for the API, kept current by the registry"""
+        return self.tools.params
+
+    async def handle_server_message(self, message) -> None:
+        """Refresh the tool registry when the server announces its tool list changed"""
+        if self.tools.on_message(message, self.session):
+            print("🔄 Server tool list changed - refreshing tools")
+
+    @retry(wait=rate_limit_wait(wait_exponential(multiplier=1, min=1, max=10)),
            stop=stop_after_attempt(RETRY_ATTEMPTS))
     async def claude_request(self, **kwargs) -> anthropic.types.Message:
-        """Wrapper with retry logic for Claude API calls"""
+        """Wrapper with retry logic for Claude API calls, paced by the shared rate limiter"""
         print(f"🤖 Sending request to Claude API...")
         try:
-            response = await anthropic_client.messages.create(**kwargs)
+            input_tokens = self.tokens.count(self.messages, self.system_prompt, self.available_tools)
+            with tracer.span("claude.request", streaming=False, messages=len(kwargs.get("messages", [])),
+                             estimated_input_tokens=input_tokens) as span:
+                response = await self.limiter.create(anthropic_client, input_tokens=input_tokens, **kwargs)
+                span.set(stop_reason=response.stop_reason, **usage_attributes(response.usage))
             print(f"✅ Received response from Claude API")
             return response
         except anthropic.APIError as e:
@@ -77,39 +111,84 @@ class Chat:
             logger.error(f"Claude API error: {str(e)}")
             raise
 
-    async def _truncate_messages(self):
+    @retry(wait=rate_limit_wait(wait_exponential(multiplier=1, min=1, max=10)),
+           stop=stop_after_attempt(RETRY_ATTEMPTS),
+           retry=retry_if_not_exception_type(StreamInterrupted))
+    async def claude_stream(self, session: ClientSession, **kwargs) -> tuple[anthropic.types.Message, list[asyncio.Task]]:
+        """Streaming Claude API call that prints text live and dispatches tools as their input completes"""
+        print(f"🤖 Streaming request to Claude API...")
+        printed = False
+
+        def on_text(text: str) -> None:
+            nonlocal printed
+            if not printed:
+                print("\n🗣️ Claude's response:")
+                printed = True
+            print(text, end="", flush=True)
+
+        async def run_tool(tool_use: ToolUseBlock) -> dict:
+            print(f"\n⚡ Tool input complete, starting {tool_use.name} while Claude continues")
+            return await self.process_tool_use(session, tool_use)
+
+        try:
+            input_tokens = self.tokens.count(self.messages, self.system_prompt, self.available_tools)
+            # Tools dispatched mid-stream are children of this span and may outlive it
+            with tracer.span("claude.request", streaming=True, messages=len(kwargs.get("messages", [])),
+                             estimated_input_tokens=input_tokens) as span:
+                response, tool_tasks = await stream_message(anthropic_client, on_text, run_tool, limiter=self.limiter,
+                                                            input_tokens=input_tokens, **kwargs)
+                span.set(stop_reason=response.stop_reason, **usage_attributes(response.usage))
+            if printed:
+                print()
+            print(f"✅ Received streamed response from Claude API")
+            return response, tool_tasks
+        except anthropic.APIError as e:
+            print(f"❌ Claude API error: {str(e)}")
+            logger.error(f"Claude API error: {str(e)}")
+            raise
+
+    def _truncate_messages(self):
         """Maintain conversation history within token limits"""
-        print("📏 Checking conversation token count...")
-        token_count = await anthropic_client.messages.count_tokens(
-            model="claude-3-7-sonnet-20250219",
-            messages=self.messages
-        )
-        print(f"📊 Current token count: {token_count.input_tokens}/{MAX_TOKENS}")
-        
-        while token_count.input_tokens > MAX_TOKENS:
-            if len(self.messages) > 1:
-                removed = self.messages.pop(1)  # Preserve system prompt
-                print(f"✂️ Truncated message: {str(removed)[:50]}...")
-                logger.warning(f"Truncated message: {str(removed)[:50]}...")
-                # Recalculate tokens after removing a message
-                token_count = await anthropic_client.messages.count_tokens(
-                    model="claude-3-7-sonnet-20250219",
-                    messages=self.messages
-                )
-                print(f"📊 Updated token count: {token_count.input_tokens}/{MAX_TOKENS}")
-            else:
-                print("⚠️ Cannot truncate further - only system message remains")
-                break
+        if self.compactor.apply(self.messages, self.tokens):
+            print("🗜️ Older turns replaced by their summary")
+        token_count = self.tokens.count(self.messages, self.system_prompt, self.available_tools)
+        print(f"📊 Current token count: {token_count}/{MAX_TOKENS}")
+        if self.compactor.maybe_start(self.messages, self.tokens, MAX_TOKENS, self.system_prompt, self.available_tools):
+            print("🗜️ Summarizing older turns in the background...")
+        if token_count <= MAX_TOKENS:
+            return
+        # Summary not ready before the hard limit: drop the oldest turns instead.
+        # One local pass finds the cut; the first user message is preserved
+        removed = self.tokens.truncate(self.messages, MAX_TOKENS, self.system_prompt, self.available_tools)
+        if not removed:
+            print("⚠️ Cannot truncate further - only the latest exchange remains")
+            return
+        print(f"✂️ Truncated {len(removed)} messages")
+        logger.warning(f"Truncated {len(removed)} messages, starting with: {str(removed[0])[:50]}...")
+        print(f"📊 Updated token count: {self.tokens.count(self.messages, self.system_prompt, self.available_tools)}/{MAX_TOKENS}")
 
 
     async def process_tool_use(self, session: ClientSession, tool_use: ToolUseBlock) -> dict:
+        """Execute tool and record it in the session's tool trace"""
+        started = time.perf_counter()
+        with tracer.span("tool.call", tool=tool_use.name, input_bytes=len(str(tool_use.input))) as span:
+            tool_result = await self._execute_tool_use(session, tool_use)
+            span.set(result_chars=len(tool_result["content"]))
+        self.tool_trace.append({
+            "name": tool_use.name,
+            "input": tool_use.input,
+            "result": tool_result["content"][:200],
+            "result_chars": len(tool_result["content"]),
+            "ms": round((time.perf_counter() - started) * 1000, 1),
+        })
+        return tool_result
+
+    async def _execute_tool_use(self, session: ClientSession, tool_use: ToolUseBlock) -> dict:
         """Execute tool with validation and error handling"""
         print(f"🛠️ Executing tool: {tool_use.name} (ID: {tool_use.id})")
         print(f"📥 Tool input: {tool_use.input}")
         
-        tool = next((t for t in self.available_tools if t["name"] == tool_use.name), None)
-        
-        if not tool:
+        if tool_use.name not in self.tools:
             print(f"❌ Tool '{tool_use.name}' not found")
             return {
                 "tool_use_id": tool_use.id,
@@ -119,12 +198,16 @@ class Chat:
         try:
             # Validate against tool schema
             print(f"🔍 Validating input against schema for {tool_use.name}...")
-            validate(instance=tool_use.input, schema=tool["input_schema"])
+            self.tools.validate(tool_use.name, tool_use.input)
             print(f"✅ Input validation successful")
             
             # Execute tool
             print(f"⚙️ Executing {tool_use.name}...")
-            result = await session.call_tool(tool_use.name, cast(dict, tool_use.input))
+            # Identical reads share one call until a write invalidates them
+            result = await self.memo.call(
+                tool_use.name, tool_use.input,
+                lambda: session.call_tool(tool_use.name, cast(dict, tool_use.input), meta=trace_meta()),
+            )
             tool_result = {
                 "tool_use_id": tool_use.id,
                 "content": result.content[0].text if result.content else ""
@@ -150,83 +233,129 @@ class Chat:
         print(f"📝 Processing query: {query}")
         self.messages.append({"role": "user", "content": query})
         
-        iteration = 0
-        while True:
-            if iteration > 0:
-                print(f"\n🔄 Iteration {iteration+1} - Processing tool results...")
-            iteration += 1
-            
-            try:
-                # Get Claude response with retry
-                print(f"🧠 Thinking...")
-                res = await self.claude_request(
-                    model="claude-3-7-sonnet-20250219",
-                    system=self.system_prompt,
-                    max_tokens=8000,
-                    messages=self.messages,
-                    tools=self.available_tools,
-                )
-            except Exception as e:
-                error_msg = f"System error: Failed to get response ({str(e)})"
-                self.messages.append({
-                    "role": "assistant", 
-                    "content": error_msg
-                })
-                print(f"❌ {error_msg}")
-                break
+        with tracer.span("query", query_chars=len(query)) as query_span:
+            iteration, done = 0, False
+            while not done:
+                if iteration > 0:
+                    print(f"\n🔄 Iteration {iteration+1} - Processing tool results...")
+                iteration += 1
+                with tracer.span("iteration", number=iteration):
+                    done = await self._run_iteration(session)
+            query_span.set(iterations=iteration)
 
-            # Process response content
-            tool_uses = [c for c in res.content if isinstance(c, ToolUseBlock)]
-            text_blocks = [c for c in res.content if isinstance(c, TextBlock)]
-
-            print(f"📊 Response breakdown: {len(text_blocks)} text blocks, {len(tool_uses)} tool calls")
+        print(f"📊 Session usage: {self.cache_usage.summary()}")
+        print(f"♻️ Tool calls saved by memo: {self.memo.saved}/{self.memo.calls}")
+        print("="*50 + "\n")
 
-            # Print immediate text response
-            if text_blocks:
-                print("\n🗣️ Claude's response:")
-                for block in text_blocks:
-                    print(block.text)
-
-            if not tool_uses:
-                print("✅ Query complete - no tools needed")
-                # Add full response to messages for history
-                self.messages.append({
-                    "role": "assistant",
-                    "content": res.content
-                })
-                break  # Exit loop if no tools needed
+    async def _run_iteration(self, session: ClientSession) -> bool:
+        """One model turn and the tools it asked for; True once the query is finished"""
+        try:
+            # Get Claude response with retry
+            print(f"🧠 Thinking...")
+            if self.compactor.apply(self.messages, self.tokens):
+                print("🗜️ Older turns replaced by their summary")
+            request = dict(
+                model="claude-3-7-sonnet-20250219",
+                max_tokens=8000,
+                **cached_request(self.system_prompt, self.available_tools, self.messages),
+            )
+            if self.streaming:
+                res, tool_tasks = await self.claude_stream(session, **request)
             else:
-                print(f"\n🛠️ Tools requested: {', '.join([t.name for t in tool_uses])}")
+                res, tool_tasks = await self.claude_request(**request), None
+        except StreamInterrupted as e:
+            # Tools already running may have written data; let them finish rather than retrying the turn
+            await asyncio.gather(*e.tool_tasks, return_exceptions=True)
+            error_msg = f"System error: Response stream failed after tools started ({str(e.cause)})"
+            self.messages.append({
+                "role": "assistant",
+                "content": error_msg
+            })
+            print(f"❌ {error_msg}")
+            return True
+        except Exception as e:
+            error_msg = f"System error: Failed to get response ({str(e)})"
+            self.messages.append({
+                "role": "assistant", 
+                "content": error_msg
+            })
+            print(f"❌ {error_msg}")
+            return True
 
-            # Process all tool uses in parallel
-            print("⚙️ Executing tools in parallel...")
-            tool_results = await asyncio.gather(
-                *[self.process_tool_use(session, tool_use) for tool_use in tool_uses]
-            )
+        self.cache_usage.record(res.usage)
+        print(f"💾 Prompt cache: {res.usage.cache_read_input_tokens or 0} read, {res.usage.cache_creation_input_tokens or 0} written")
+
+        # Keep the local token estimate in line with what the API counted
+        self.tokens.calibrate(usage_input_tokens(res.usage), self.messages, self.system_prompt, self.available_tools)
+
+        # Process response content
+        tool_uses = [c for c in res.content if isinstance(c, ToolUseBlock)]
+        text_blocks = [c for c in res.content if isinstance(c, TextBlock)]
 
-            # Update conversation history
+        print(f"📊 Response breakdown: {len(text_blocks)} text blocks, {len(tool_uses)} tool calls")
+
+        # Print immediate text response (already shown live when streaming)
+        if text_blocks and not self.streaming:
+            print("\n🗣️ Claude's response:")
+            for block in text_blocks:
+                print(block.text)
+
+        if not tool_uses:
+            print("✅ Query complete - no tools needed")
+            # Add full response to messages for history
             self.messages.append({
                 "role": "assistant",
                 "content": res.content
             })
-            
-            # Construct tool_results in the correct format
-            tool_results_content = [{
-                "type": "tool_result",
-                "tool_use_id": result["tool_use_id"],
-                "content": result["content"]
-            } for result in tool_results]
-            
-            print("\n📤 Sending tool results back to Claude...")
-            self.messages.append({
-                "role": "user",
-                "content": tool_results_content
-            })
+            return True  # Finished: no tools needed
+        else:
+            print(f"\n🛠️ Tools requested: {', '.join([t.name for t in tool_uses])}")
 
-            # Maintain token window
-            await self._truncate_messages()
+        # Process all tool uses in parallel; streamed ones are already running
+        if tool_tasks is not None:
+            print("⚙️ Waiting for tools started during streaming...")
+            tool_results = await asyncio.gather(*tool_tasks)
+        else:
+            print("⚙️ Executing tools in parallel...")
+            tool_results = await asyncio.gather(
+                *[self.process_tool_use(session, tool_use) for tool_use in tool_uses]
+            )
 
-        print("="*50 + "\n")
+        # Update conversation history
+        self.messages.append({
+            "role": "assistant",
+            "content": res.content
+        })
+
+        # Construct tool_results in the correct format
+        tool_results_content = [{
+            "type": "tool_result",
+            "tool_use_id": result["tool_use_id"],
+            "content": result["content"]
+        } for result in tool_results]
+
+        print("\n📤 Sending tool results back to Claude...")
+        self.messages.append({
+            "role": "user",
+            "content": tool_results_content
+        })
+
+        # Maintain token window
+        self._truncate_messages()
+        return False
+
+    async def answer(self, session: ClientSession, query: str) -> dict:
+        """Run one query headlessly and return the answer with its tool trace and token usage"""
+        await self.process_query(session, query)
+        content = self.messages[-1]["content"]
+        answer = content_text(content)
+        if isinstance(content, str) and content.startswith("System error"):
+            raise RuntimeError(answer)
+        return {
+            "answer": answer,
+            "tool_calls": self.tool_trace,
+            "usage": {**asdict(self.cache_usage), "hit_rate": round(self.cache_usage.hit_rate, 3)},
+        }
 
     async def chat_loop(self, session: ClientSession):
         """Main chat interface with session management"""
@@ -255,16 +384,87 @@ class Chat:
     async def run(self):
         """Main entry point with connection management"""
         print("🔌 Establishing connection to server...")
-        async with stdio_client(server_params) as (read, write):
+        print(f"🔗 Transport: {transport_name(self.server_url)} {self.server_url}")
+        async with connect_mcp(self.server_url, server_params) as (read, write):
             print("✅ Connection established")
-            async with ClientSession(read, write) as session:
+            async with ClientSession(read, write, message_handler=self.handle_server_message) as session:
+                self.session = session
                 print("🔄 Initializing session...")
                 await session.initialize()
                 print("✅ Session initialized")
                 await self.chat_loop(session)
+                logger.info(f"Session usage: {self.cache_usage.summary()}")
+                logger.info(f"Tool memo: {self.memo.stats()}")
+                logger.info(f"Rate limiter: {self.limiter.stats()}")
                 print("👋 Session ended")
 
+@contextlib.asynccontextmanager
+async def batch_session(server_url: str = MCP_SERVER_URL):
+    """One MCP session for a batch worker; each query gets a fresh Chat sharing the session's tools"""
+    async with connect_mcp(server_url, server_params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            tools = ToolRegistry()
+            await tools.refresh(session)
+
+            async def answer(query: str) -> dict:
+                return await Chat(tools=tools, server_url=server_url, session=session).answer(session, query)
+
+            yield answer
+
+
+async def run_batch_api(input_path: str, output_path: str, server_url: str = MCP_SERVER_URL) -> None:
+    """Answer a JSONL file of queries through the Message Batches API, running tools locally between rounds"""
+    done = completed_ids(output_path)
+    records = [r for r in load_queries(input_path) if r["id"] not in done]
+    print(f"📦 {len(records)} queries to submit ({len(done)} already answered)")
+    if not records:
+        return
+    async with connect_mcp(server_url, server_params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            tools = ToolRegistry()
+            await tools.refresh(session)
+
+            async def run_tool(name: str, tool_input: dict) -> str:
+                tools.validate(name, tool_input)
+                result = await session.call_tool(name, tool_input)
+                return result.content[0].text if result.content else ""
+
+            batches = BatchAPIClient(anthropic_client, model="claude-3-7-sonnet-20250219", max_tokens=8000,
+                                     system_prompt=Chat.system_prompt)
+            jobs = await batches.run({r["id"]: r["query"] for r in records}, tools.params, run_tool)
+    writer = ResultWriter(output_path)
+    try:
+        for record in records:
+            job = jobs[record["id"]]
+            result = {**record, "answer": job.answer, "tool_calls": job.tool_calls, "usage": asdict(job.usage),
+                      "rounds": job.rounds, "status": "ok" if job.status == "succeeded" else "error"}
+            if job.error:
+                result["error"] = job.error
+            writer.write(result)
+    finally:
+        writer.close()
+    print(f"📊 Batch usage: {batches.cache_usage.summary()}")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database support agent")
+    parser.add_argument("--batch", metavar="INPUT", help="answer the queries in a JSONL file instead of chatting")
+    parser.add_argument("--output", default="logs/batch_results.jsonl", help="JSONL results file; reruns resume it")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="concurrent agent sessions")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="with --batch: submit through the Message Batches API (cheaper, not interactive)")
+    args = parser.parse_args()
+    if args.batch and args.batch_api:
+        asyncio.run(run_batch_api(args.batch, args.output))
+        raise SystemExit(0)
+    if args.batch:
+        # Per-query chatter would interleave across sessions; the trace log still records it
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(run_batch(args.batch, args.output, batch_session, args.concurrency))
+        raise SystemExit(0)
+
     print("🚀 Starting chat agent")
     chat = Chat()
     asyncio.run(chat.run())
\ No newline at end of file
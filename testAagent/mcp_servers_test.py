@@ -1,147 +1,90 @@
-import os
-import psycopg2
-import couchdb
-
-from loguru import logger
-from mcp.server.fastmcp import FastMCP
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# PostgreSQL connection details
-PG_USER = os.getenv("PG_USER")
-PG_PASSWORD = os.getenv("PG_PASSWORD")
-PG_DB = os.getenv("PG_DB")
-DB_HOST = os.getenv("DB_HOST")
-
-# CouchDB connection details
-COUCH_USER = os.getenv("COUCH_USER")
-COUCH_PASSWORD = os.getenv("COUCH_PASSWORD")
-COUCH_HOST = os.getenv("COUCH_HOST", "localhost")
-COUCH_PORT = os.getenv("COUCH_PORT", "5984")
-
-postgres_url = f"postgresql://{PG_USER}:{PG_PASSWORD}@{DB_HOST}/{PG_DB}"
-couch_url = f"http://{COUCH_USER}:{COUCH_PASSWORD}@{COUCH_HOST}:{COUCH_PORT}"
-
-# Create an MCP server
-mcp = FastMCP("Data Support Agent")
-
-
-@mcp.tool()
-def query_pg(sql: str) -> str:
-    """Execute SQL queries safely"""
-    logger.info(f"Executing SQL query: {sql}")
-    conn = psycopg2.connect(
-        user=PG_USER,
-        password=PG_PASSWORD,
-        host=DB_HOST,
-        database=PG_DB
-    )
-    try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        
-        # Check if the query returns results
-        if cursor.description:
-            result = cursor.fetchall()
-            return "\n".join(str(row) for row in result)
-        else:
-            conn.commit()
-            return f"Query executed successfully. Rows affected: {cursor.rowcount}"
-    except Exception as e:
-        return f"Error: {str(e)}"
-    finally:
-        conn.close()
-
-@mcp.tool()
-def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None) -> str:
-    """
-    Perform CRUD operations on CouchDB documents in a specific database.
-
-    Args:
-        db_name (str): Name of the CouchDB database.
-        doc_id (str): Document ID to fetch, update, or delete a specific document.
-        query (dict): Mango query to list documents (if doc_id is not provided).
-        operation (str): The type of operation to perform. Options: "create", "read", "update", "delete".
-        data (dict): The data to use for create or update operations.
-
-    Returns:
-        str: The result of the operation.
-    """
-    logger.info(f"Performing operation '{operation}' on CouchDB database '{db_name}' - doc_id: {doc_id}, query: {query}, data: {data}")
-
-    try:
-        # Connect to CouchDB
-        couch = couchdb.Server(couch_url)
-
-        # Check if the database exists
-        if db_name not in couch:
-            return f"Error: Database '{db_name}' does not exist."
-
-        db = couch[db_name]
-
-        if operation == "read":
-            if doc_id:
-                # Fetch a specific document by ID
-                try:
-                    doc = db[doc_id]
-                    return str(doc)
-                except couchdb.ResourceNotFound:
-                    return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
-            else:
-                # Use mango query to list documents
-                try:
-                    results = db.find(query)
-                    return "\n".join(str(doc) for doc in results)
-                except Exception as e:
-                    logger.error(f"Error querying CouchDB: {str(e)}")
-                    return f"Error: {str(e)}"
-
-        elif operation == "create":
-            if not data:
-                return "Error: 'data' is required for create operation."
-            # Create a new document
-            doc_id, doc_rev = db.save(data)
-            return f"Document created with ID: {doc_id} and revision: {doc_rev}"
-
-        elif operation == "update":
-            if not doc_id or not data:
-                return "Error: 'doc_id' and 'data' are required for update operation."
-            # Fetch the existing document
-            try:
-                doc = db[doc_id]
-                doc.update(data)
-                db.save(doc)
-                return f"Document with ID '{doc_id}' updated successfully."
-            except couchdb.ResourceNotFound:
-                return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
-
-        elif operation == "delete":
-            if not doc_id:
-                return "Error: 'doc_id' is required for delete operation."
-            # Fetch the existing document
-            try:
-                doc = db[doc_id]
-                db.delete(doc)
-                return f"Document with ID '{doc_id}' deleted successfully."
-            except couchdb.ResourceNotFound:
-                return f"Error: Document with ID '{doc_id}' not found in database '{db_name}'."
-
-        else:
-            return f"Error: Invalid operation '{operation}'. Supported operations: 'create', 'read', 'update', 'delete'."
-
-    except Exception as e:
-        logger.error(f"Failed to connect to CouchDB: {str(e)}")
-        return f"Error: Failed to connect to CouchDB. {str(e)}"
-
-
-
-@mcp.prompt()
-def mobilization_prompt(previous_membership: str, current_membership: str) -> str:
-    return f"Please review this location mobilized from {previous_membership} to {current_membership}"
-
-
-if __name__ == "__main__":
-    print("Starting server...")
-    # Initialize and run the server
+from loguru import logger
+from mcp.server.fastmcp import FastMCP
+from src.tools.database import DatabaseTools
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Create an MCP server
+mcp = FastMCP("Data Support Agent")
+db_tools = DatabaseTools()
+
+
+@mcp.tool()
+async def query_pg(sql: str, page_size: int = None) -> str:
+    """Execute SQL queries safely, returning row sets one page at a time"""
+    logger.info(f"Executing SQL query: {sql}")
+    return await db_tools.query_pg(sql, page_size)
+
+@mcp.tool()
+async def bulk_load_pg(table: str, columns: list[str], rows: list = None, csv: str = None, header: bool = False) -> str:
+    """Load many rows into a Postgres table with COPY, in batches that commit independently"""
+    logger.info(f"Bulk loading into {table}")
+    return await db_tools.bulk_load_pg(table, columns, rows, csv, header)
+
+@mcp.tool()
+async def fetch_pg_page(cursor_token: str, page_size: int = None) -> str:
+    """Fetch the next page of a query_pg result set"""
+    return await db_tools.fetch_pg_page(cursor_token, page_size)
+
+@mcp.tool()
+async def describe_schema(name: str = None, refresh: bool = False) -> str:
+    """Describe Postgres tables and CouchDB databases from an in-memory catalog"""
+    return await db_tools.describe_schema(name, refresh)
+
+@mcp.tool()
+async def result_slice(handle: str, offset: int = 0, limit: int = None, columns: list[str] = None,
+                       order_by: str = None, descending: bool = False) -> str:
+    """Read a window of rows from a result stored under a handle"""
+    return await db_tools.result_slice(handle, offset, limit, columns, order_by, descending)
+
+@mcp.tool()
+async def result_filter(handle: str, where: list[list], columns: list[str] = None, limit: int = None,
+                        offset: int = 0, order_by: str = None, descending: bool = False) -> str:
+    """Return stored rows matching every [column, operator, value] condition"""
+    return await db_tools.result_filter(handle, where, columns, limit, offset, order_by, descending)
+
+@mcp.tool()
+async def result_aggregate(handle: str, metrics: list[str], group_by: list[str] = None, where: list[list] = None) -> str:
+    """Aggregate a stored result, e.g. metrics=["count", "sum:amount"], grouped and filtered"""
+    return await db_tools.result_aggregate(handle, metrics, group_by, where)
+
+@mcp.tool()
+async def query_couch(db_name: str, doc_id: str = None, query: dict = None, operation: str = "read", data: dict = None,
+                      docs: list[dict] = None, doc_ids: list[str] = None, limit: int = None, fields: list[str] = None,
+                      bookmark: str = None, view: str = None) -> str:
+    """
+    Perform CRUD operations on CouchDB documents in a specific database.
+
+    Args:
+        db_name (str): Name of the CouchDB database.
+        doc_id (str): Document ID to fetch, update, or delete a specific document.
+        query (dict): Mango query (or bare selector) to list documents (if doc_id is not provided).
+            For view: view parameters such as group_level, key, startkey, endkey, reduce.
+        operation (str): The type of operation to perform. Options: "create", "read", "update", "delete",
+            "bulk_create", "bulk_read", "bulk_update", "bulk_delete", "create_index", "list_indexes",
+            "view", "define_view", "list_views".
+        data (dict): The data to use for create or update operations. For create_index: {"fields": [...], "name": ...}.
+            For define_view: {"design": ..., "view": ..., "map": "function(doc) {...}", "reduce": "_count" | "_sum" | "_stats" | js}.
+        docs (list[dict]): Documents for bulk_create, or partial documents with "_id" for bulk_update.
+        doc_ids (list[str]): Document IDs for bulk_read or bulk_delete.
+        limit (int): Maximum documents a Mango read returns (default 25, max 200).
+        fields (list[str]): Fields to return from a Mango read instead of whole documents.
+        bookmark (str): Bookmark from a previous Mango read, to fetch the next batch.
+        view (str): "design_name/view_name" for the view operation; aggregates run inside CouchDB.
+
+    Returns:
+        str: The result of the operation. Bulk writes report a status line per document.
+    """
+    return await db_tools.query_couch(db_name, doc_id, query, operation, data, docs, doc_ids, limit, fields, bookmark, view)
+
+
+@mcp.prompt()
+def mobilization_prompt(previous_membership: str, current_membership: str) -> str:
+    return f"Please review this location mobilized from {previous_membership} to {current_membership}"
+
+
+if __name__ == "__main__":
+    print("Starting server...")
+    # Initialize and run the server
     mcp.run(transport="stdio")
\ No newline at end of file